@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# Lookups per second on a shared FDB, alone and while another process keeps
+# learning new stations (which evicts old ones) and moving known ones.
+#
+#   python3 bench/fdb_lookup.py [/dev/shm/bench.fdb]
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fdb import FDB
+
+CAPACITY = 1 << 16
+STATIONS = 50000
+SECONDS = 3
+
+def stations(count, seed):
+    rng = random.Random(seed)
+    return [(rng.randrange(1, 5), rng.getrandbits(47) << 1) for _ in range(count)]
+
+def writer(table, stop, counter):
+    known = stations(STATIONS, 1)
+    fresh = stations(STATIONS, 2)
+    n = 0
+    while not stop.is_set():
+        for vlan, mac in fresh[n % STATIONS:n % STATIONS + 100]:
+            table.learn(vlan, mac, n & 7)
+        for vlan, mac in known[n % STATIONS:n % STATIONS + 100]:
+            table.learn(vlan, mac, (n >> 3) & 7)
+        n += 100
+    counter.value = n * 2
+
+def reader(path, seconds):
+    table = FDB.attach(path)
+    keys = stations(STATIONS, 1)
+    lookups = 0
+    hits = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for vlan, mac in keys[:1000]:
+            if table.lookup(vlan, mac) >= 0:
+                hits += 1
+        lookups += 1000
+        keys.append(keys.pop(0))
+    return lookups, hits
+
+def run(path, with_writer):
+    context = multiprocessing.get_context('fork')
+    table = FDB.create(path, CAPACITY, 300, context.Lock())
+    for vlan, mac in stations(STATIONS, 1):
+        table.learn(vlan, mac, 0)
+
+    stop = context.Event()
+    counter = context.RawValue('Q', 0)
+    process = None
+    if with_writer:
+        process = context.Process(target=writer, args=(table, stop, counter))
+        process.start()
+
+    lookups, hits = reader(path, SECONDS)
+
+    stop.set()
+    if process is not None:
+        process.join()
+    return lookups / SECONDS, hits / lookups, counter.value / SECONDS
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else '/dev/shm/bench.fdb'
+    print(f'{"writer":<8} {"lookups/s":>10} {"hit rate":>9} {"learns/s":>9}')
+    try:
+        for with_writer in (False, True):
+            rate, hit_rate, learns = run(path, with_writer)
+            mode = 'yes' if with_writer else 'no'
+            print(f'{mode:<8} {rate:>10.0f} {hit_rate:>9.2%} {learns:>9.0f}')
+    finally:
+        os.unlink(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+# Forwarding benchmark without root or Mininet: synthetic traffic is replayed
+# through the real switch.handle_frame, with bench/memlink.py standing in for
+# dlink.so. Reports Mpps, ns/frame, frames sent per frame received and heap
+# allocated per frame.
+#
+#   python3 bench/forwarding.py [frames]
+#
+# The switch modes are picked from the environment as usual, e.g.
+#   SWITCH_TX_IOV=1 SWITCH_ZERO_COPY=1 python3 bench/forwarding.py
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+import memlink
+sys.modules['wrapper'] = memlink
+import switch
+from stats import Stats
+
+FRAMES = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+PORT_COUNTS = (4, 16, 48)
+FRAME_SIZES = (64, 512, 1500)
+# (mix, share of learned unicast, of unknown unicast, of broadcast)
+MIXES = (('learned', 1.0, 0.0, 0.0),
+         ('unknown', 0.0, 1.0, 0.0),
+         ('broadcast', 0.0, 0.0, 1.0),
+         ('mixed', 0.8, 0.1, 0.1))
+VLANS = (1, 2, 3)
+HOSTS_PER_PORT = 4
+PATTERN = 256
+
+def host_mac(port, vlan, host):
+    return bytes([0x02, 0x00, port, vlan, host, 0x01])
+
+def make_frame(dst, src, vlan, size):
+    tag = struct.pack('!HH', 0x8200, vlan) if vlan is not None else b''
+    header = dst + src + tag + b'\x08\x00'
+    return header + bytes(size - len(header))
+
+def port_vlans(num_ports):
+    # A quarter of the ports (at least one) are trunks (0), the others access ports
+    trunks = max(1, num_ports // 4)
+    return [0 if i < trunks else VLANS[i % len(VLANS)] for i in range(num_ports)]
+
+def setup_switch(num_ports, workdir):
+    names = [f'p{i}' for i in range(num_ports)]
+    vlans = port_vlans(num_ports)
+    os.makedirs(os.path.join(workdir, 'configs'), exist_ok=True)
+    with open(os.path.join(workdir, 'configs', 'switch0.cfg'), 'w') as f:
+        f.write('10\n')
+        for name, vlan in zip(names, vlans):
+            f.write(f'{name} {"T" if vlan == 0 else vlan}\n')
+
+    os.chdir(workdir)
+    sys.argv = ['switch.py', '0'] + names
+    (switch.table, switch.ports, _, _, _, switch.interfaces,
+     switch.interface_state) = switch.init_resources()
+    switch.switch_stats = Stats(num_ports)
+    switch.use_stats(0)
+    switch.update_flood_sets()
+
+    # Hosts behind every port: one set per VLAN on trunks
+    hosts = []
+    for port, vlan in enumerate(vlans):
+        for host_vlan in (VLANS if vlan == 0 else (vlan,)):
+            for host in range(HOSTS_PER_PORT):
+                hosts.append((port, host_vlan, host_mac(port, host_vlan, host)))
+    for port, vlan, mac in hosts:
+        switch.table.learn(vlan, int.from_bytes(mac, 'big'), port)
+    return vlans, hosts
+
+def make_traffic(vlans, hosts, tagged, mix, size, rng):
+    _, learned, unknown, _ = mix
+    ingress = [(port, vlan, mac) for port, vlan, mac in hosts
+               if (vlans[port] == 0) == tagged]
+    traffic = []
+    for _ in range(PATTERN):
+        port, vlan, src = rng.choice(ingress)
+        draw = rng.random()
+        if draw < learned:
+            dst = rng.choice([mac for p, v, mac in hosts if v == vlan and p != port])
+        elif draw < learned + unknown:
+            dst = bytes([0x02, 0xee, 0, 0, 0, rng.randrange(256)])
+        else:
+            dst = b'\xff' * 6
+        traffic.append((port, make_frame(dst, src, vlan if tagged else None, size)))
+    return traffic
+
+def replay(traffic, count):
+    memlink.feed(traffic[i % len(traffic)] for i in range(count))
+    recv = memlink.recv_from_any_link
+    handle = switch.handle_frame
+    for _ in range(count):
+        interface, data, length = recv()
+        handle(interface, data, length)
+
+def time_per_frame(traffic):
+    replay(traffic, 1000)
+    memlink.reset_counters()
+    start = time.perf_counter_ns()
+    replay(traffic, FRAMES)
+    return (time.perf_counter_ns() - start) / FRAMES, memlink.tx_frames / FRAMES
+
+def heap_per_frame(traffic):
+    # Peak heap growth of one receive + handle_frame, averaged over a sample
+    samples = min(FRAMES // 10, 2000)
+    memlink.feed(traffic[i % len(traffic)] for i in range(samples))
+    total = 0
+    tracemalloc.start()
+    for _ in range(samples):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        interface, data, length = memlink.recv_from_any_link()
+        switch.handle_frame(interface, data, length)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / samples
+
+def main():
+    rng = random.Random(1)
+    workdir = tempfile.TemporaryDirectory(prefix='switch-bench-')
+    print(f'{"ports":>5} {"mix":<10} {"ingress":<9} {"size":>5} {"Mpps":>7} '
+          f'{"ns/frame":>9} {"tx/frame":>9} {"heap B/frame":>13}')
+    for num_ports in PORT_COUNTS:
+        vlans, hosts = setup_switch(num_ports, workdir.name)
+        for mix in MIXES:
+            for tagged in (False, True):
+                for size in FRAME_SIZES:
+                    traffic = make_traffic(vlans, hosts, tagged, mix, size, rng)
+                    ns, tx = time_per_frame(traffic)
+                    heap = heap_per_frame(traffic)
+                    ingress = 'tagged' if tagged else 'untagged'
+                    print(f'{num_ports:>5} {mix[0]:<10} {ingress:<9} {size:>5} '
+                          f'{1000 / ns:>7.3f} {ns:>9.0f} {tx:>9.2f} {heap:>13.1f}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# In-memory stand-in for wrapper.py / dlink.so, for benchmarks without root
+# or Mininet. Install it before switch is imported:
+#   sys.modules['wrapper'] = memlink
+# Frames to receive are queued with feed(); sent frames are only counted.
+import itertools
+
+from storm import StormControl
+
+MAX_PACKET_LEN = 1600
+MAX_BATCH_FRAMES = 64
+
+interface_names = []
+frames = iter(())
+tx_frames = 0
+tx_bytes = 0
+storm_control = None
+
+def setup(names):
+    global interface_names
+    interface_names = list(names)
+
+# Frames are (interface, data) pairs, received once each in order
+def feed(new_frames):
+    global frames
+    frames = iter(new_frames)
+
+def reset_counters():
+    global tx_frames, tx_bytes
+    tx_frames = tx_bytes = 0
+
+def init(argv_p):
+    setup(argv_p)
+    return len(interface_names)
+
+def set_zero_copy(enabled):
+    pass
+
+def set_port_stats(block):
+    pass
+
+def set_bpdu_filter(bpdus_only):
+    pass
+
+def open_control_sockets():
+    pass
+
+def recv_control(max_frames=MAX_BATCH_FRAMES):
+    return []
+
+def get_control_fd():
+    return -1
+
+def join_fanout(groups, mode=0):
+    pass
+
+def storm_init(limits, buckets, lock=None):
+    global storm_control
+    storm_control = StormControl(limits, buckets, lock)
+
+def storm_allow(port, traffic_class, length):
+    return storm_control.allow(port, traffic_class, length)
+
+def init_tx_ring(*args):
+    pass
+
+def init_rx_ring(*args):
+    pass
+
+def recv_from_any_link():
+    interface, data = next(frames)
+    return interface, data, len(data)
+
+def recv_from_any_link_batch(max_frames=MAX_BATCH_FRAMES):
+    return [(interface, data, len(data))
+            for interface, data in itertools.islice(frames, max_frames)]
+
+recv_from_any_link_ring = recv_from_any_link_batch
+
+def release_ring_frames():
+    pass
+
+def recv_from_link(interface, max_frames=MAX_BATCH_FRAMES):
+    return []
+
+def get_interface_fd(interface):
+    return -1
+
+def fastpath_punt_recv(timeout_ms=-1):
+    return None
+
+def fastpath_punt_fd():
+    return -1
+
+def flush_links():
+    pass
+
+def open_link_events():
+    return -1
+
+def recv_link_events():
+    return []
+
+def send_to_link(interface, buffer, length):
+    global tx_frames, tx_bytes
+    tx_frames += 1
+    tx_bytes += length
+
+def send_to_link_iov(interface, header, tag, payload):
+    global tx_frames, tx_bytes
+    tx_frames += 1
+    tx_bytes += len(header) + len(tag) + len(payload)
+
+def packet_type(index=None):
+    return 0
+
+def get_interface_mac(interface):
+    return bytes([0x02, 0, 0, 0, 0xff, interface])
+
+def get_switch_mac():
+    return get_interface_mac(1)
+
+def get_interface_name(interface):
+    return interface_names[interface]
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# Microbenchmark for the wrapper receive/send path: time and heap usage per
+# frame, with and without zero-copy mode.
+#
+# Needs root and a built dlink.so. The two interfaces must be the two ends of
+# a veth pair:
+#   ip link add bench0 type veth peer name bench1
+#   ip link set bench0 up; ip link set bench1 up
+#   python3 bench/wrapper_alloc.py bench0 bench1
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(sys.path[0])
+import wrapper
+
+FRAMES = 20000
+FRAME_SIZES = (64, 512, 1500)
+
+def send_recv(frame, count):
+    for _ in range(count):
+        wrapper.send_to_link(0, frame, len(frame))
+        wrapper.recv_from_any_link()
+
+def time_per_frame(frame):
+    send_recv(frame, 1000)
+    start = time.perf_counter_ns()
+    send_recv(frame, FRAMES)
+    return (time.perf_counter_ns() - start) / FRAMES
+
+def heap_per_frame(frame):
+    # Peak heap growth of one send + receive, averaged over the frames
+    total = 0
+    tracemalloc.start()
+    for _ in range(FRAMES // 10):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        send_recv(frame, 1)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / (FRAMES // 10)
+
+def main():
+    wrapper.init(sys.argv[1:])
+    print(f'{"mode":<10} {"size":>5} {"ns/frame":>10} {"heap B/frame":>13}')
+    for size in FRAME_SIZES:
+        frame = b'\x02\x00\x00\x00\x00\x01' * 2 + b'\x88\xb5' + bytes(size - 14)
+        for zero_copy in (False, True):
+            wrapper.set_zero_copy(zero_copy)
+            ns = time_per_frame(frame)
+            heap = heap_per_frame(frame)
+            mode = 'zero-copy' if zero_copy else 'copy'
+            print(f'{mode:<10} {size:>5} {ns:>10.0f} {heap:>13.1f}')
+
+if __name__ == "__main__":
+    main()
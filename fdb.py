@@ -0,0 +1,405 @@
+import mmap
+import os
+import sys
+import time
+from array import array
+from contextlib import contextmanager, nullcontext
+
+# Keys are (vlan << 48) | mac, with the MAC as a 48-bit int; VLAN ids fit in
+# 12 bits, so an all-ones key can never be a real entry.
+EMPTY = 0xFFFFFFFFFFFFFFFF
+
+DEFAULT_CAPACITY = 1 << 16
+DEFAULT_AGING_TIME = 300
+
+# Slots checked for expired entries every second
+SWEEP_CHUNK = 1024
+
+# Attempts of a lookup while a writer changes the table. A writer that died
+# in the middle (e.g. a killed worker) leaves the sequence number odd; past
+# this many attempts the lookup misses and the frame is flooded.
+READ_RETRIES = 1000
+
+# Header words at the start of a shared buffer
+COUNT, HAND, SWEEP, MAGIC, SEQ, CAPACITY, SIZE, AGING = range(8)
+HEADER_WORDS = 8
+FDB_MAGIC = 0x3142444657535452
+
+def table_size(capacity):
+    size = 2
+    while size < 2 * capacity:
+        size <<= 1
+    return size
+
+def buffer_size(capacity):
+    """Bytes of shared memory needed by an FDB of this capacity."""
+    size = table_size(capacity)
+    return HEADER_WORDS * 8 + size * (8 + 2 + 4 + 1)
+
+def mac_to_int(mac):
+    return int.from_bytes(mac, byteorder='big')
+
+def int_to_mac(mac):
+    return ':'.join(f'{b:02x}' for b in mac.to_bytes(6, byteorder='big'))
+
+class FDB:
+    """Forwarding database keyed by (VLAN, MAC).
+
+    Entries live in an open addressing table (linear probing, backward shift
+    deletion) made of typed arrays: 15 bytes per slot and at most half of the
+    slots in use. Entries older than aging_time seconds are ignored by lookups
+    and removed by a sweep that advances a little every second. When capacity
+    entries are in use a new entry replaces the least recently learned one,
+    approximated with a CLOCK hand over the slots.
+
+    With a buffer (see FDB.shared and FDB.create) the table lives in that
+    memory and can be used by several processes at once. Writers take the
+    lock and make the sequence number odd while they change the slot layout
+    (seqlock); lookups take no lock, they retry when the sequence number was
+    odd or changed under them. Refreshing the age of a known entry is a
+    single store and is done outside the lock.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, aging_time=DEFAULT_AGING_TIME,
+                 buffer=None, lock=None):
+        size = table_size(capacity)
+        self.capacity = capacity
+        self.aging_time = aging_time
+        self.mask = size - 1
+        self.lock = lock if lock is not None else nullcontext()
+        # Memory holding the table, None for a private one
+        self.buffer = buffer
+        if buffer is None:
+            self.header = array('Q', [0]) * HEADER_WORDS
+            self.keys = array('Q', [EMPTY]) * size
+            self.ports = array('h', [-1]) * size
+            # Last time the entry was learned, in whole seconds
+            self.stamps = array('I', [0]) * size
+            # CLOCK reference bits, set when an entry is learned again
+            self.ref = bytearray(size)
+        else:
+            view = memoryview(buffer)
+            offset = 0
+            fields = []
+            for fmt, count in (('Q', HEADER_WORDS), ('Q', size), ('h', size), ('I', size), ('B', size)):
+                length = count * array(fmt).itemsize
+                fields.append(view[offset:offset + length].cast(fmt))
+                offset += length
+            self.header, self.keys, self.ports, self.stamps, self.ref = fields
+            # A fresh mapping is all zeroes
+            if self.header[MAGIC] != FDB_MAGIC and not view.readonly:
+                self.clear()
+                self.header[MAGIC] = FDB_MAGIC
+        # Geometry for tools that map the table, see FDB.attach
+        if not self.readonly:
+            self.header[CAPACITY] = capacity
+            self.header[SIZE] = size
+            self.header[AGING] = aging_time
+        self.now = int(time.monotonic())
+
+    @classmethod
+    def shared(cls, capacity=DEFAULT_CAPACITY, aging_time=DEFAULT_AGING_TIME, lock=None):
+        """Creates an FDB in anonymous shared memory, inherited across fork()."""
+        buffer = mmap.mmap(-1, buffer_size(capacity))
+        return cls(capacity, aging_time, buffer, lock)
+
+    @classmethod
+    def create(cls, path, capacity=DEFAULT_CAPACITY, aging_time=DEFAULT_AGING_TIME, lock=None):
+        """Creates an FDB in a file (usually under /dev/shm), replacing any old one."""
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, buffer_size(capacity))
+            buffer = mmap.mmap(fd, buffer_size(capacity))
+        finally:
+            os.close(fd)
+        return cls(capacity, aging_time, buffer, lock)
+
+    @classmethod
+    def attach(cls, path):
+        """Maps the FDB file of a running switch read-only."""
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = memoryview(buffer)[:HEADER_WORDS * 8].cast('Q')
+        if header[MAGIC] != FDB_MAGIC:
+            raise ValueError(f'{path} is not an FDB')
+        capacity, aging_time = header[CAPACITY], header[AGING]
+        header.release()
+        return cls(capacity, aging_time, buffer)
+
+    @property
+    def readonly(self):
+        return isinstance(self.header, memoryview) and self.header.readonly
+
+    def __len__(self):
+        return self.header[COUNT]
+
+    @property
+    def count(self):
+        return self.header[COUNT]
+
+    @count.setter
+    def count(self, value):
+        self.header[COUNT] = value
+
+    @property
+    def hand(self):
+        return self.header[HAND]
+
+    @hand.setter
+    def hand(self, value):
+        self.header[HAND] = value
+
+    @property
+    def sweep(self):
+        return self.header[SWEEP]
+
+    @sweep.setter
+    def sweep(self, value):
+        self.header[SWEEP] = value
+
+    @contextmanager
+    def writing(self):
+        # Every change of the slot layout happens in here. The number is
+        # made even again from the value read first, so that an exception, or
+        # an odd number left by a writer that died, never blocks the readers.
+        with self.lock:
+            seq = self.header[SEQ] | 1
+            self.header[SEQ] = seq
+            try:
+                yield
+            finally:
+                self.header[SEQ] = seq + 1
+
+    def tick(self):
+        """Advances the FDB clock, called once per received frame or batch."""
+        now = int(time.monotonic())
+        if now != self.now:
+            self.now = now
+            if not self.readonly:
+                self.age_out(SWEEP_CHUNK)
+
+    def slot(self, key):
+        # Fibonacci hashing, the middle bits of the product mix VLAN and MAC.
+        # The product is cut to 64 bits like in C, so that the fast path
+        # (fdb_find in lib/fastpath.c) probes the same slots at any size.
+        return (((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 40) & self.mask
+
+    def find(self, key):
+        keys = self.keys
+        mask = self.mask
+        i = (((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 40) & mask
+        while True:
+            k = keys[i]
+            if k == key:
+                return i
+            if k == EMPTY:
+                return -1
+            i = (i + 1) & mask
+
+    def lookup(self, vlan, mac):
+        """Returns the port the MAC was learned on in the VLAN, or -1."""
+        # Same probe as find(), inlined since it runs for every frame
+        key = (vlan << 48) | mac
+        header = self.header
+        keys = self.keys
+        mask = self.mask
+        retries = READ_RETRIES
+        while True:
+            seq = header[SEQ]
+            i = (((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 40) & mask
+            k = keys[i]
+            while k != key and k != EMPTY:
+                i = (i + 1) & mask
+                k = keys[i]
+            port = self.ports[i]
+            stamp = self.stamps[i]
+            # A writer was busy, the probe may have seen a half moved entry
+            if seq & 1 or header[SEQ] != seq:
+                retries -= 1
+                if retries:
+                    continue
+                return -1
+            # Expired entries are left to the sweep in tick()
+            if k == EMPTY or self.now - stamp > self.aging_time:
+                return -1
+            return port
+
+    def learn(self, vlan, mac, port):
+        key = (vlan << 48) | mac
+        keys = self.keys
+        mask = self.mask
+        i = (((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 40) & mask
+        k = keys[i]
+        while k != EMPTY:
+            if k == key:
+                # Known station: only refresh it, unless it moved to another port
+                if self.ports[i] != port:
+                    break
+                now = self.now
+                if self.stamps[i] != now:
+                    self.stamps[i] = now
+                    self.ref[i] = 1
+                return
+            i = (i + 1) & mask
+            k = keys[i]
+
+        with self.writing():
+            self.insert(key, port)
+
+    def insert(self, key, port):
+        keys = self.keys
+        mask = self.mask
+        # Probe again, the table may have changed since the unlocked lookup
+        i = self.find(key)
+        if i >= 0:
+            self.ports[i] = port
+            self.stamps[i] = self.now
+            self.ref[i] = 1
+            return
+
+        if self.count >= self.capacity:
+            self.evict()
+        i = self.slot(key)
+        while keys[i] != EMPTY:
+            i = (i + 1) & mask
+        # The key goes last, so readers never match it with stale data
+        self.ports[i] = port
+        self.stamps[i] = self.now
+        self.ref[i] = 1
+        keys[i] = key
+        self.count += 1
+
+    def delete(self, i):
+        keys = self.keys
+        ports = self.ports
+        stamps = self.stamps
+        ref = self.ref
+        mask = self.mask
+        j = i
+        while True:
+            j = (j + 1) & mask
+            k = keys[j]
+            if k == EMPTY:
+                break
+            # Move the entry back into the hole unless its home slot lies
+            # cyclically in (i, j], where a lookup would still reach it
+            home = self.slot(k)
+            if (i <= j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+                # Readers retry anyway, but never see a key next to another
+                # entry's port even when they do not check the sequence number
+                keys[i] = EMPTY
+                ports[i] = ports[j]
+                stamps[i] = stamps[j]
+                ref[i] = ref[j]
+                keys[i] = k
+                i = j
+        keys[i] = EMPTY
+        ports[i] = -1
+        ref[i] = 0
+        self.count -= 1
+
+    def evict(self):
+        keys = self.keys
+        ref = self.ref
+        mask = self.mask
+        while True:
+            i = self.hand
+            self.hand = (i + 1) & mask
+            if keys[i] == EMPTY:
+                continue
+            if ref[i] and self.now - self.stamps[i] <= self.aging_time:
+                ref[i] = 0
+                continue
+            self.delete(i)
+            return
+
+    def age_out(self, chunk=None):
+        """Removes expired entries from the next chunk slots, or from all."""
+        size = self.mask + 1
+        if chunk is None or chunk > size:
+            chunk = size
+        expired = []
+        for n in range(chunk):
+            i = (self.sweep + n) & self.mask
+            if self.keys[i] != EMPTY and self.now - self.stamps[i] > self.aging_time:
+                expired.append(self.keys[i])
+        self.sweep = (self.sweep + chunk) & self.mask
+        if expired:
+            with self.writing():
+                self.remove_keys(expired)
+
+    def remove_keys(self, keys):
+        # Entries move during deletion, so they are found again by key
+        for key in keys:
+            i = self.find(key)
+            if i >= 0:
+                self.delete(i)
+
+    def flush_port(self, port):
+        self.flush_ports((port,))
+
+    def flush_ports(self, ports, vlans=None):
+        """Removes the entries learned on the ports, only in these VLANs if given."""
+        with self.writing():
+            self.remove_keys([self.keys[i] for i in self.slots_of_ports(ports)
+                              if self.keys[i] != EMPTY
+                              and (vlans is None or self.keys[i] >> 48 in vlans)])
+
+    def slots_of_ports(self, ports):
+        # Searches the port array as bytes, in C instead of slot by slot
+        raw = memoryview(self.ports).cast('B').tobytes()
+        for port in ports:
+            pattern = port.to_bytes(2, sys.byteorder, signed=True)
+            i = raw.find(pattern)
+            while i >= 0:
+                if i % 2 == 0:
+                    yield i // 2
+                i = raw.find(pattern, i + 1)
+
+    def flush_vlan(self, vlan):
+        with self.writing():
+            self.remove_keys([k for k in self.keys if k != EMPTY and k >> 48 == vlan])
+
+    def flush(self):
+        with self.writing():
+            self.clear()
+
+    def clear(self):
+        size = self.mask + 1
+        self.keys[:] = array('Q', [EMPTY]) * size
+        self.ports[:] = array('h', [-1]) * size
+        self.ref[:] = bytearray(size)
+        self.count = 0
+
+    def entries(self):
+        """Returns (vlan, mac, port, age) for every entry that has not expired.
+
+        The slots are copied under the sequence number, so the result is a
+        consistent snapshot even while the switch keeps learning.
+        """
+        header = self.header
+        for _ in range(READ_RETRIES):
+            seq = header[SEQ]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            keys = self.keys.tolist()
+            ports = self.ports.tolist()
+            stamps = self.stamps.tolist()
+            if header[SEQ] == seq:
+                break
+        else:
+            # The writer is gone: show the table as it is
+            keys = self.keys.tolist()
+            ports = self.ports.tolist()
+            stamps = self.stamps.tolist()
+
+        now = int(time.monotonic())
+        entries = []
+        for i, k in enumerate(keys):
+            if k == EMPTY:
+                continue
+            age = now - stamps[i]
+            if age <= self.aging_time:
+                entries.append((k >> 48, k & 0xFFFFFFFFFFFF, ports[i], age))
+        return entries
@@ -0,0 +1,108 @@
+#ifndef _FASTPATH_H_
+#define _FASTPATH_H_
+
+#include <stddef.h>
+#include <stdint.h>
+
+/* Frames waiting for the control plane beyond this are dropped */
+#define MAX_PUNTED_FRAMES 1024
+/* Same for the BPDUs, which have a queue of their own */
+#define MAX_CONTROL_FRAMES 256
+
+/* Hash slots of a port, each naming the LAG member its frames leave on */
+#define LAG_SLOTS 64
+
+/* Traffic classes of storm control, same order as in storm.py */
+enum {
+	STORM_UNKNOWN,
+	STORM_BROADCAST,
+	STORM_MULTICAST,
+	STORM_CLASSES
+};
+
+/*
+ * @brief Installs the port table of the forwarding thread. The arrays stay
+ * owned by the caller, which may change states at any time (e.g. on STP
+ * events).
+ *
+ * @param vlans - access VLAN of each port, 0 for trunk ports
+ * @param states - one row per spanning tree instance, with one entry per
+ * interface: non-zero for ports that forward, 0 for blocked ports
+ * @param instances - row of states used by each of the 4096 VLAN ids
+ */
+void fastpath_set_ports(const int *vlans, const volatile uint8_t *states,
+			const uint8_t *instances);
+
+/*
+ * @brief Installs the link aggregation groups. A LAG is a single logical
+ * port, numbered after its first member: the FDB, STP and states only know
+ * that one. The arrays stay owned by the caller, which may change slots at
+ * any time (e.g. when a member loses its carrier).
+ *
+ * @param lags - logical port of each interface, the interface itself if it
+ * is in no LAG
+ * @param slots - LAG_SLOTS entries per logical port: the member that sends
+ * the frames whose MACs hash to the slot
+ */
+void fastpath_set_lags(const int *lags, const volatile int *slots);
+
+/*
+ * @brief Installs the storm control limits. Frames a port would flood beyond
+ * them are dropped and counted as STATS_DROP_STORM. The arrays stay owned by
+ * the caller. Without limits nothing is dropped.
+ *
+ * @param limits - two words per port and traffic class, ports first: the
+ * packets and the bytes per second the port may flood, 0 for no limit
+ * @param buckets - one word per limit, zeroed for full buckets (see storm.py).
+ * The processes that share them share the limits.
+ */
+void storm_init(const uint32_t *limits, volatile uint64_t *buckets);
+
+/*
+ * @brief Takes a frame from the buckets of a port and traffic class, atomically.
+ *
+ * @param port - logical port the frame came in on
+ * @param storm_class - STORM_UNKNOWN, STORM_BROADCAST or STORM_MULTICAST
+ * @param len - length of the frame
+ * @return 1 if the frame may be flooded, 0 if the port is over its limit
+ */
+int storm_allow(int port, int storm_class, size_t len);
+
+/*
+ * @brief Installs the FDB the forwarding thread looks MACs up in. fdb points
+ * to the shared memory of the Python FDB (see fdb.py for the layout); the
+ * thread only reads it, except for refreshing the age of known sources.
+ *
+ * @param fdb - start of the table, header included
+ * @param size - number of slots, a power of two
+ */
+void fastpath_set_fdb(void *fdb, uint64_t size);
+
+/*
+ * @brief Starts the forwarding thread. It receives on every interface,
+ * forwards known traffic itself and punts the rest: BPDUs (from blocked
+ * ports too), frames whose source is unknown, expired or moved, and
+ * untagged frames on trunks. Punted frames keep the interface they came in
+ * on, not their logical port.
+ * Nothing else may receive from the interfaces afterwards.
+ * Returns: 0 on success, -1 if the tables are not installed.
+ */
+int fastpath_start(void);
+
+/*
+ * @brief Takes the oldest punted BPDU, or the oldest punted frame if no BPDU
+ * is waiting. Waits at most timeout_ms for one (forever if negative).
+ *
+ * @param frame_data - buffer of at least MAX_PACKET_LEN bytes
+ * @param length - will be set to the length of the frame
+ * Returns: the interface the frame was received on, -1 on timeout.
+ */
+int fastpath_punt_recv(char *frame_data, size_t *length, int timeout_ms);
+
+/*
+ * @brief Returns an eventfd that is readable while punted frames are queued,
+ * for callers with their own event loop.
+ */
+int fastpath_punt_fd(void);
+
+#endif /* _FASTPATH_H_ */
@@ -7,13 +7,62 @@
 #include <stdlib.h>
 
 #define MAX_PACKET_LEN 1600
-#define SWITCH_NUM_INTERFACES 4
+#define MAX_BATCH_FRAMES 64
 
+/* Counters kept for every port, in this order (see stats.py) */
+enum {
+	STATS_RX_FRAMES,
+	STATS_RX_BYTES,
+	STATS_TX_FRAMES,
+	STATS_TX_BYTES,
+	STATS_UNICAST,
+	STATS_FLOOD,
+	STATS_BROADCAST,
+	STATS_MULTICAST,
+	STATS_BPDU,
+	STATS_DROP_BLOCKED,
+	STATS_DROP_VLAN,
+	STATS_DROP_STORM,
+	STATS_LINK_DOWN,
+	STATS_COUNTERS
+};
+
+extern uint64_t *port_stats;
+
+/*
+ * @brief Sets the counters updated by the library: STATS_COUNTERS words per
+ * interface, owned by the caller. Receiving and sending count rx/tx frames
+ * and bytes; the fast path also counts its forwarding decisions and drops.
+ */
+void set_port_stats(uint64_t *counters);
+
+static inline void port_stats_add(int intidx, int counter, uint64_t value)
+{
+	/* Several threads send, so the updates must not get lost */
+	if (port_stats)
+		__atomic_fetch_add(&port_stats[intidx * STATS_COUNTERS + counter], value,
+				   __ATOMIC_RELAXED);
+}
+
+/*
+ * @brief Sends a frame on an interface. When the interface has a transmit
+ * ring the frame is only queued, see tx_ring_flush.
+ */
 int send_to_link(int interface, char *frame_data, size_t length);
 
+/*
+ * @brief Sends a frame made of three pieces, e.g. the MAC addresses, a VLAN tag
+ * and the rest of the original frame, with a single writev. The pieces are
+ * never copied into one buffer, except into the slot of a transmit ring.
+ * tag_len may be 0.
+ */
+int send_to_link_iov(int interface, char *header, size_t header_len,
+		     char *tag, size_t tag_len, char *payload, size_t payload_len);
+
 /*
  * @brief Receives a packet. Blocking function, blocks if there is no packet to
- * be received.
+ * be received. Ports with pending packets are served round-robin, after any
+ * pending BPDU (see open_control_sockets).
  *
  * @param frame_data - region of memory in which the data will be copied; should
  *        have at least MAX_PACKET_LEN bytes allocated 
@@ -22,8 +71,167 @@ int send_to_link(int interface, char *frame_data, size_t length);
  */
 int recv_from_any_link(char *frame_data, size_t *length);
 
+/*
+ * @brief Receives up to max_frames packets from all the ready interfaces in a
+ * single call. Blocks until at least one packet is available. Pending BPDUs
+ * (see open_control_sockets) come first.
+ *
+ * @param frames - contiguous region of memory of max_frames * frame_len bytes;
+ *        frame i is written at offset i * frame_len
+ * @param frame_len - size of one frame slot, at least MAX_PACKET_LEN
+ * @param max_frames - capacity of the output arrays (capped at MAX_BATCH_FRAMES)
+ * @param ifaces - will be set to the interface each frame was received from
+ * @param offsets - will be set to the offset of each frame inside frames
+ * @param lengths - will be set to the length of each frame
+ * @param pkttypes - if not NULL, will be set to the packet type of each frame
+ * Returns: the number of frames received.
+ */
+int recv_from_any_link_batch(char *frames, size_t frame_len, int max_frames,
+			      int *ifaces, size_t *offsets, size_t *lengths,
+			      int *pkttypes);
+
+/*
+ * @brief Receives the frames already queued on one interface, without
+ * blocking. Meant for callers that run their own event loop on the sockets
+ * returned by get_interface_fd.
+ *
+ * @param intidx - interface index
+ * @param frames - buffer of max_frames slots of frame_len bytes each
+ * @param frame_len - size of one frame slot, at least MAX_PACKET_LEN
+ * @param max_frames - capacity of the output arrays (capped at MAX_BATCH_FRAMES)
+ * @param offsets - will be set to the offset of each frame inside frames
+ * @param lengths - will be set to the length of each frame
+ * @param pkttypes - if not NULL, will be set to the packet type of each frame
+ * Returns: the number of frames received, 0 if none was queued, -1 on error.
+ */
+int recv_from_link_batch(int intidx, char *frames, size_t frame_len, int max_frames,
+			 size_t *offsets, size_t *lengths, int *pkttypes);
+
+/*
+ * @brief Returns the socket of an interface, to wait for it with poll/epoll.
+ */
+int get_interface_fd(int intidx);
+
+/*
+ * @brief Returns the packet type (PACKET_HOST, PACKET_BROADCAST,
+ * PACKET_MULTICAST, PACKET_OTHERHOST) of the frame last returned by
+ * recv_from_any_link. Frames sent on an interface (PACKET_OUTGOING) are
+ * dropped by the kernel and never received.
+ */
+int get_last_packet_type(void);
+
+
+/*
+ * @brief Switches every interface to a memory mapped TPACKET_V3 receive ring.
+ * After this call packets must be received with rx_ring_recv instead of
+ * recv_from_any_link / recv_from_any_link_batch.
+ *
+ * @param block_size - size of one ring block, a multiple of the page size
+ * @param block_nr - number of blocks per interface
+ * @param frame_size - maximum size of a captured frame, including its header
+ * @param block_timeout - milliseconds after which a partially filled block is
+ *        handed to user space
+ * Returns: 0 on success.
+ */
+int init_rx_ring(unsigned int block_size, unsigned int block_nr,
+		 unsigned int frame_size, unsigned int block_timeout);
+
+/* Returns the base of the receive ring of an interface and sets its size */
+void *get_rx_ring(int intidx, size_t *size);
+
+/*
+ * @brief Receives frames from the receive ring of any interface, without
+ * copying them. Blocking function. Returns no frame while BPDUs are pending
+ * on the control sockets: call recv_control until it returns -1 first.
+ *
+ * @param intidx - will be set to the interface the frames belong to
+ * @param offsets - will be set to the offset of each frame inside the ring
+ *        returned by get_rx_ring
+ * @param lengths - will be set to the length of each frame
+ * @param pkttypes - if not NULL, will be set to the packet type of each frame
+ * @param max_frames - capacity of offsets, lengths and pkttypes
+ * Returns: the number of frames. They stay valid until rx_ring_release.
+ */
+int rx_ring_recv(int *intidx, size_t *offsets, size_t *lengths, int *pkttypes,
+		 int max_frames);
+
+/*
+ * @brief Gives the current block of an interface back to the kernel, once
+ * every frame in it has been returned by rx_ring_recv.
+ */
+void rx_ring_release(int intidx);
+
+/*
+ * @brief Adds a memory mapped TPACKET_V3 transmit ring to every interface.
+ * send_to_link then only queues frames in the ring; they are put on the wire
+ * by tx_ring_flush, or when the ring of the interface is full.
+ *
+ * @param block_size - size of one ring block, a multiple of the page size
+ * @param block_nr - number of blocks per interface
+ * @param frame_size - size of a ring slot, including its header
+ * Returns: 0 on success.
+ */
+int init_tx_ring(unsigned int block_size, unsigned int block_nr,
+		 unsigned int frame_size);
+
+/*
+ * @brief Transmits the frames queued in the transmit rings, with one
+ * non-blocking sendto per interface that has pending frames.
+ * Returns: the number of interfaces kicked.
+ */
+int tx_ring_flush(void);
+
+/*
+ * @brief Attaches a classic BPF filter to every interface that accepts either
+ * only the frames sent to 01:80:c2:00:00:00 (BPDUs) or every frame but those.
+ * Used to split the control plane and the forwarding workers.
+ *
+ * @param bpdus_only - 1 to keep only BPDUs, 0 to drop them
+ * Returns: 0 on success.
+ */
+int set_bpdu_filter(int bpdus_only);
+
+/*
+ * @brief Gives BPDUs a receive queue of their own, ahead of the data frames:
+ * opens a second socket on every interface that only accepts BPDUs, and
+ * makes the data sockets drop them. A BPDU then never waits behind the data
+ * frames queued on its port; the receive functions serve the control
+ * sockets first. Not for use together with set_bpdu_filter.
+ * Returns: 0 on success.
+ */
+int open_control_sockets(void);
+
+/*
+ * @brief Receives a pending BPDU from the control sockets, without blocking.
+ *
+ * @param frame_data - buffer of at least MAX_PACKET_LEN bytes
+ * @param length - will be set to the length of the frame
+ * Returns: the interface it has been received on, -1 if none is pending or
+ * the control sockets are not open.
+ */
+int recv_control(char *frame_data, size_t *length);
+
+/*
+ * @brief Returns a descriptor that is readable while BPDUs are pending on the
+ * control sockets, for callers with their own event loop; -1 if they are not
+ * open.
+ */
+int get_control_fd(void);
+
+/*
+ * @brief Joins the socket of every interface to a PACKET_FANOUT group, so that
+ * the frames of a port are spread across the processes that joined it.
+ * Interface i joins the first group id, from groups[i] on, that the kernel
+ * accepts, and the id is written back to groups[i]. Processes that join one
+ * after the other with the same array therefore end up in the same groups.
+ *
+ * @param groups - first id to try for every interface, 0 to 0xffff
+ * @param mode - PACKET_FANOUT_HASH (0) keeps the frames of a flow together
+ * Returns: 0 on success.
+ */
+int join_fanout(int *groups, int mode);
 
-/* Returns the name of an itnerface */
+/* Returns the name of an itnerface, as it was passed to init */
 char *get_interface_name(int interface);
 
 char *get_interface_ip(int interface);
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# Runs the switches of a topology over AF_UNIX seqpacket socketpairs (see
+# unixlink.py), without root, Mininet or real interfaces.
+#
+#   python3 launcher.py topologies/default.topo [settle_seconds]
+#
+# Starts every switch, waits for STP to settle, then has every host send a
+# broadcast and prints which hosts got it. Tests (see tests/) use Topology:
+#
+#   with Topology('topologies/default.topo') as topo:
+#       topo.send('h-0', frame)
+#       topo.receive('h-1', timeout=0.5)
+#       topo.cut('switch0', 'rr-0-1')     # unplugs a cable
+#       topo.plug('switch0', 'rr-0-1')    # and plugs a new one in
+#       topo.kill('switch1')              # a switch loses power
+#
+# Extra environment for the switches (SWITCH_ASYNC=1, ...) is passed through.
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def parse_topology(path):
+    # Returns the links and the config template of the switches, if the
+    # topology names one with a "config configs/.../switch{id}.cfg" line
+    links = []
+    config = None
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            a, b = line.split()
+            if a == 'config':
+                config = b
+                continue
+            links.append((tuple(a.split(':')), tuple(b.split(':'))))
+    return links, config
+
+def is_switch(node):
+    return node.startswith('switch')
+
+class Topology:
+    def __init__(self, path, env=None, log_dir=None):
+        self.links, config = parse_topology(path)
+        self.env = dict(env or {})
+        if config:
+            self.env.setdefault('SWITCH_CONFIG', config)
+        self.log_dir = log_dir
+        self.switch_ports = {}
+        self.hosts = {}
+        self.processes = {}
+        # Our copies of the switch ends, to cut links with, and the sockets
+        # new cables go to the switches on
+        self.switch_ends = {}
+        self.controls = {}
+        for end in (end for link in self.links for end in link):
+            node, port = end
+            if is_switch(node):
+                self.switch_ports.setdefault(node, [])
+                if port not in self.switch_ports[node]:
+                    self.switch_ports[node].append(port)
+
+    def start(self):
+        # One socketpair per link; each side keeps its own end
+        ends = {}
+        for a, b in self.links:
+            ends[a], ends[b] = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        for (node, port), sock in ends.items():
+            if not is_switch(node):
+                sock.setblocking(False)
+                self.hosts[node] = sock
+
+        for node, ports in self.switch_ports.items():
+            fds = [ends[(node, port)].fileno() for port in ports]
+            self.controls[node], control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            env = dict(os.environ, **self.env)
+            env['SWITCH_BACKEND'] = 'unixlink'
+            env['SWITCH_LINK_NODE'] = node
+            env['SWITCH_LINK_FDS'] = ','.join(f'{port}={fd}' for port, fd in zip(ports, fds))
+            env['SWITCH_LINK_CONTROL'] = str(control.fileno())
+            output = subprocess.DEVNULL
+            if self.log_dir:
+                output = open(os.path.join(self.log_dir, f'{node}.log'), 'w')
+            switch_id = node[len('switch'):]
+            self.processes[node] = subprocess.Popen(
+                [sys.executable, 'switch.py', switch_id] + ports,
+                cwd=HERE, env=env, pass_fds=fds + [control.fileno()], stdout=output,
+                stderr=subprocess.STDOUT)
+            control.close()
+
+        for end, sock in ends.items():
+            if is_switch(end[0]):
+                self.switch_ends[end] = sock
+
+    def cut(self, node, port):
+        """Unplugs the cable at node:port, both ends lose their carrier."""
+        self.switch_ends[(node, port)].shutdown(socket.SHUT_RDWR)
+
+    def plug(self, node, port):
+        """Plugs a new cable in where node:port was cut, both ends get their
+        carrier back."""
+        link = next(link for link in self.links if (node, port) in link)
+        for end, sock in zip(link, socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)):
+            if is_switch(end[0]):
+                socket.send_fds(self.controls[end[0]], [end[1].encode()], [sock.fileno()])
+                self.switch_ends[end].close()
+                self.switch_ends[end] = sock
+            else:
+                sock.setblocking(False)
+                self.hosts[end[0]].close()
+                self.hosts[end[0]] = sock
+
+    def kill(self, node):
+        # Our copies keep the sockets open, so the links are cut by hand
+        self.processes[node].kill()
+        for end in self.switch_ends:
+            if end[0] == node:
+                self.cut(*end)
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for sock in (list(self.hosts.values()) + list(self.switch_ends.values()) +
+                     list(self.controls.values())):
+            sock.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def send(self, host, frame):
+        self.hosts[host].send(frame)
+
+    def receive(self, host, timeout=0.5):
+        """Returns the frames host receives within timeout seconds."""
+        sock = self.hosts[host]
+        frames = []
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return frames
+            if not select.select([sock], [], [], remaining)[0]:
+                continue
+            try:
+                frame = sock.recv(2048)
+            except BlockingIOError:
+                continue
+            if not frame:
+                # The switch is gone
+                return frames
+            frames.append(frame)
+
+    def drain(self, timeout=0.2):
+        return {host: self.receive(host, timeout) for host in self.hosts}
+
+def host_mac(index):
+    return bytes([0x02, 0x00, 0x00, 0x00, 0x00, index])
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: launcher.py TOPOLOGY [SETTLE_SECONDS]', file=sys.stderr)
+        sys.exit(2)
+    settle = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+
+    with Topology(sys.argv[1]) as topo:
+        time.sleep(settle)
+        hosts = sorted(topo.hosts)
+        for index, host in enumerate(hosts):
+            topo.drain(0.05)
+            frame = b'\xff' * 6 + host_mac(index) + b'\x08\x00' + bytes(46)
+            topo.send(host, frame)
+            got = [h for h, frames in topo.drain().items()
+                   if any(f[6:12] == host_mac(index) for f in frames)]
+            print(f'{host} -> {" ".join(sorted(got)) or "-"}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+#define _GNU_SOURCE
+
+#include "fastpath.h"
+#include "lib.h"
+#include "queue.h"
+
+#include <errno.h>
+#include <pthread.h>
+#include <string.h>
+#include <sys/eventfd.h>
+#include <time.h>
+
+/* Ethertype of the 802.1Q tags used by the switch */
+#define VLAN_TPID 0x8200
+#define BPDU_MAC 0x0180c2000000ULL
+
+/* Layout of the FDB shared with fdb.py: header words, then the slot arrays */
+#define FDB_HEADER_WORDS 8
+#define FDB_SEQ 4
+#define FDB_AGING 7
+#define FDB_EMPTY 0xFFFFFFFFFFFFFFFFULL
+/*
+ * Attempts of a lookup before it gives up on a busy writer, as FDB.lookup.
+ * A writer that died in FDB.writing leaves the sequence number odd for good.
+ */
+#define FDB_READ_RETRIES 100000
+
+#define NSEC_PER_SEC 1000000000ULL
+
+extern int *interfaces;
+extern int num_interfaces;
+
+struct punted_frame {
+	int intidx;
+	size_t len;
+	char data[MAX_PACKET_LEN];
+};
+
+static const int *port_vlans;
+static const volatile uint8_t *port_states;
+static const uint8_t *vlan_instances;
+static const int *port_lags;
+static const volatile int *lag_slots;
+
+static const uint32_t *storm_limits;
+static volatile uint64_t *storm_buckets;
+
+static volatile uint64_t *fdb_header;
+static volatile uint64_t *fdb_keys;
+static volatile int16_t *fdb_ports;
+static volatile uint32_t *fdb_stamps;
+static volatile uint8_t *fdb_ref;
+static uint64_t fdb_mask;
+
+/*
+ * BPDUs wait in a queue of their own, always taken first, so that STP keeps
+ * its timing however many data frames are punted. Data frames beyond
+ * MAX_PUNTED_FRAMES are dropped on arrival.
+ */
+static queue control_queue;
+static queue punt_queue;
+static int control_punted;
+static int punted;
+static int punt_event = -1;
+static pthread_mutex_t punt_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t punt_cond = PTHREAD_COND_INITIALIZER;
+
+static pthread_t fastpath_thread;
+
+void fastpath_set_ports(const int *vlans, const volatile uint8_t *states,
+			const uint8_t *instances)
+{
+	port_vlans = vlans;
+	port_states = states;
+	vlan_instances = instances;
+}
+
+void fastpath_set_lags(const int *lags, const volatile int *slots)
+{
+	port_lags = lags;
+	lag_slots = slots;
+}
+
+void storm_init(const uint32_t *limits, volatile uint64_t *buckets)
+{
+	storm_buckets = buckets;
+	storm_limits = limits;
+}
+
+void fastpath_set_fdb(void *fdb, uint64_t size)
+{
+	uint8_t *p = fdb;
+
+	fdb_header = (volatile uint64_t *)p;
+	p += FDB_HEADER_WORDS * sizeof(uint64_t);
+	fdb_keys = (volatile uint64_t *)p;
+	p += size * sizeof(uint64_t);
+	fdb_ports = (volatile int16_t *)p;
+	p += size * sizeof(int16_t);
+	fdb_stamps = (volatile uint32_t *)p;
+	p += size * sizeof(uint32_t);
+	fdb_ref = (volatile uint8_t *)p;
+	fdb_mask = size - 1;
+}
+
+static uint64_t mac_at(const uint8_t *p)
+{
+	return ((uint64_t)p[0] << 40) | ((uint64_t)p[1] << 32) | ((uint64_t)p[2] << 24) |
+	       ((uint64_t)p[3] << 16) | ((uint64_t)p[4] << 8) | p[5];
+}
+
+static uint32_t fdb_now(void)
+{
+	struct timespec ts;
+
+	/* Same clock as time.monotonic() in fdb.py */
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return ts.tv_sec;
+}
+
+/*
+ * Seqlock read of the slot of key, same probe as FDB.lookup, which also
+ * truncates the product to 64 bits. Returns the slot, -1 if the key is not
+ * in the table or no consistent read was possible (the frame is flooded).
+ */
+static int64_t fdb_find(uint64_t key, int16_t *port, uint32_t *stamp)
+{
+	uint64_t seq, i, k, probes;
+	int retries;
+
+	for (retries = 0; retries < FDB_READ_RETRIES; retries++) {
+		seq = __atomic_load_n(&fdb_header[FDB_SEQ], __ATOMIC_ACQUIRE);
+		if (seq & 1)
+			continue;
+
+		i = ((key * 0x9E3779B97F4A7C15ULL) >> 40) & fdb_mask;
+		/* A torn read could probe forever, the sequence check catches it */
+		for (probes = 0; probes <= fdb_mask; probes++) {
+			k = fdb_keys[i];
+			if (k == key || k == FDB_EMPTY)
+				break;
+			i = (i + 1) & fdb_mask;
+		}
+		*port = fdb_ports[i];
+		*stamp = fdb_stamps[i];
+
+		__atomic_thread_fence(__ATOMIC_ACQUIRE);
+		if (__atomic_load_n(&fdb_header[FDB_SEQ], __ATOMIC_RELAXED) == seq)
+			return k == key ? (int64_t)i : -1;
+	}
+	return -1;
+}
+
+/* Port the MAC was learned on in the VLAN, -1 if unknown or expired */
+static int fdb_lookup(int vlan, uint64_t mac, uint32_t now)
+{
+	int16_t port;
+	uint32_t stamp;
+
+	if (fdb_find(((uint64_t)vlan << 48) | mac, &port, &stamp) < 0)
+		return -1;
+	if (now - stamp > fdb_header[FDB_AGING])
+		return -1;
+	return port;
+}
+
+/*
+ * Refreshes a source learned on the same port, like FDB.learn does without
+ * the lock. Returns 0 when the control plane has to learn it.
+ */
+static int fdb_refresh_source(int vlan, uint64_t mac, int intidx, uint32_t now)
+{
+	int16_t port;
+	uint32_t stamp;
+	int64_t i = fdb_find(((uint64_t)vlan << 48) | mac, &port, &stamp);
+
+	if (i < 0 || port != intidx || now - stamp > fdb_header[FDB_AGING])
+		return 0;
+	if (stamp != now) {
+		fdb_stamps[i] = now;
+		fdb_ref[i] = 1;
+	}
+	return 1;
+}
+
+static void punt(int intidx, const uint8_t *frame, size_t len, int control)
+{
+	struct punted_frame *p;
+	uint64_t one = 1;
+
+	if (len > MAX_PACKET_LEN)
+		return;
+
+	pthread_mutex_lock(&punt_lock);
+	if (control ? control_punted >= MAX_CONTROL_FRAMES : punted >= MAX_PUNTED_FRAMES) {
+		pthread_mutex_unlock(&punt_lock);
+		return;
+	}
+	p = malloc(sizeof(*p));
+	if (p == NULL) {
+		pthread_mutex_unlock(&punt_lock);
+		return;
+	}
+	p->intidx = intidx;
+	p->len = len;
+	memcpy(p->data, frame, len);
+
+	if (punted + control_punted == 0) {
+		if (write(punt_event, &one, sizeof(one)) < 0)
+			perror("write eventfd");
+	}
+	if (control) {
+		control_punted++;
+		queue_enq(control_queue, p);
+	} else {
+		punted++;
+		queue_enq(punt_queue, p);
+	}
+	pthread_cond_signal(&punt_cond);
+	pthread_mutex_unlock(&punt_lock);
+}
+
+int fastpath_punt_recv(char *frame_data, size_t *length, int timeout_ms)
+{
+	struct punted_frame *p;
+	struct timespec deadline;
+	uint64_t value;
+	int intidx;
+
+	clock_gettime(CLOCK_REALTIME, &deadline);
+	deadline.tv_sec += timeout_ms / 1000;
+	deadline.tv_nsec += (long)(timeout_ms % 1000) * 1000000;
+	if (deadline.tv_nsec >= 1000000000) {
+		deadline.tv_sec++;
+		deadline.tv_nsec -= 1000000000;
+	}
+
+	pthread_mutex_lock(&punt_lock);
+	while (queue_empty(control_queue) && queue_empty(punt_queue)) {
+		int res = timeout_ms < 0 ? pthread_cond_wait(&punt_cond, &punt_lock) :
+			  pthread_cond_timedwait(&punt_cond, &punt_lock, &deadline);
+
+		if (res == ETIMEDOUT && queue_empty(control_queue) && queue_empty(punt_queue)) {
+			pthread_mutex_unlock(&punt_lock);
+			return -1;
+		}
+	}
+	if (!queue_empty(control_queue)) {
+		p = queue_deq(control_queue);
+		control_punted--;
+	} else {
+		p = queue_deq(punt_queue);
+		punted--;
+	}
+	/* The eventfd stays readable exactly while frames are queued */
+	if (punted + control_punted == 0) {
+		if (read(punt_event, &value, sizeof(value)) < 0 && errno != EAGAIN)
+			perror("read eventfd");
+	}
+	pthread_mutex_unlock(&punt_lock);
+
+	intidx = p->intidx;
+	memcpy(frame_data, p->data, p->len);
+	*length = p->len;
+	free(p);
+	return intidx;
+}
+
+int fastpath_punt_fd(void)
+{
+	return punt_event;
+}
+
+/* Sends the frame on out, pushing or popping the tag the egress port needs */
+static void forward_to(int out, uint8_t *frame, size_t len, int tagged, int vlan)
+{
+	uint8_t tag[4] = { VLAN_TPID >> 8, VLAN_TPID & 0xff, (vlan >> 8) & 0x0f, vlan & 0xff };
+
+	if (port_vlans[out] == 0) {
+		if (tagged)
+			send_to_link(out, (char *)frame, len);
+		else
+			send_to_link_iov(out, (char *)frame, 12, (char *)tag, 4,
+					 (char *)frame + 12, len - 12);
+	} else {
+		if (tagged)
+			send_to_link_iov(out, (char *)frame, 12, NULL, 0,
+					 (char *)frame + 16, len - 16);
+		else
+			send_to_link(out, (char *)frame, len);
+	}
+}
+
+/*
+ * Takes cost ns from a bucket of storm.py: the word is the time at which the
+ * traffic let through so far drained, at most a second ahead of now. Every
+ * process sharing the buckets may take at the same time.
+ */
+static int storm_take(volatile uint64_t *bucket, uint64_t cost, uint64_t now)
+{
+	uint64_t old = __atomic_load_n(bucket, __ATOMIC_RELAXED), next;
+
+	do {
+		next = (old > now ? old : now) + cost;
+		if (next - now > NSEC_PER_SEC)
+			return 0;
+	} while (!__atomic_compare_exchange_n(bucket, &old, next, 0,
+					      __ATOMIC_RELAXED, __ATOMIC_RELAXED));
+	return 1;
+}
+
+/* Gives back what storm_take took, unless the bucket was emptied meanwhile */
+static void storm_refund(volatile uint64_t *bucket, uint64_t cost)
+{
+	uint64_t old = __atomic_load_n(bucket, __ATOMIC_RELAXED);
+
+	while (old >= cost && !__atomic_compare_exchange_n(bucket, &old, old - cost, 0,
+							   __ATOMIC_RELAXED, __ATOMIC_RELAXED))
+		;
+}
+
+int storm_allow(int port, int storm_class, size_t len)
+{
+	int i = (port * STORM_CLASSES + storm_class) * 2;
+	uint32_t packet_rate, byte_rate;
+	struct timespec ts;
+	uint64_t now;
+
+	if (storm_limits == NULL)
+		return 1;
+	packet_rate = storm_limits[i];
+	byte_rate = storm_limits[i + 1];
+	if (!packet_rate && !byte_rate)
+		return 1;
+
+	/* The clock of time.monotonic_ns() */
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	now = ts.tv_sec * NSEC_PER_SEC + ts.tv_nsec;
+	if (packet_rate && !storm_take(&storm_buckets[i], NSEC_PER_SEC / packet_rate, now))
+		return 0;
+	if (byte_rate && !storm_take(&storm_buckets[i + 1], len * NSEC_PER_SEC / byte_rate, now)) {
+		if (packet_rate)
+			storm_refund(&storm_buckets[i], NSEC_PER_SEC / packet_rate);
+		return 0;
+	}
+	return 1;
+}
+
+/*
+ * Sends the frame on a member of the logical port out. The member only
+ * depends on the MACs, so the frames of a flow are never reordered.
+ */
+static void forward_to_lag(int out, uint8_t *frame, size_t len, int tagged, int vlan)
+{
+	int slot = (frame[4] ^ frame[5] ^ frame[10] ^ frame[11]) & (LAG_SLOTS - 1);
+
+	forward_to(lag_slots[out * LAG_SLOTS + slot], frame, len, tagged, vlan);
+}
+
+/* Same decisions as handle_frame in switch.py for the frames it does not punt */
+static void forward_frame(int intidx, uint8_t *frame, size_t len, uint32_t now)
+{
+	uint64_t dst, src;
+	int tagged, vlan, out, port, storm_class;
+	const volatile uint8_t *states;
+
+	if (len < 14)
+		return;
+	dst = mac_at(frame);
+	/* BPDUs are for STP, blocked ports included */
+	if (dst == BPDU_MAC) {
+		punt(intidx, frame, len, 1);
+		return;
+	}
+	/* The members of a LAG are one port, the first of them, past this point */
+	port = port_lags[intidx];
+
+	src = mac_at(frame + 6);
+	tagged = ((frame[12] << 8) | frame[13]) == VLAN_TPID;
+
+	/*
+	 * Untagged frames on trunks and tagged frames on access ports are rare
+	 * and keep their Python handling as it is.
+	 */
+	if ((tagged && len < 18) || tagged != (port_vlans[port] == 0)) {
+		punt(intidx, frame, len, 0);
+		return;
+	}
+	vlan = tagged ? (((frame[14] << 8) | frame[15]) & 0x0fff) : port_vlans[port];
+
+	/* Port states of the spanning tree instance of the VLAN */
+	states = port_states + vlan_instances[vlan] * num_interfaces;
+	if (!states[port]) {
+		port_stats_add(port, STATS_DROP_BLOCKED, 1);
+		return;
+	}
+
+	if (!fdb_refresh_source(vlan, src, port, now)) {
+		punt(intidx, frame, len, 0);
+		return;
+	}
+
+	if (!((dst >> 40) & 1)) {
+		out = fdb_lookup(vlan, dst, now);
+		/* Entries behind a port that stopped forwarding are flooded */
+		if (out >= 0 && states[out]) {
+			port_stats_add(port, STATS_UNICAST, 1);
+			forward_to_lag(out, frame, len, tagged, vlan);
+			return;
+		}
+		port_stats_add(port, STATS_FLOOD, 1);
+		storm_class = STORM_UNKNOWN;
+	} else if (dst == 0xFFFFFFFFFFFFULL) {
+		port_stats_add(port, STATS_BROADCAST, 1);
+		storm_class = STORM_BROADCAST;
+	} else {
+		port_stats_add(port, STATS_MULTICAST, 1);
+		storm_class = STORM_MULTICAST;
+	}
+
+	if (!storm_allow(port, storm_class, len)) {
+		port_stats_add(port, STATS_DROP_STORM, 1);
+		return;
+	}
+
+	/* Members other than the first are blocked in every instance */
+	for (out = 0; out < num_interfaces; out++) {
+		if (out == port || !states[out])
+			continue;
+		if (port_vlans[out] != 0 && port_vlans[out] != vlan)
+			continue;
+		forward_to_lag(out, frame, len, tagged, vlan);
+	}
+}
+
+static void *fastpath_loop(void *arg)
+{
+	static char frames[MAX_BATCH_FRAMES * MAX_PACKET_LEN];
+	int ifaces[MAX_BATCH_FRAMES];
+	size_t offsets[MAX_BATCH_FRAMES], lengths[MAX_BATCH_FRAMES];
+	size_t ring_size;
+	int use_ring = get_rx_ring(0, &ring_size) != NULL;
+	int count, intidx;
+
+	for (;;) {
+		uint32_t now;
+
+		if (use_ring) {
+			/* The rings hold no BPDUs once the control sockets are open */
+			while ((intidx = recv_control(frames, &lengths[0])) >= 0)
+				punt(intidx, (uint8_t *)frames, lengths[0], 1);
+
+			count = rx_ring_recv(&intidx, offsets, lengths, NULL, MAX_BATCH_FRAMES);
+			uint8_t *ring = get_rx_ring(intidx, &ring_size);
+
+			now = fdb_now();
+			for (int i = 0; i < count; i++)
+				forward_frame(intidx, ring + offsets[i], lengths[i], now);
+			tx_ring_flush();
+			rx_ring_release(intidx);
+			continue;
+		}
+
+		count = recv_from_any_link_batch(frames, MAX_PACKET_LEN, MAX_BATCH_FRAMES,
+						 ifaces, offsets, lengths, NULL);
+		now = fdb_now();
+		for (int i = 0; i < count; i++)
+			forward_frame(ifaces[i], (uint8_t *)frames + offsets[i], lengths[i], now);
+		tx_ring_flush();
+	}
+
+	return NULL;
+}
+
+int fastpath_start(void)
+{
+	if (port_vlans == NULL || port_states == NULL || vlan_instances == NULL ||
+	    port_lags == NULL || lag_slots == NULL || fdb_header == NULL)
+		return -1;
+
+	control_queue = queue_create();
+	punt_queue = queue_create();
+	punt_event = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+	DIE(punt_event < 0, "eventfd");
+
+	DIE(pthread_create(&fastpath_thread, NULL, fastpath_loop, NULL) != 0,
+	    "pthread_create");
+	return 0;
+}
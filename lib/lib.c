@@ -1,3 +1,5 @@
+#define _GNU_SOURCE
+
 #include "lib.h"
 
 #include <sys/ioctl.h>
@@ -16,9 +18,170 @@
 #include <sys/socket.h>
 #include <netinet/in.h>
 #include <arpa/inet.h>
+#include <sys/epoll.h>
+#include <sys/mman.h>
+#include <errno.h>
+#include <pthread.h>
+#include <sys/uio.h>
+#include <linux/filter.h>
+
+
+/* Per-port state, sized from the argc passed to init */
+int *interfaces;
+int num_interfaces;
+static char (*interface_names)[IFNAMSIZ];
+
+static int epoll_fd;
+static struct epoll_event *epoll_events;
+/* Ports reported readable by epoll and not served yet */
+static uint8_t *port_ready;
+static int ports_ready;
+/* Next port to look at, ready ports are served round-robin */
+static int port_next;
+
+/*
+ * BPDU-only socket of every interface, see open_control_sockets. They are in
+ * epoll_fd too (event data num_interfaces + i) and in control_epoll_fd, which
+ * only holds them.
+ */
+static int *control_socks;
+static uint8_t *control_ready;
+static int controls_ready;
+static int control_next;
+static int control_epoll_fd = -1;
+
+/* Memory mapped TPACKET_V3 receive ring of one interface */
+struct rx_ring {
+	uint8_t *map;
+	size_t size;
+	unsigned int block_size;
+	unsigned int block_nr;
+	unsigned int cur_block;
+	/* Frames of the current block not yet handed to the caller */
+	unsigned int pkts_left;
+	struct tpacket3_hdr *next_pkt;
+	int held;
+};
+
+/* Memory mapped TPACKET_V3 transmit ring of one interface */
+struct tx_ring {
+	uint8_t *map;
+	unsigned int frame_size;
+	unsigned int frame_nr;
+	unsigned int frames_per_block;
+	unsigned int block_size;
+	unsigned int cur_frame;
+	/* Frames were queued since the last kick */
+	int pending;
+};
+
+static struct rx_ring *rx_rings;
+static int rx_ring_last;
+static struct tx_ring *tx_rings;
+static size_t *tx_ring_size;
+/* Base of the single mapping holding the RX ring followed by the TX ring */
+static uint8_t **ring_maps;
+
+/* send_to_link may be called from several Python threads */
+static pthread_mutex_t tx_ring_lock = PTHREAD_MUTEX_INITIALIZER;
+
+static int tx_ring_enqueue(int intidx, const struct iovec *iov, int iovcnt);
+
+uint64_t *port_stats;
+
+/* Packet type (PACKET_HOST, PACKET_BROADCAST, ...) of the last received frame */
+static int last_pkttype;
+
+/*
+ * A packet socket bound with ETH_P_ALL also gets a PACKET_OUTGOING copy of
+ * every frame sent on the interface by any other socket, e.g. the socket of
+ * another worker. Drop those in the kernel: with PACKET_IGNORE_OUTGOING where
+ * available, otherwise with a classic BPF filter on the packet type.
+ */
+static void ignore_outgoing(int s)
+{
+	int res, one = 1;
+	struct sock_filter code[] = {
+		{ BPF_LD | BPF_W | BPF_ABS, 0, 0, SKF_AD_OFF + SKF_AD_PKTTYPE },
+		{ BPF_JMP | BPF_JEQ | BPF_K, 0, 1, PACKET_OUTGOING },
+		{ BPF_RET | BPF_K, 0, 0, 0 },
+		{ BPF_RET | BPF_K, 0, 0, 0xffffffff },
+	};
+	struct sock_fprog prog = {
+		.len = sizeof(code) / sizeof(code[0]),
+		.filter = code,
+	};
+
+#ifdef PACKET_IGNORE_OUTGOING
+	res = setsockopt(s, SOL_PACKET, PACKET_IGNORE_OUTGOING, &one, sizeof(one));
+	if (res == 0)
+		return;
+#endif
+	res = setsockopt(s, SOL_SOCKET, SO_ATTACH_FILTER, &prog, sizeof(prog));
+	DIE(res == -1, "setsockopt SO_ATTACH_FILTER");
+}
 
+static void attach_bpdu_filter(int s, int bpdus_only)
+{
+	int res;
+	/* Keeps dropping PACKET_OUTGOING, see ignore_outgoing */
+	struct sock_filter code[] = {
+		{ BPF_LD | BPF_W | BPF_ABS, 0, 0, SKF_AD_OFF + SKF_AD_PKTTYPE },
+		{ BPF_JMP | BPF_JEQ | BPF_K, 6, 0, PACKET_OUTGOING },
+		/* Destination 01:80:c2:00:00:00 */
+		{ BPF_LD | BPF_W | BPF_ABS, 0, 0, 0 },
+		{ BPF_JMP | BPF_JEQ | BPF_K, 0, 3, 0x0180c200 },
+		{ BPF_LD | BPF_H | BPF_ABS, 0, 0, 4 },
+		{ BPF_JMP | BPF_JEQ | BPF_K, 0, 1, 0x0000 },
+		/* BPDU */
+		{ BPF_RET | BPF_K, 0, 0, bpdus_only ? 0xffffffff : 0 },
+		/* Any other frame */
+		{ BPF_RET | BPF_K, 0, 0, bpdus_only ? 0 : 0xffffffff },
+		{ BPF_RET | BPF_K, 0, 0, 0 },
+	};
+	struct sock_fprog prog = {
+		.len = sizeof(code) / sizeof(code[0]),
+		.filter = code,
+	};
+
+	res = setsockopt(s, SOL_SOCKET, SO_ATTACH_FILTER, &prog, sizeof(prog));
+	DIE(res == -1, "setsockopt SO_ATTACH_FILTER");
+}
+
+int set_bpdu_filter(int bpdus_only)
+{
+	for (int i = 0; i < num_interfaces; i++)
+		attach_bpdu_filter(interfaces[i], bpdus_only);
+
+	return 0;
+}
+
+int join_fanout(int *groups, int mode)
+{
+	int res, id, tries;
+
+	/* Group members must be bound to the same device: one group per port */
+	for (int i = 0; i < num_interfaces; i++) {
+		id = groups[i] & 0xffff;
+		/*
+		 * EINVAL: the id is taken by a group on another device (e.g. the
+		 * ports of another switch) or with another mode, try the next one
+		 */
+		for (tries = 0; tries <= 0xffff; tries++) {
+			int arg = id | (mode << 16);
+
+			res = setsockopt(interfaces[i], SOL_PACKET, PACKET_FANOUT,
+					 &arg, sizeof(arg));
+			if (res == 0 || errno != EINVAL)
+				break;
+			id = (id + 1) & 0xffff;
+		}
+		DIE(res == -1, "setsockopt PACKET_FANOUT");
+		groups[i] = id;
+	}
 
-int interfaces[SWITCH_NUM_INTERFACES];
+	return 0;
+}
 
 int get_sock(const char *if_name)
 {
@@ -38,9 +201,62 @@ int get_sock(const char *if_name)
 
 	res = bind(s, (struct sockaddr *)&addr , sizeof(addr));
 	DIE(res == -1, "bind");
+
+	ignore_outgoing(s);
 	return s;
 }
 
+int open_control_sockets(void)
+{
+	char frame[MAX_PACKET_LEN];
+
+	control_socks = calloc(num_interfaces, sizeof(*control_socks));
+	control_ready = calloc(num_interfaces, sizeof(*control_ready));
+	DIE(!control_socks || !control_ready, "calloc");
+	control_epoll_fd = epoll_create1(0);
+	DIE(control_epoll_fd == -1, "epoll_create1");
+
+	for (int i = 0; i < num_interfaces; i++) {
+		struct epoll_event ev = { .events = EPOLLIN, .data.u32 = num_interfaces + i };
+
+		control_socks[i] = get_sock(interface_names[i]);
+		attach_bpdu_filter(control_socks[i], 1);
+		/* Frames queued before the filter was attached are also on the data socket */
+		while (recv(control_socks[i], frame, sizeof(frame), MSG_DONTWAIT) >= 0)
+			;
+		attach_bpdu_filter(interfaces[i], 0);
+
+		DIE(epoll_ctl(epoll_fd, EPOLL_CTL_ADD, control_socks[i], &ev) == -1,
+		    "epoll_ctl");
+		DIE(epoll_ctl(control_epoll_fd, EPOLL_CTL_ADD, control_socks[i], &ev) == -1,
+		    "epoll_ctl");
+	}
+
+	return 0;
+}
+
+int get_control_fd(void)
+{
+	return control_epoll_fd;
+}
+
+void set_port_stats(uint64_t *counters)
+{
+	port_stats = counters;
+}
+
+static void count_tx(int intidx, size_t len)
+{
+	port_stats_add(intidx, STATS_TX_FRAMES, 1);
+	port_stats_add(intidx, STATS_TX_BYTES, len);
+}
+
+static void count_rx(int intidx, size_t len)
+{
+	port_stats_add(intidx, STATS_RX_FRAMES, 1);
+	port_stats_add(intidx, STATS_RX_BYTES, len);
+}
+
 int send_to_link(int intidx, char *frame_data, size_t len)
 {
 	/*
@@ -48,15 +264,60 @@ int send_to_link(int intidx, char *frame_data, size_t len)
 	 * interface, eg 1500 bytes 
 	 */
 	int ret;
+	if (tx_rings[intidx].map != NULL) {
+		struct iovec iov = { .iov_base = frame_data, .iov_len = len };
+
+		pthread_mutex_lock(&tx_ring_lock);
+		ret = tx_ring_enqueue(intidx, &iov, 1);
+		pthread_mutex_unlock(&tx_ring_lock);
+		if (ret >= 0)
+			count_tx(intidx, len);
+		return ret;
+	}
+
 	ret = write(interfaces[intidx], frame_data, len);
 	DIE(ret == -1, "write");
+	count_tx(intidx, ret);
+	return ret;
+}
+
+int send_to_link_iov(int intidx, char *header, size_t header_len,
+		     char *tag, size_t tag_len, char *payload, size_t payload_len)
+{
+	struct iovec iov[3] = {
+		{ .iov_base = header, .iov_len = header_len },
+		{ .iov_base = tag, .iov_len = tag_len },
+		{ .iov_base = payload, .iov_len = payload_len },
+	};
+	int ret;
+
+	if (tx_rings[intidx].map != NULL) {
+		pthread_mutex_lock(&tx_ring_lock);
+		ret = tx_ring_enqueue(intidx, iov, 3);
+		pthread_mutex_unlock(&tx_ring_lock);
+		if (ret >= 0)
+			count_tx(intidx, header_len + tag_len + payload_len);
+		return ret;
+	}
+
+	ret = writev(interfaces[intidx], iov, 3);
+	DIE(ret == -1, "writev");
+	count_tx(intidx, ret);
 	return ret;
 }
 
 ssize_t receive_from_link(int intidx, char *frame_data)
 {
 	ssize_t ret;
-  ret = read(interfaces[intidx], frame_data, MAX_PACKET_LEN);
+	struct sockaddr_ll addr;
+	socklen_t addr_len = sizeof(addr);
+
+	ret = recvfrom(interfaces[intidx], frame_data, MAX_PACKET_LEN, 0,
+		       (struct sockaddr *)&addr, &addr_len);
+	if (ret >= 0) {
+		last_pkttype = addr.sll_pkttype;
+		count_rx(intidx, ret);
+	}
 	return ret;
 }
 
@@ -72,33 +333,502 @@ int socket_receive_message(int sockfd, char *frame_data, size_t *len)
 	return 0;
 }
 
-int recv_from_any_link(char *frame_data, size_t *length) {
+static void mark_ready(int count)
+{
+	for (int k = 0; k < count; k++) {
+		int i = epoll_events[k].data.u32;
+
+		if (i >= num_interfaces) {
+			i -= num_interfaces;
+			if (!control_ready[i]) {
+				control_ready[i] = 1;
+				controls_ready++;
+			}
+		} else if (!port_ready[i]) {
+			port_ready[i] = 1;
+			ports_ready++;
+		}
+	}
+}
+
+static void wait_for_ports(void)
+{
 	int res;
-	fd_set set;
 
-	FD_ZERO(&set);
-	while (1) {
-		for (int i = 0; i < SWITCH_NUM_INTERFACES; i++) {
-			FD_SET(interfaces[i], &set);
+	do {
+		res = epoll_wait(epoll_fd, epoll_events, 2 * num_interfaces, -1);
+	} while (res == -1 && errno == EINTR);
+	DIE(res == -1, "epoll_wait");
+
+	mark_ready(res);
+}
+
+/* Receives one BPDU from a ready control socket, -1 if none is queued */
+static int control_recv_one(char *frame_data, size_t size, size_t *length)
+{
+	for (int k = 0; k < num_interfaces && controls_ready > 0; k++) {
+		int i = (control_next + k) % num_interfaces;
+		ssize_t ret;
+
+		if (!control_ready[i])
+			continue;
+		ret = recv(control_socks[i], frame_data, size, MSG_DONTWAIT);
+		if (ret < 0) {
+			control_ready[i] = 0;
+			controls_ready--;
+			continue;
 		}
+		control_next = (i + 1) % num_interfaces;
+		count_rx(i, ret);
+		*length = ret;
+		return i;
+	}
 
-		res = select(interfaces[SWITCH_NUM_INTERFACES - 1] + 1, &set, NULL, NULL, NULL);
-		DIE(res == -1, "select");
+	return -1;
+}
 
-		for (int i = 0; i < SWITCH_NUM_INTERFACES; i++) {
-			if (FD_ISSET(interfaces[i], &set)) {
-				ssize_t ret = receive_from_link(i, frame_data);
-        if (ret < 0)
-          continue;
-				*length = ret;
+int recv_control(char *frame_data, size_t *length)
+{
+	int res;
+
+	if (control_socks == NULL)
+		return -1;
+	/* Callers that do not go through wait_for_ports ask epoll themselves */
+	if (controls_ready == 0) {
+		res = epoll_wait(control_epoll_fd, epoll_events, 2 * num_interfaces, 0);
+		if (res > 0)
+			mark_ready(res);
+	}
+
+	return control_recv_one(frame_data, MAX_PACKET_LEN, length);
+}
+
+/*
+ * Returns the next readable port after the last one served, waiting for one
+ * if none is left. Level triggered epoll reports a port again as long as it
+ * still has frames queued, so every port gets one turn per round. Returns -1
+ * when only control sockets are ready, they go first.
+ */
+static int next_ready_port(void)
+{
+	while (ports_ready == 0 && controls_ready == 0)
+		wait_for_ports();
+	if (ports_ready == 0)
+		return -1;
+
+	for (int k = 0; k < num_interfaces; k++) {
+		int i = (port_next + k) % num_interfaces;
+
+		if (port_ready[i]) {
+			port_ready[i] = 0;
+			ports_ready--;
+			port_next = (i + 1) % num_interfaces;
+			return i;
+		}
+	}
+
+	return -1;
+}
+
+int recv_from_any_link(char *frame_data, size_t *length) {
+	while (1) {
+		int i;
+		ssize_t ret;
+
+		/* BPDUs never wait behind the data frames of a busy port */
+		if (controls_ready > 0) {
+			i = control_recv_one(frame_data, MAX_PACKET_LEN, length);
+			if (i >= 0) {
+				last_pkttype = PACKET_MULTICAST;
 				return i;
 			}
 		}
+
+		i = next_ready_port();
+		if (i < 0)
+			continue;
+		ret = receive_from_link(i, frame_data);
+		if (ret < 0)
+			continue;
+		*length = ret;
+		return i;
 	}
 
 	return -1;
 }
 
+int get_last_packet_type(void)
+{
+	return last_pkttype;
+}
+
+int recv_from_any_link_batch(char *frames, size_t frame_len, int max_frames,
+			      int *ifaces, size_t *offsets, size_t *lengths,
+			      int *pkttypes)
+{
+	struct mmsghdr msgs[MAX_BATCH_FRAMES];
+	struct iovec iovs[MAX_BATCH_FRAMES];
+	struct sockaddr_ll addrs[MAX_BATCH_FRAMES];
+	int res, count = 0;
+
+	if (max_frames > MAX_BATCH_FRAMES)
+		max_frames = MAX_BATCH_FRAMES;
+
+	for (int i = 0; i < max_frames; i++) {
+		iovs[i].iov_base = frames + i * frame_len;
+		iovs[i].iov_len = frame_len;
+		memset(&msgs[i].msg_hdr, 0, sizeof(msgs[i].msg_hdr));
+		msgs[i].msg_hdr.msg_iov = &iovs[i];
+		msgs[i].msg_hdr.msg_iovlen = 1;
+		msgs[i].msg_hdr.msg_name = &addrs[i];
+		msgs[i].msg_hdr.msg_namelen = sizeof(addrs[i]);
+	}
+
+	/* Block for the first frame only, then drain the ports that are already ready */
+	while (count < max_frames && (count == 0 || ports_ready > 0 || controls_ready > 0)) {
+		int i;
+
+		/* BPDUs go first in the batch */
+		if (controls_ready > 0) {
+			i = control_recv_one(frames + count * frame_len, frame_len, &lengths[count]);
+			if (i >= 0) {
+				ifaces[count] = i;
+				offsets[count] = count * frame_len;
+				if (pkttypes)
+					pkttypes[count] = PACKET_MULTICAST;
+				count++;
+			}
+			continue;
+		}
+
+		i = next_ready_port();
+		if (i < 0)
+			continue;
+		res = recvmmsg(interfaces[i], msgs + count, max_frames - count,
+			       MSG_DONTWAIT, NULL);
+		if (res <= 0)
+			continue;
+
+		for (int j = count; j < count + res; j++) {
+			ifaces[j] = i;
+			offsets[j] = j * frame_len;
+			lengths[j] = msgs[j].msg_len;
+			count_rx(i, msgs[j].msg_len);
+			if (pkttypes)
+				pkttypes[j] = addrs[j].sll_pkttype;
+		}
+		count += res;
+	}
+
+	return count;
+}
+
+int recv_from_link_batch(int intidx, char *frames, size_t frame_len, int max_frames,
+			 size_t *offsets, size_t *lengths, int *pkttypes)
+{
+	struct mmsghdr msgs[MAX_BATCH_FRAMES];
+	struct iovec iovs[MAX_BATCH_FRAMES];
+	struct sockaddr_ll addrs[MAX_BATCH_FRAMES];
+	int res;
+
+	if (max_frames > MAX_BATCH_FRAMES)
+		max_frames = MAX_BATCH_FRAMES;
+
+	for (int i = 0; i < max_frames; i++) {
+		iovs[i].iov_base = frames + i * frame_len;
+		iovs[i].iov_len = frame_len;
+		memset(&msgs[i].msg_hdr, 0, sizeof(msgs[i].msg_hdr));
+		msgs[i].msg_hdr.msg_iov = &iovs[i];
+		msgs[i].msg_hdr.msg_iovlen = 1;
+		msgs[i].msg_hdr.msg_name = &addrs[i];
+		msgs[i].msg_hdr.msg_namelen = sizeof(addrs[i]);
+	}
+
+	res = recvmmsg(interfaces[intidx], msgs, max_frames, MSG_DONTWAIT, NULL);
+	if (res < 0)
+		return (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) ? 0 : -1;
+
+	for (int j = 0; j < res; j++) {
+		offsets[j] = j * frame_len;
+		lengths[j] = msgs[j].msg_len;
+		count_rx(intidx, msgs[j].msg_len);
+		if (pkttypes)
+			pkttypes[j] = addrs[j].sll_pkttype;
+	}
+
+	return res;
+}
+
+int get_interface_fd(int intidx)
+{
+	return interfaces[intidx];
+}
+
+/*
+ * The kernel maps the RX ring and the TX ring of a socket in one region, RX
+ * first, and refuses to change a ring while it is mapped. Drop the previous
+ * mapping and map both rings again after one of them is set up.
+ */
+static void map_rings(int intidx)
+{
+	struct rx_ring *rx = &rx_rings[intidx];
+	struct tx_ring *tx = &tx_rings[intidx];
+	size_t size = rx->size + tx_ring_size[intidx];
+	uint8_t *map;
+
+	map = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED,
+		   interfaces[intidx], 0);
+	DIE(map == MAP_FAILED, "mmap packet rings");
+
+	ring_maps[intidx] = map;
+	rx->map = rx->size ? map : NULL;
+	tx->map = tx_ring_size[intidx] ? map + rx->size : NULL;
+}
+
+static void unmap_rings(int intidx)
+{
+	size_t size = rx_rings[intidx].size + tx_ring_size[intidx];
+
+	if (ring_maps[intidx] == NULL)
+		return;
+	munmap(ring_maps[intidx], size);
+	ring_maps[intidx] = NULL;
+}
+
+static void set_tpacket_version(int intidx)
+{
+	int res, version = TPACKET_V3;
+
+	/* The version is fixed once the first ring of the socket exists */
+	if (rx_rings[intidx].size || tx_ring_size[intidx])
+		return;
+	res = setsockopt(interfaces[intidx], SOL_PACKET, PACKET_VERSION,
+			 &version, sizeof(version));
+	DIE(res == -1, "setsockopt PACKET_VERSION");
+}
+
+int init_rx_ring(unsigned int block_size, unsigned int block_nr,
+		 unsigned int frame_size, unsigned int block_timeout)
+{
+	int res;
+	struct tpacket_req3 req;
+
+	memset(&req, 0, sizeof(req));
+	req.tp_block_size = block_size;
+	req.tp_block_nr = block_nr;
+	req.tp_frame_size = frame_size;
+	req.tp_frame_nr = (block_size / frame_size) * block_nr;
+	req.tp_retire_blk_tov = block_timeout;
+
+	for (int i = 0; i < num_interfaces; i++) {
+		struct rx_ring *ring = &rx_rings[i];
+
+		unmap_rings(i);
+		set_tpacket_version(i);
+		res = setsockopt(interfaces[i], SOL_PACKET, PACKET_RX_RING,
+				 &req, sizeof(req));
+		DIE(res == -1, "setsockopt PACKET_RX_RING");
+
+		ring->size = (size_t)block_size * block_nr;
+		map_rings(i);
+		ring->block_size = block_size;
+		ring->block_nr = block_nr;
+		ring->cur_block = 0;
+		ring->pkts_left = 0;
+		ring->held = 0;
+	}
+
+	return 0;
+}
+
+void *get_rx_ring(int intidx, size_t *size)
+{
+	*size = rx_rings[intidx].size;
+	return rx_rings[intidx].map;
+}
+
+static struct tpacket_block_desc *rx_ring_block(struct rx_ring *ring)
+{
+	return (struct tpacket_block_desc *)(ring->map +
+					     (size_t)ring->cur_block * ring->block_size);
+}
+
+static int rx_ring_ready(struct rx_ring *ring)
+{
+	if (ring->held)
+		return ring->pkts_left > 0;
+	return rx_ring_block(ring)->hdr.bh1.block_status & TP_STATUS_USER;
+}
+
+int rx_ring_recv(int *intidx, size_t *offsets, size_t *lengths, int *pkttypes,
+		 int max_frames)
+{
+	struct rx_ring *ring = NULL;
+	int i, count = 0;
+
+	while (ring == NULL) {
+		/* Pending BPDUs first: nothing from the rings, see recv_control */
+		if (controls_ready > 0) {
+			*intidx = rx_ring_last;
+			return 0;
+		}
+		/* Start after the last served port so that low ports do not starve high ones */
+		for (int k = 1; k <= num_interfaces; k++) {
+			i = (rx_ring_last + k) % num_interfaces;
+			if (rx_ring_ready(&rx_rings[i])) {
+				ring = &rx_rings[i];
+				break;
+			}
+		}
+		if (ring != NULL)
+			break;
+
+		/* The ring state is read directly, epoll is only used to sleep */
+		wait_for_ports();
+	}
+	rx_ring_last = i;
+
+	if (!ring->held) {
+		struct tpacket_block_desc *block = rx_ring_block(ring);
+
+		ring->held = 1;
+		ring->pkts_left = block->hdr.bh1.num_pkts;
+		ring->next_pkt = (struct tpacket3_hdr *)((uint8_t *)block +
+							 block->hdr.bh1.offset_to_first_pkt);
+	}
+
+	while (ring->pkts_left > 0 && count < max_frames) {
+		struct tpacket3_hdr *pkt = ring->next_pkt;
+
+		offsets[count] = (uint8_t *)pkt + pkt->tp_mac - ring->map;
+		lengths[count] = pkt->tp_snaplen;
+		count_rx(i, pkt->tp_snaplen);
+		if (pkttypes) {
+			/* The link layer address follows the aligned frame header */
+			struct sockaddr_ll *addr = (struct sockaddr_ll *)((uint8_t *)pkt +
+				TPACKET_ALIGN(sizeof(struct tpacket3_hdr)));
+			pkttypes[count] = addr->sll_pkttype;
+		}
+		count++;
+
+		ring->pkts_left--;
+		ring->next_pkt = (struct tpacket3_hdr *)((uint8_t *)pkt + pkt->tp_next_offset);
+	}
+
+	*intidx = i;
+	return count;
+}
+
+void rx_ring_release(int intidx)
+{
+	struct rx_ring *ring = &rx_rings[intidx];
+
+	/* The block goes back to the kernel only once all its frames were consumed */
+	if (!ring->held || ring->pkts_left > 0)
+		return;
+
+	__sync_synchronize();
+	rx_ring_block(ring)->hdr.bh1.block_status = TP_STATUS_KERNEL;
+	ring->held = 0;
+	ring->cur_block = (ring->cur_block + 1) % ring->block_nr;
+}
+
+int init_tx_ring(unsigned int block_size, unsigned int block_nr,
+		 unsigned int frame_size)
+{
+	int res;
+	struct tpacket_req3 req;
+
+	memset(&req, 0, sizeof(req));
+	req.tp_block_size = block_size;
+	req.tp_block_nr = block_nr;
+	req.tp_frame_size = frame_size;
+	req.tp_frame_nr = (block_size / frame_size) * block_nr;
+
+	for (int i = 0; i < num_interfaces; i++) {
+		struct tx_ring *ring = &tx_rings[i];
+
+		unmap_rings(i);
+		set_tpacket_version(i);
+		res = setsockopt(interfaces[i], SOL_PACKET, PACKET_TX_RING,
+				 &req, sizeof(req));
+		DIE(res == -1, "setsockopt PACKET_TX_RING");
+
+		tx_ring_size[i] = (size_t)block_size * block_nr;
+		ring->frame_size = frame_size;
+		ring->frame_nr = req.tp_frame_nr;
+		ring->frames_per_block = block_size / frame_size;
+		ring->block_size = block_size;
+		ring->cur_frame = 0;
+		ring->pending = 0;
+		map_rings(i);
+	}
+
+	return 0;
+}
+
+static struct tpacket3_hdr *tx_ring_frame(struct tx_ring *ring)
+{
+	unsigned int block = ring->cur_frame / ring->frames_per_block;
+	unsigned int frame = ring->cur_frame % ring->frames_per_block;
+
+	return (struct tpacket3_hdr *)(ring->map + (size_t)block * ring->block_size +
+				       (size_t)frame * ring->frame_size);
+}
+
+static int tx_ring_enqueue(int intidx, const struct iovec *iov, int iovcnt)
+{
+	struct tx_ring *ring = &tx_rings[intidx];
+	struct tpacket3_hdr *hdr = tx_ring_frame(ring);
+	/* Without PACKET_TX_HAS_OFF the kernel expects the data right after the header */
+	size_t data_off = TPACKET3_HDRLEN - sizeof(struct sockaddr_ll);
+	size_t len = 0;
+	int res;
+
+	for (int k = 0; k < iovcnt; k++)
+		len += iov[k].iov_len;
+
+	DIE(len + data_off > ring->frame_size, "frame too large for the TX ring");
+
+	/* Ring full: push the queued frames out and wait for the slot to free up */
+	while (hdr->tp_status != TP_STATUS_AVAILABLE) {
+		DIE(hdr->tp_status == TP_STATUS_WRONG_FORMAT, "TX ring frame format");
+		res = sendto(interfaces[intidx], NULL, 0, 0, NULL, 0);
+		DIE(res == -1, "sendto TX ring");
+	}
+
+	/* The pieces are gathered straight into the slot */
+	for (int k = 0, off = data_off; k < iovcnt; off += iov[k].iov_len, k++)
+		memcpy((uint8_t *)hdr + off, iov[k].iov_base, iov[k].iov_len);
+	hdr->tp_len = len;
+	hdr->tp_snaplen = len;
+	hdr->tp_next_offset = 0;
+	__sync_synchronize();
+	hdr->tp_status = TP_STATUS_SEND_REQUEST;
+
+	ring->cur_frame = (ring->cur_frame + 1) % ring->frame_nr;
+	ring->pending = 1;
+	return len;
+}
+
+int tx_ring_flush(void)
+{
+	int res, kicked = 0;
+
+	pthread_mutex_lock(&tx_ring_lock);
+	for (int i = 0; i < num_interfaces; i++) {
+		if (!tx_rings[i].pending)
+			continue;
+		res = sendto(interfaces[i], NULL, 0, MSG_DONTWAIT, NULL, 0);
+		DIE(res == -1 && errno != EAGAIN, "sendto TX ring");
+		tx_rings[i].pending = 0;
+		kicked++;
+	}
+	pthread_mutex_unlock(&tx_ring_lock);
+
+	return kicked;
+}
+
 char *get_interface_ip(int interface)
 {
 	struct ifreq ifr;
@@ -115,31 +845,14 @@ char *get_interface_ip(int interface)
 
 char *get_interface_name(int interface)
 {
-	struct ifreq ifr;
-	int ret;
-	if (interface == 0)
-		sprintf(ifr.ifr_name, "rr-0-1");
-	else {
-		sprintf(ifr.ifr_name, "r-%u", interface - 1);
-	}
-
-  ifr.ifr_ifindex = interface + 2;
-	ret = ioctl(interfaces[interface], SIOCGIFNAME, &ifr);
-	DIE(ret == -1, "ioctl SIOCGIFNAME");
-  char *int_name = malloc(256);
-  strncpy(int_name, ifr.ifr_name, 256);
-  return int_name;
+	return interface_names[interface];
 }
 
 void get_interface_mac(int interface, uint8_t *mac)
 {
 	struct ifreq ifr;
 	int ret;
-	if (interface == 0)
-		sprintf(ifr.ifr_name, "rr-0-1");
-	else {
-		sprintf(ifr.ifr_name, "r-%u", interface - 1);
-	}
+	strncpy(ifr.ifr_name, interface_names[interface], IFNAMSIZ);
 	ret = ioctl(interfaces[interface], SIOCGIFHWADDR, &ifr);
 	DIE(ret == -1, "ioctl SIOCGIFHWADDR");
 	memcpy(mac, ifr.ifr_addr.sa_data, 6);
@@ -190,9 +903,30 @@ int hwaddr_aton(const char *txt, uint8_t *addr)
 
 int init(int argc, char *argv[])
 {
+	num_interfaces = argc;
+	interfaces = calloc(argc, sizeof(*interfaces));
+	interface_names = calloc(argc, sizeof(*interface_names));
+	/* Room for the control sockets too */
+	epoll_events = calloc(2 * argc, sizeof(*epoll_events));
+	port_ready = calloc(argc, sizeof(*port_ready));
+	rx_rings = calloc(argc, sizeof(*rx_rings));
+	tx_rings = calloc(argc, sizeof(*tx_rings));
+	tx_ring_size = calloc(argc, sizeof(*tx_ring_size));
+	ring_maps = calloc(argc, sizeof(*ring_maps));
+	DIE(!interfaces || !interface_names || !epoll_events || !port_ready ||
+	    !rx_rings || !tx_rings || !tx_ring_size || !ring_maps, "calloc");
+
+	epoll_fd = epoll_create1(0);
+	DIE(epoll_fd == -1, "epoll_create1");
+
   for (int i = 0; i < argc; ++i) {
+		struct epoll_event ev = { .events = EPOLLIN, .data.u32 = i };
+
 		printf("Setting up interface: %s\n", argv[i]);
 		interfaces[i] = get_sock(argv[i]);
+		strncpy(interface_names[i], argv[i], IFNAMSIZ - 1);
+		DIE(epoll_ctl(epoll_fd, EPOLL_CTL_ADD, interfaces[i], &ev) == -1,
+		    "epoll_ctl");
 	}
 
   return argc;
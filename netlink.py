@@ -0,0 +1,93 @@
+# Carrier changes of the switch interfaces, read from rtnetlink
+# (RTM_NEWLINK / RTM_DELLINK on the RTMGRP_LINK group). Linux only.
+import socket
+import struct
+
+RTMGRP_LINK = 1
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+IFLA_IFNAME = 3
+IFF_UP = 0x1
+IFF_LOWER_UP = 0x10000
+# Administratively up and with a carrier
+RUNNING = IFF_UP | IFF_LOWER_UP
+
+NLMSG_HEADER = struct.Struct('=IHHII')   # length, type, flags, seq, pid
+IFINFOMSG = struct.Struct('=BxHiII')     # family, type, index, flags, change
+RTATTR = struct.Struct('=HH')            # length, type
+
+def align(length):
+    return (length + 3) & ~3
+
+class LinkMonitor:
+    """Tells when the carrier of one of the named interfaces goes or comes back.
+
+    The socket is non-blocking; poll fileno() and call events() when it is
+    readable. All interfaces are assumed up at first, the initial state of
+    each is asked for right away and reported like any change.
+    """
+
+    def __init__(self, names):
+        self.ports = {name: i for i, name in enumerate(names)}
+        self.carrier = [True] * len(names)
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK,
+                                  socket.NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_LINK))
+        self.request_dump()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def request_dump(self):
+        request = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        header = NLMSG_HEADER.pack(NLMSG_HEADER.size + len(request), RTM_GETLINK,
+                                   NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+        self.sock.send(header + request)
+
+    def events(self):
+        """Returns (interface, up) for every carrier change since the last call."""
+        changes = []
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return changes
+            except OSError:
+                # ENOBUFS: the kernel dropped events, start over from a dump
+                self.request_dump()
+                continue
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                if length < NLMSG_HEADER.size:
+                    break
+                if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+                    self.link_message(data[offset + NLMSG_HEADER.size:offset + length],
+                                      msg_type, changes)
+                offset += align(length)
+
+    def link_message(self, message, msg_type, changes):
+        if len(message) < IFINFOMSG.size:
+            return
+        _, _, _, flags, _ = IFINFOMSG.unpack_from(message)
+        name = None
+        offset = IFINFOMSG.size
+        while offset + RTATTR.size <= len(message):
+            length, attr_type = RTATTR.unpack_from(message, offset)
+            if length < RTATTR.size:
+                break
+            if attr_type == IFLA_IFNAME:
+                name = message[offset + RTATTR.size:offset + length].split(b'\0')[0].decode()
+                break
+            offset += align(length)
+
+        interface = self.ports.get(name)
+        if interface is None:
+            return
+        up = msg_type == RTM_NEWLINK and (flags & RUNNING) == RUNNING
+        if up != self.carrier[interface]:
+            self.carrier[interface] = up
+            changes.append((interface, up))
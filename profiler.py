@@ -0,0 +1,132 @@
+import os
+import signal
+import sys
+import threading
+from time import perf_counter_ns
+
+# Each power of two is split in 4 buckets, so percentiles are within ~20%
+SUB_BUCKETS = 4
+NUM_BUCKETS = 65 * SUB_BUCKETS
+
+def bucket_of(ns):
+    bits = ns.bit_length()
+    if bits <= 3:
+        return ns
+    return (bits << 2) | ((ns >> (bits - 3)) & 3)
+
+def bucket_limit(index):
+    # Largest value that falls in the bucket
+    if index < 8:
+        return index
+    bits = index >> 2
+    return ((4 | (index & 3)) + 1 << (bits - 3)) - 1
+
+class Histogram:
+    """Latency histogram in nanoseconds with logarithmic buckets."""
+
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ns):
+        self.buckets[bucket_of(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, fraction):
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min(bucket_limit(index), self.max)
+        return self.max
+
+def timed(func, histogram):
+    add = histogram.add
+
+    def timed_func(*args):
+        start = perf_counter_ns()
+        result = func(*args)
+        add(perf_counter_ns() - start)
+        return result
+
+    return timed_func
+
+class StageProfiler:
+    """Times hot-path stages by swapping timed wrappers in for their functions.
+
+    stages maps a stage name to the (owner, attribute) pairs that make it up;
+    owner is a module or an object. While disabled the original functions are
+    in place, so profiling costs nothing. Stages nest: a stage that calls
+    another includes its time.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.histograms = {}
+        self.saved = []
+        self.enabled = False
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.histograms = {stage: Histogram() for stage in self.stages}
+        for stage, targets in self.stages.items():
+            for owner, name in targets:
+                if not hasattr(owner, name):
+                    continue
+                had_own = name in vars(owner)
+                self.saved.append((owner, name, getattr(owner, name), had_own))
+                setattr(owner, name, timed(getattr(owner, name), self.histograms[stage]))
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        for owner, name, func, had_own in reversed(self.saved):
+            if had_own:
+                setattr(owner, name, func)
+            else:
+                # A bound method wrapped on an instance, the class has it
+                delattr(owner, name)
+        self.saved = []
+        self.enabled = False
+
+    def report(self):
+        lines = [f'profile of pid {os.getpid()} (ns)',
+                 f'{"stage":<10} {"count":>10} {"mean":>9} {"p50":>9} {"p90":>9} {"p99":>9} {"max":>10}']
+        for stage, h in self.histograms.items():
+            if not h.count:
+                continue
+            lines.append(f'{stage:<10} {h.count:>10} {h.total // h.count:>9} '
+                         f'{h.percentile(0.5):>9} {h.percentile(0.9):>9} '
+                         f'{h.percentile(0.99):>9} {h.max:>10}')
+        return '\n'.join(lines)
+
+    def install_signals(self, start=signal.SIGUSR1, stop=signal.SIGUSR2):
+        """start enables profiling; stop disables it and prints the report.
+
+        Python runs signal handlers in the main thread only between bytecodes,
+        never while it blocks in a receive call of dlink.so. The signals are
+        blocked instead (threads started later inherit that) and taken by a
+        thread of their own. Call before starting any other thread.
+        """
+        signal.pthread_sigmask(signal.SIG_BLOCK, {start, stop})
+        threading.Thread(target=self.wait_signals, args=(start, stop), daemon=True).start()
+
+    def wait_signals(self, start, stop):
+        while True:
+            if signal.sigwait({start, stop}) == start:
+                self.enable()
+            else:
+                self.stop()
+
+    def stop(self):
+        if self.enabled:
+            self.disable()
+            print(self.report(), file=sys.stderr, flush=True)
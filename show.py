@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+# Inspects a running switch without stopping it.
+#
+#   python3 show.py mac table /dev/shm/switch0.fdb [vlan]
+#   python3 show.py stats /dev/shm/switch0.stats
+#
+# The switch must run with SWITCH_FDB_FILE / SWITCH_STATS_FILE set to the
+# same file. The table is mapped read-only and never locked, so the
+# forwarding loop is not disturbed.
+import json
+import sys
+
+from fdb import FDB, int_to_mac
+from stats import COUNTER_NAMES
+
+def show_mac_table(path, vlan=None):
+    table = FDB.attach(path)
+    entries = sorted(table.entries())
+    print(f'{"VLAN":>4}  {"MAC":<17}  {"Port":>4}  {"Age":>4}')
+    shown = 0
+    for entry_vlan, mac, port, age in entries:
+        if vlan is not None and entry_vlan != vlan:
+            continue
+        print(f'{entry_vlan:>4}  {int_to_mac(mac):<17}  {port:>4}  {age:>4}')
+        shown += 1
+    print(f'{shown} entries (capacity {table.capacity}, aging {table.aging_time}s)')
+
+def show_stats(path):
+    with open(path) as f:
+        snapshot = json.load(f)
+    rows = list(snapshot['ports'].items()) + [('total', snapshot['totals'])]
+    width = max(len(name) for name, _ in rows)
+    print(f'{"port":<{width}}  {"state":<12}' + ''.join(f'  {c:>12}' for c in COUNTER_NAMES))
+    for name, counters in rows:
+        print(f'{name:<{width}}  {counters.get("state", ""):<12}'
+              + ''.join(f'  {counters[c]:>12}' for c in COUNTER_NAMES))
+
+def usage():
+    print('usage: show.py mac table FDB_FILE [VLAN]', file=sys.stderr)
+    print('       show.py stats STATS_FILE', file=sys.stderr)
+    sys.exit(2)
+
+def main():
+    args = sys.argv[1:]
+    if args[:2] == ['mac', 'table'] and len(args) in (3, 4):
+        vlan = int(args[3]) if len(args) == 4 else None
+        show_mac_table(args[2], vlan)
+    elif args[:1] == ['stats'] and len(args) == 2:
+        show_stats(args[1])
+    else:
+        usage()
+
+if __name__ == "__main__":
+    main()
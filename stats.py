@@ -0,0 +1,63 @@
+import json
+import mmap
+import os
+import time
+
+# Per-port counters, same order as the STATS_* enum in include/lib.h
+COUNTER_NAMES = ('rx_frames', 'rx_bytes', 'tx_frames', 'tx_bytes',
+                 'unicast', 'flood', 'broadcast', 'multicast', 'bpdu',
+                 'drop_blocked', 'drop_vlan', 'drop_storm', 'link_down')
+(RX_FRAMES, RX_BYTES, TX_FRAMES, TX_BYTES, UNICAST, FLOOD, BROADCAST,
+ MULTICAST, BPDU, DROP_BLOCKED, DROP_VLAN, DROP_STORM, LINK_DOWN) = range(len(COUNTER_NAMES))
+COUNTERS = len(COUNTER_NAMES)
+
+class Stats:
+    """Counters of every process of a switch, in shared memory.
+
+    Each process owns two blocks of COUNTERS words per port: one updated by
+    dlink.so (rx/tx and the fast path, with atomic adds since several threads
+    send) and one updated by Python, so that nobody increments a word another
+    thread is writing. Readers add all the blocks up.
+    """
+
+    def __init__(self, num_ports, processes=1):
+        self.num_ports = num_ports
+        self.block_len = num_ports * COUNTERS
+        self.blocks = 2 * processes
+        self.buffer = mmap.mmap(-1, self.blocks * self.block_len * 8)
+        self.view = memoryview(self.buffer).cast('Q')
+
+    def lib_block(self, process):
+        return self.view[2 * process * self.block_len:(2 * process + 1) * self.block_len]
+
+    def python_block(self, process):
+        return self.view[(2 * process + 1) * self.block_len:(2 * process + 2) * self.block_len]
+
+    def totals(self):
+        """Returns one list of COUNTERS values per port."""
+        words = self.view.tolist()
+        sums = [0] * self.block_len
+        for block in range(self.blocks):
+            base = block * self.block_len
+            for i in range(self.block_len):
+                sums[i] += words[base + i]
+        return [sums[p * COUNTERS:(p + 1) * COUNTERS] for p in range(self.num_ports)]
+
+    def snapshot(self, port_names, states=None):
+        # states: optional state of every port, e.g. 'up' or 'err-disabled'
+        ports = {}
+        totals = dict.fromkeys(COUNTER_NAMES, 0)
+        for i, (name, values) in enumerate(zip(port_names, self.totals())):
+            ports[name] = dict(zip(COUNTER_NAMES, values))
+            if states is not None:
+                ports[name]['state'] = states[i]
+            for counter, value in zip(COUNTER_NAMES, values):
+                totals[counter] += value
+        return {'time': time.time(), 'ports': ports, 'totals': totals}
+
+    def export(self, path, port_names, states=None):
+        """Rewrites the stats file; readers never see a partial file."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(port_names, states), f)
+        os.replace(tmp, path)
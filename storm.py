@@ -0,0 +1,52 @@
+# Storm control: rate limits on the frames each port may flood, per traffic
+# class, in packets and in bytes per second.
+import contextlib
+import time
+
+# Traffic classes, same order as in fastpath.h
+STORM_UNKNOWN, STORM_BROADCAST, STORM_MULTICAST = range(3)
+STORM_CLASSES = 3
+STORM_CLASS_NAMES = {'unknown-unicast': STORM_UNKNOWN, 'broadcast': STORM_BROADCAST,
+                     'multicast': STORM_MULTICAST}
+
+SECOND = 1000000000
+
+class StormControl:
+    """Rate limits of every (port, traffic class), the way storm_allow in
+    lib/fastpath.c applies them.
+
+    limits holds two numbers per port and class, ports first: packets and
+    bytes per second, 0 for no limit. buckets holds one word per limit, the
+    time in ns of time.monotonic_ns() at which the traffic let through so far
+    would have drained at the rate. A frame passes if that stays within a
+    second of now, so bursts up to the rate pass untouched and a zeroed word
+    is a full bucket. The processes that share buckets share the limit,
+    taken under lock. Frames of unlimited classes cost a single lookup.
+    """
+
+    def __init__(self, limits, buckets=None, lock=None, clock=time.monotonic_ns):
+        self.limits = limits
+        self.buckets = [0] * len(limits) if buckets is None else buckets
+        self.lock = contextlib.nullcontext() if lock is None else lock
+        self.clock = clock
+
+    def allow(self, port, traffic_class, length):
+        """Takes a frame of length bytes from the bucket, False if it is empty."""
+        i = (port * STORM_CLASSES + traffic_class) * 2
+        packet_rate = self.limits[i]
+        byte_rate = self.limits[i + 1]
+        if not packet_rate and not byte_rate:
+            return True
+
+        now = self.clock()
+        with self.lock:
+            packets = max(self.buckets[i], now) + SECOND // packet_rate if packet_rate else now
+            size = max(self.buckets[i + 1], now) + length * SECOND // byte_rate if byte_rate else now
+            if packets - now > SECOND or size - now > SECOND:
+                return False
+            if packet_rate:
+                self.buckets[i] = packets
+            if byte_rate:
+                self.buckets[i + 1] = size
+        return True
+
@@ -0,0 +1,368 @@
+# Rapid spanning tree (802.1w-style) of one bridge, for one instance.
+#
+# BPDUs go to 01:80:c2:00:00:00 on the non-edge ports and carry the instance
+# (a group of VLANs with a tree of its own, see switch.read_config), the
+# priority vector of the sending port, the 802.1w flags and the age of the
+# root information in hops (each bridge adds one, MAX_AGE drops it):
+#   6 bytes  2 bytes   8 bytes  4 bytes    8 bytes    2 bytes  1 byte
+#   dst mac  instance  root id  root cost  bridge id  port id  flags
+#   1 byte       1 byte
+#   message age  max age
+#
+# Every bridge sends a BPDU on its designated ports each hello time, and at
+# once when its information changes. A designated port that is not forwarding
+# proposes; the bridge at the other end puts its other designated ports in
+# sync (discarding, or already agreed downstream) and answers with an
+# agreement, so the port forwards after one round trip instead of after two
+# forward delays. A port that hears no BPDU at all for three hellos has no
+# bridge behind it and forwards as an edge port; the forward delay timers
+# are only a fallback for a bridge that never answers the proposals.
+#
+# Information heard on a port lasts three hellos, less when its message age
+# gets close to the max age. A port whose link goes down (link_down(), from
+# the carrier events) loses its information at once.
+import struct
+import threading
+import time
+
+BPDU_MAC = b'\x01\x80\xc2\x00\x00\x00'
+BPDU_FORMAT = struct.Struct('!6sHQIQHBBB')
+
+# Flags, same bits as in 802.1w
+TC = 0x01
+PROPOSAL = 0x02
+ROLE_SHIFT = 2
+LEARNING_FLAG = 0x10
+FORWARDING_FLAG = 0x20
+AGREEMENT = 0x40
+
+# Port roles
+ROOT = 'root'
+DESIGNATED = 'designated'
+ALTERNATE = 'alternate'
+BACKUP = 'backup'
+# The link is down
+DISABLED = 'disabled'
+# Role field of the flags; backup ports are sent as alternate ones
+ROLE_CODES = {ALTERNATE: 1, BACKUP: 1, ROOT: 2, DESIGNATED: 3}
+CODE_ROLES = {1: ALTERNATE, 2: ROOT, 3: DESIGNATED}
+
+# Port states
+DISCARDING = 'discarding'
+LEARNING = 'learning'
+FORWARDING = 'forwarding'
+
+PATH_COST = 10
+HELLO_TIME = 1.0
+FORWARD_DELAY = 15.0
+MAX_AGE = 20
+# Port information not refreshed for this many hellos is dropped
+INFO_HELLOS = 3
+# tick() should be called about this often (seconds)
+TICK = 0.1
+
+def bpdu_instance(data, length):
+    """Returns the instance a BPDU is for, -1 if it is too short."""
+    if length < BPDU_FORMAT.size:
+        return -1
+    return (data[6] << 8) | data[7]
+
+class BridgePort:
+    def __init__(self, index, edge):
+        self.index = index
+        self.id = 0x8000 | index
+        # Access ports lead to hosts: they forward from the start and send no
+        # BPDUs. Trunks that nobody answers on become edge ports as well.
+        self.admin_edge = edge
+        self.edge = edge
+        self.role = DESIGNATED
+        self.state = FORWARDING if edge else DISCARDING
+        self.state_time = time.monotonic()
+        # Priority vector (root, cost, bridge, port) of the designated port
+        # at the other end, None while nothing was heard on this port
+        self.info = None
+        self.info_age = 0
+        self.info_max_age = MAX_AGE
+        self.info_until = 0.0
+        self.bpdu_time = 0.0
+        # The other end agreed to our current root information
+        self.agreed = False
+        self.tc_until = 0.0
+        self.send_now = False
+
+class STP:
+    """Port roles and states of one bridge.
+
+    send(port, frame) transmits a BPDU, on_change() is called after port
+    states changed and on_flush(ports) when the FDB entries learned on those
+    ports are stale. Frames arrive through receive(), carrier changes through
+    link_down() and link_up(); tick() runs the timers. They may be called
+    from different threads.
+    """
+
+    def __init__(self, bridge_id, edge, send, on_change, on_flush, instance=0,
+                 path_cost=PATH_COST, hello=HELLO_TIME, forward_delay=FORWARD_DELAY,
+                 max_age=MAX_AGE):
+        self.bridge_id = bridge_id
+        self.instance = instance
+        self.ports = [BridgePort(i, is_edge) for i, is_edge in enumerate(edge)]
+        self.send = send
+        self.on_change = on_change
+        self.on_flush = on_flush
+        self.path_cost = path_cost
+        self.hello = hello
+        self.forward_delay = forward_delay
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # Until told otherwise we are the root
+        self.root_id = bridge_id
+        self.root_cost = 0
+        self.root_port = None
+        self.next_hello = 0.0
+        self.changed = False
+
+    def is_root(self):
+        return self.root_id == self.bridge_id
+
+    def forwarding(self, port):
+        return self.ports[port].state == FORWARDING
+
+    def learning(self, port):
+        return self.ports[port].state == LEARNING
+
+    def receive(self, port, data, length):
+        if length < BPDU_FORMAT.size:
+            return
+        _, _, root, cost, bridge, port_id, flags, age, max_age = BPDU_FORMAT.unpack_from(data)
+        role = CODE_ROLES.get((flags >> ROLE_SHIFT) & 3)
+        with self.lock:
+            now = time.monotonic()
+            p = self.ports[port]
+            if p.role == DISABLED:
+                return
+            p.bpdu_time = now
+            if p.edge:
+                # A bridge behind it, it is no edge port after all
+                p.edge = p.admin_edge = False
+                self.set_state(p, DISCARDING, now)
+
+            if role == DESIGNATED:
+                self.receive_designated(p, (root, cost, bridge, port_id), flags, age, max_age, now)
+            elif flags & AGREEMENT and p.role == DESIGNATED and root == self.root_id:
+                # The root or alternate port at the other end is in sync with us
+                p.agreed = True
+                self.set_state(p, FORWARDING, now)
+
+            if flags & TC and p.role in (ROOT, DESIGNATED):
+                self.topology_change(p, False, now)
+            self.commit(now)
+
+    def receive_designated(self, p, vector, flags, age, max_age, now):
+        if age >= max_age:
+            # Went around too many bridges, most likely stale
+            if p.info is not None and vector[2:] == p.info[2:]:
+                p.info = None
+                self.update_roles(now)
+            return
+
+        if p.info is None or vector <= p.info or vector[2:] == p.info[2:]:
+            # Better information, or news from the same designated port
+            changed = vector != p.info
+            p.info = vector
+            p.info_age = age
+            p.info_max_age = max_age
+            p.info_until = now + min(INFO_HELLOS * self.hello, max_age - age)
+            if changed:
+                self.update_roles(now)
+        elif p.role == DESIGNATED:
+            # The other end has not heard of our better root yet
+            p.send_now = True
+
+        if flags & PROPOSAL:
+            if p.role == ROOT:
+                self.sync(now)
+                self.transmit(p, AGREEMENT, now)
+            elif p.role in (ALTERNATE, BACKUP):
+                # Discarding already, nothing to sync
+                self.transmit(p, AGREEMENT, now)
+
+    def sync(self, now):
+        # No loop may go through the new root port: the designated ports that
+        # did not agree to the current root block until they do
+        for p in self.ports:
+            if p.role == DESIGNATED and not p.edge and not p.agreed:
+                self.set_state(p, DISCARDING, now)
+                p.send_now = True
+
+    def update_roles(self, now):
+        # Root port: the best vector heard, with our path cost to it added
+        best = (self.bridge_id, 0, self.bridge_id, 0, 0)
+        root_port = None
+        for p in self.ports:
+            # Disabled ports have no information
+            if p.info is None or p.info[2] == self.bridge_id:
+                continue
+            root, cost, bridge, port_id = p.info
+            vector = (root, cost + self.path_cost, bridge, port_id, p.id)
+            if vector < best:
+                best, root_port = vector, p
+
+        rerooted = best[0] != self.root_id or root_port is not self.root_port
+        if rerooted or best[1] != self.root_cost:
+            # The designated ports tell the others about the new vector
+            for p in self.ports:
+                p.send_now = True
+        self.root_id, self.root_cost, self.root_port = best[0], best[1], root_port
+
+        # Blocking first, the root port may only forward once the rest is in sync
+        for p in self.ports:
+            if p is root_port or p.role == DISABLED:
+                continue
+            if p.info is None or p.info >= (self.root_id, self.root_cost, self.bridge_id, p.id):
+                self.set_role(p, DESIGNATED, rerooted, now)
+            elif p.info[2] == self.bridge_id:
+                # Our own BPDUs come back: two of our ports on one segment
+                self.set_role(p, BACKUP, rerooted, now)
+            else:
+                self.set_role(p, ALTERNATE, rerooted, now)
+        if root_port is not None:
+            self.set_role(root_port, ROOT, rerooted, now)
+
+    def set_role(self, p, role, rerooted, now):
+        old_role = p.role
+        p.role = role
+        if role != old_role:
+            # A new designated port proposes right away
+            p.send_now = True
+        if role == ROOT:
+            # The old root port is blocked by now and the other ports synced
+            self.set_state(p, FORWARDING, now)
+        elif role in (ALTERNATE, BACKUP):
+            p.agreed = False
+            self.set_state(p, DISCARDING, now)
+            if old_role in (ROOT, DESIGNATED) and not p.edge:
+                self.on_flush({p.index})
+        elif p.edge:
+            self.set_state(p, FORWARDING, now)
+        elif rerooted or old_role != DESIGNATED:
+            # Agreements given for the old root do not hold any more
+            p.agreed = False
+            self.set_state(p, DISCARDING, now)
+
+    def set_state(self, p, state, now):
+        if p.state == state:
+            return
+        p.state = state
+        p.state_time = now
+        self.changed = True
+        if state == FORWARDING and not p.edge:
+            self.topology_change(p, True, now)
+
+    def topology_change(self, origin, detected, now):
+        # Entries behind the other ports may have moved. A port that starts
+        # forwarding tells everyone, a received TC goes on away from its origin
+        flushed = set()
+        for p in self.ports:
+            if p.edge or p is origin:
+                continue
+            flushed.add(p.index)
+            if p.role in (ROOT, DESIGNATED):
+                p.tc_until = now + 2 * self.hello
+                p.send_now = True
+        if detected:
+            origin.tc_until = now + 2 * self.hello
+            origin.send_now = True
+        if flushed:
+            self.on_flush(flushed)
+
+    def transmit(self, p, flags, now):
+        flags |= ROLE_CODES[p.role] << ROLE_SHIFT
+        if p.state == LEARNING:
+            flags |= LEARNING_FLAG
+        elif p.state == FORWARDING:
+            flags |= LEARNING_FLAG | FORWARDING_FLAG
+        elif p.role == DESIGNATED:
+            flags |= PROPOSAL
+        if now < p.tc_until:
+            flags |= TC
+        if self.root_port is None:
+            age, max_age = 0, self.max_age
+        else:
+            age, max_age = self.root_port.info_age + 1, self.root_port.info_max_age
+        self.send(p.index, BPDU_FORMAT.pack(BPDU_MAC, self.instance, self.root_id, self.root_cost,
+                                            self.bridge_id, p.id, flags, age, max_age))
+
+    def commit(self, now):
+        # BPDUs asked for while handling an event, then the new port states
+        for p in self.ports:
+            if p.send_now:
+                p.send_now = False
+                if p.role == DESIGNATED and not p.admin_edge:
+                    self.transmit(p, 0, now)
+        if self.changed:
+            self.changed = False
+            self.on_change()
+
+    def link_down(self, port):
+        with self.lock:
+            now = time.monotonic()
+            p = self.ports[port]
+            if p.role == DISABLED:
+                return
+            p.role = DISABLED
+            p.info = None
+            p.agreed = False
+            p.tc_until = 0.0
+            self.set_state(p, DISCARDING, now)
+            # Whatever was behind the port is gone, the rest of the FDB is
+            # only flushed if the tree changes
+            self.on_flush({p.index})
+            self.update_roles(now)
+            self.commit(now)
+
+    def link_up(self, port):
+        with self.lock:
+            now = time.monotonic()
+            p = self.ports[port]
+            if p.role != DISABLED:
+                return
+            # Starts over like at boot: proposing, or forwarding if edge
+            p.role = DESIGNATED
+            p.edge = p.admin_edge
+            p.state_time = now
+            p.bpdu_time = 0.0
+            if p.edge:
+                self.set_state(p, FORWARDING, now)
+            p.send_now = True
+            self.update_roles(now)
+            self.commit(now)
+
+    def tick(self):
+        with self.lock:
+            now = time.monotonic()
+            expired = False
+            for p in self.ports:
+                if p.info is not None and now >= p.info_until:
+                    # The other end is gone, or stopped being designated
+                    p.info = None
+                    expired = True
+            if expired:
+                self.update_roles(now)
+
+            for p in self.ports:
+                if p.role != DESIGNATED or p.edge or p.state == FORWARDING:
+                    continue
+                if now - max(p.state_time, p.bpdu_time) >= INFO_HELLOS * self.hello:
+                    # Not a BPDU while proposing: no bridge behind this port
+                    p.edge = True
+                    self.set_state(p, FORWARDING, now)
+                elif now - p.state_time >= self.forward_delay:
+                    # A bridge that does not answer the proposals: the slow
+                    # way, as in 802.1D
+                    self.set_state(p, FORWARDING if p.state == LEARNING else LEARNING, now)
+
+            if now >= self.next_hello:
+                self.next_hello = max(self.next_hello, now - self.hello) + self.hello
+                for p in self.ports:
+                    p.send_now = True
+            self.commit(now)
@@ -1,16 +1,107 @@
 #!/usr/bin/python3
+import asyncio
+import importlib
+import os
+import select
 import sys
 import struct
+
+# SWITCH_BACKEND names a module with the functions of wrapper.py to use in
+# its place, e.g. unixlink to run over AF_UNIX sockets (see launcher.py)
+BACKEND = os.environ.get('SWITCH_BACKEND', 'wrapper')
+if BACKEND != 'wrapper':
+    sys.modules['wrapper'] = importlib.import_module(BACKEND)
+
 import wrapper
 import threading
 import time
-from wrapper import recv_from_any_link, send_to_link, get_switch_mac, get_interface_name
+import ctypes
+import multiprocessing
+import random
+import signal
+from collections import namedtuple
+from fdb import FDB, int_to_mac
+from profiler import StageProfiler
+from stats import Stats, COUNTERS, UNICAST, FLOOD, BROADCAST, MULTICAST, BPDU, DROP_BLOCKED, DROP_VLAN, DROP_STORM, LINK_DOWN
+from storm import STORM_CLASSES, STORM_CLASS_NAMES, STORM_UNKNOWN, STORM_BROADCAST, STORM_MULTICAST
+from stp import STP, BPDU_MAC, TICK as STP_TICK, bpdu_instance
+from wrapper import recv_from_any_link, recv_from_any_link_batch, send_to_link, get_switch_mac, get_interface_name, get_interface_mac
+from wrapper import recv_from_any_link_ring, release_ring_frames, flush_links, send_to_link_iov
+from wrapper import recv_from_link, get_interface_fd, fastpath_punt_recv, fastpath_punt_fd
+from wrapper import open_link_events, recv_link_events, open_control_sockets, recv_control, get_control_fd
+from wrapper import storm_allow
+
+# Port table entry: mode is TRUNK or ACCESS, vlan_id is 0 on trunks
+Port = namedtuple('Port', ['name', 'mode', 'vlan_id', 'mac'])
+TRUNK = 'trunk'
+ACCESS = 'access'
+
+RX_BATCH = int(os.environ.get('SWITCH_RX_BATCH', '0'))
+RX_RING = os.environ.get('SWITCH_RX_RING', '0') == '1'
+TX_RING = os.environ.get('SWITCH_TX_RING', '0') == '1'
+ZERO_COPY = os.environ.get('SWITCH_ZERO_COPY', '0') == '1'
+# Push/pop VLAN tags with writev; only copy-free when frames arrive as
+# memoryviews (SWITCH_ZERO_COPY or SWITCH_RX_RING)
+TX_IOV = os.environ.get('SWITCH_TX_IOV', '0') == '1'
+FDB_SIZE = int(os.environ.get('SWITCH_FDB_SIZE', '65536'))
+FDB_AGING = int(os.environ.get('SWITCH_FDB_AGING', '300'))
+WORKERS = int(os.environ.get('SWITCH_WORKERS', '0'))
+PR_SET_PDEATHSIG = 1  # from linux/prctl.h
+# Keeps the FDB in this file (e.g. /dev/shm/switch{id}.fdb) for show.py,
+# {id} is replaced by the switch id
+FDB_FILE = os.environ.get('SWITCH_FDB_FILE', '')
+# One asyncio event loop for the receive path and the timers, no BPDU thread.
+# Receives with recvmmsg, SWITCH_RX_RING is ignored
+ASYNC = os.environ.get('SWITCH_ASYNC', '0') == '1'
+# Forwards known traffic in a C thread of dlink.so. Python keeps STP and
+# learning and only sees the frames the thread punts.
+FASTPATH = os.environ.get('SWITCH_FASTPATH', '0') == '1'
+fastpath_started = False
+# BPDUs get sockets of their own, received before any data frame, so that a
+# busy port cannot delay STP. With workers this process only gets BPDUs anyway.
+CONTROL_QUEUE = os.environ.get('SWITCH_CONTROL_QUEUE', '1') == '1'
+# Config of the switch, {id} as above; the checker topology uses the default
+CONFIG_FILE = os.environ.get('SWITCH_CONFIG', 'configs/switch{id}.cfg')
+# Rewrites this JSON file with the counters every second, {id} as above
+STATS_FILE = os.environ.get('SWITCH_STATS_FILE', '')
+# Err-disables a port that keeps dropping storm traffic for this many seconds
+# in a row (see the storm lines of the config), 0 never does
+STORM_ERR_DISABLE = int(os.environ.get('SWITCH_STORM_ERR_DISABLE', '0'))
+
+BROADCAST_MAC = 0xFFFFFFFFFFFF
+
+# Bumped by the STP code whenever a port state changes
+state_generation = multiprocessing.RawValue(ctypes.c_ulong, 0)
+# One spanning tree per instance of the config, by row and by instance id.
+# Only the process that receives the BPDUs has them, see main()
+stps = []
+stp_by_id = {}
+# Port states are kept in one row of interface_state per instance:
+# vlan_instance[vlan] is the row of a VLAN, state_base[vlan] where it starts
+vlan_instance = [0] * 4096
+state_base = [0] * 4096
+states_lock = threading.Lock()
+# Link aggregation: port_lag[i] is the logical port of interface i, the first
+# member of its LAG (or i itself); the FDB, STP and interface_state only know
+# logical ports. lag_slots has LAG_SLOTS entries per logical port, the member
+# that sends the frames whose MACs hash to each.
+LAG_SLOTS = 64  # as in fastpath.h
+port_lag = []
+lag_slots = []
+carrier = []
+# Packets and bytes per second each port may flood, per traffic class (see
+# storm.py). The buckets are shared by the workers, so the limits hold for
+# the whole switch; storm_enabled is False when the config sets none.
+storm_enabled = False
+storm_limits = []
+storm_buckets = []
 
 def parse_ethernet_header(data):
     # Unpack the header fields from the byte array
     #dest_mac, src_mac, ethertype = struct.unpack('!6s6sH', data[:14])
-    dest_mac = data[0:6]
-    src_mac = data[6:12]
+    # MACs are kept as 48-bit ints, the form the FDB stores them in
+    dest_mac = int.from_bytes(data[0:6], byteorder='big')
+    src_mac = int.from_bytes(data[6:12], byteorder='big')
     
     # Extract ethertype. Under 802.1Q, this may be the bytes from the VLAN TAG
     ether_type = (data[12] << 8) + data[13]
@@ -29,59 +120,295 @@ def create_vlan_tag(vlan_id):
     # vlan_id & 0x0FFF ensures that only the last 12 bits are used
     return struct.pack('!H', 0x8200) + struct.pack('!H', vlan_id & 0x0FFF)
 
-def send_bdpu_every_sec():
-    global root_bridge_ID, root_path_cost, own_bridge_ID
-    global interfaces, interface_state, vlan, table
-    # TODO Send BDPU every second if necessary
+# 802.1Q tags of every VLAN id, built once
+VLAN_TAGS = [create_vlan_tag(vlan_id) for vlan_id in range(4096)]
+
+def lag_ports(names, groups):
+    first = {}
+    return [first.setdefault(groups[name], i) if name in groups else i
+            for i, name in enumerate(names)]
+
+def update_lag_slots(slots, port_lag, carrier):
+    # Spreads the slots of every logical port over its members with a carrier
+    for port in set(port_lag):
+        members = [i for i, lag in enumerate(port_lag) if lag == port and carrier[i]]
+        members = members or [port]
+        for k in range(LAG_SLOTS):
+            slots[port * LAG_SLOTS + k] = members[k % len(members)]
+
+def send_to_lag(port, data, length):
+    # The member only depends on the MACs, the frames of a flow stay in order
+    slot = (data[4] ^ data[5] ^ data[10] ^ data[11]) & (LAG_SLOTS - 1)
+    wrapper.send_to_link(lag_slots[port * LAG_SLOTS + slot], data, length)
+
+def send_to_lag_iov(port, header, tag, payload):
+    slot = (header[4] ^ header[5] ^ header[10] ^ header[11]) & (LAG_SLOTS - 1)
+    wrapper.send_to_link_iov(lag_slots[port * LAG_SLOTS + slot], header, tag, payload)
+
+def send_bpdu(interface, data):
+    send_to_link(interface, data, len(data))
+    # print('sent BDPU on interface ', interface, ' with data ', data, ' and length ', len(data))
+    if TX_RING:
+        flush_links()
+
+def run_stp_timers():
     while True:
-        if own_bridge_ID == root_bridge_ID:
-            for interface in interfaces:
-                if vlan.get(get_interface_name(interface)) != 'T':
-                    continue
-                mac_cast = struct.pack('!BBBBBB', 0x01, 0x80, 0xc2, 0x00, 0x00, 0x00)
-                own_bid = struct.pack('!q', own_bridge_ID)
-                root_bid = struct.pack('!q', root_bridge_ID)
-                cost_path = struct.pack('!I', root_path_cost)
-                data = mac_cast + own_bid + root_bid + cost_path
-                send_to_link(interface, data, len(data))
-                # print('sent BDPU on interface ', interface, ' with data ', data, ' and length ', len(data))
+        tick_stps()
+        time.sleep(STP_TICK)
+
+def tick_stps():
+    for stp in stps:
+        stp.tick()
+
+def on_link_events(loop=None):
+    # A port that lost its carrier leaves the spanning tree at once, without
+    # waiting for its BPDU information to age out. A LAG only leaves it with
+    # its last member, until then the others take over the traffic.
+    for interface, up in recv_link_events():
+        if not up:
+            counters[interface * COUNTERS + LINK_DOWN] += 1
+        port = port_lag[interface]
+        members = [i for i in interfaces if port_lag[i] == port]
+        was_up = any(carrier[i] for i in members)
+        carrier[interface] = up
+        if len(members) > 1:
+            update_lag_slots(lag_slots, port_lag, carrier)
+        # Any member coming up again ends the err-disabled state of its LAG
+        recovered = up and err_disabled[port]
+        if recovered:
+            clear_err_disabled(port)
+        if any(carrier[i] for i in members) != was_up or recovered:
+            for stp in stps:
+                if up:
+                    stp.link_up(port)
+                else:
+                    stp.link_down(port)
+        if loop is not None and not fastpath_started:
+            if up:
+                loop.add_reader(get_interface_fd(interface), on_readable, interface, handle_frame)
+            else:
+                loop.remove_reader(get_interface_fd(interface))
+
+def watch_links(fd):
+    while True:
+        select.select([fd], [], [])
+        on_link_events()
+
+def create_stps(instances):
+    # The bridge id is the priority of the instance, the switch MAC breaks ties.
+    # Access ports are edge ports, the trunks run the spanning trees.
+    global stps, stp_by_id
+    mac = int.from_bytes(get_switch_mac(), byteorder='big')
+    edge = [port.mode == ACCESS for port in ports]
+    stps = []
+    for row, (instance, priority) in enumerate(instances):
+        # A topology change only flushes the VLANs of its own tree
+        vlans = None
+        if len(instances) > 1:
+            vlans = frozenset(v for v in range(4096) if vlan_instance[v] == row)
+        stps.append(STP((priority << 48) | mac, edge, send_bpdu,
+                        lambda row=row: apply_port_states(row),
+                        lambda flushed, vlans=vlans: table.flush_ports(flushed, vlans),
+                        instance))
+    stp_by_id = {stp.instance: stp for stp in stps}
+    # The other members of a LAG stay out of the trees for good
+    for i in interfaces:
+        if port_lag[i] != i:
+            for stp in stps:
+                stp.link_down(i)
+
+def apply_port_states(row=0):
+    # Called by the STP of an instance whenever one of its ports changes state
+    with states_lock:
+        base = row * len(interfaces)
+        for i in interfaces:
+            interface_state[base + i] = stps[row].forwarding(i)
+        # Tells the forwarding workers, if any, to rebuild theirs as well
+        state_generation.value += 1
+        update_flood_sets()
+
+def use_stats(process):
+    # Counters of this process: one block for Python, one for dlink.so
+    global counters
+    counters = switch_stats.python_block(process)
+    wrapper.set_port_stats(switch_stats.lib_block(process))
+
+def export_stats():
+    states = ['err-disabled' if err_disabled[port_lag[i]] else 'up' if carrier[i] else 'down'
+              for i in interfaces]
+    switch_stats.export(STATS_FILE.replace('{id}', sys.argv[1]),
+                        [port.name for port in ports], states)
+
+def export_stats_every_sec():
+    while True:
+        export_stats()
         time.sleep(1)
 
+def check_storms():
+    # A port that dropped storm traffic in each of the last STORM_ERR_DISABLE
+    # seconds leaves every spanning tree as if its cable was pulled, until
+    # its carrier goes down and up again (any member, for a LAG). Drops are
+    # counted on the logical port and include the workers and the fast path.
+    drops = [port[DROP_STORM] for port in switch_stats.totals()]
+    for i in interfaces:
+        if drops[i] > storm_drops[i]:
+            storm_seconds[i] += 1
+            if storm_seconds[i] == STORM_ERR_DISABLE:
+                err_disabled[i] = True
+                for stp in stps:
+                    stp.link_down(i)
+        else:
+            storm_seconds[i] = 0
+    storm_drops[:] = drops
+
+def clear_err_disabled(port):
+    # Starts over with full buckets, and with the storm seconds counted again
+    err_disabled[port] = False
+    storm_seconds[port] = 0
+    i = port * STORM_CLASSES * 2
+    storm_buckets[i:i + STORM_CLASSES * 2] = [0] * (STORM_CLASSES * 2)
+
+def check_storms_every_sec():
+    while True:
+        time.sleep(1)
+        check_storms()
+
+def install_profiler():
+    # kill -USR1 starts timing the hot path, kill -USR2 prints the report.
+    # receive includes the wait for frames, forward includes lookup and send.
+    module = sys.modules[__name__]
+    receive = ('recv_from_any_link', 'recv_from_any_link_batch', 'recv_from_any_link_ring',
+               'recv_from_link', 'fastpath_punt_recv')
+    profiler = StageProfiler({
+        'receive': [(module, name) for name in receive],
+        'parse': [(module, 'parse_ethernet_header')],
+        'learn': [(table, 'learn')],
+        'lookup': [(table, 'lookup')],
+        'forward': [(module, 'trunk_forwarding'), (module, 'access_forwarding')],
+        'send': [(module, 'send_to_link'), (module, 'send_to_link_iov')],
+    })
+    profiler.install_signals()
+    return profiler
+
 def is_Unicast(mac):
-    return mac[0] & 1 == 0
+    return (mac >> 40) & 1 == 0
 
-def init_resources():
-    table = {}
+def create_fdb(shared=False, lock=None):
+    if FDB_FILE:
+        return FDB.create(FDB_FILE.replace('{id}', sys.argv[1]), FDB_SIZE, FDB_AGING, lock)
+    if shared:
+        return FDB.shared(FDB_SIZE, FDB_AGING, lock)
+    return FDB(FDB_SIZE, FDB_AGING, lock=lock)
+
+def parse_vlans(text):
+    # e.g. 2,5-7
+    vlans = set()
+    for item in text.split(','):
+        first, _, last = item.partition('-')
+        vlans.update(range(int(first), int(last or first) + 1))
+    return vlans
+
+def read_config(switch_id):
+    # First line: bridge priority of instance 0, the tree of every VLAN not
+    # given to another instance. Then one line per port, its name and access
+    # VLAN (T for trunks), and optionally
+    #   instance <id> <vlans> <priority>
+    # for a spanning tree of its own (MST-style), e.g. "instance 1 2,5-7 4".
+    # Every switch needs the same instances; their priorities differ so that
+    # each instance gets its root, and its blocked trunk, somewhere else.
+    # Ports with the same name after their VLAN are a LAG, e.g. "rr-0-1 T lag0"
+    # and "rr-0-1b T lag0"; both ends need it and the members the same VLAN.
+    # Storm control limits what a port may flood, e.g. "storm r-0 broadcast
+    # 100 64000" for 100 packets and 64000 bytes per second (0: no limit);
+    # the classes are broadcast, multicast and unknown-unicast.
     vlan = {}
+    groups = {}
+    storms = []
+    instances = []
+    vlan_map = [0] * 4096
+    name = CONFIG_FILE.replace('{id}', switch_id)
+    with open(name, 'r') as f:
+        instances.append((0, int(f.readline().strip())))
+        for line in f:
+            fields = line.split()
+            # print('line: ', line)
+            if not fields:
+                continue
+            if fields[0] == 'instance':
+                instance, vlans, priority = int(fields[1]), fields[2], int(fields[3])
+                for v in parse_vlans(vlans):
+                    vlan_map[v] = len(instances)
+                instances.append((instance, priority))
+            elif fields[0] == 'storm':
+                packets = int(fields[3])
+                size = int(fields[4]) if len(fields) > 4 else 0
+                storms.append((fields[1], STORM_CLASS_NAMES[fields[2]], packets, size))
+            else:
+                vlan.update({fields[0]: fields[1]})
+                if len(fields) > 2:
+                    groups[fields[0]] = fields[2]
+    return vlan, instances, vlan_map, groups, storms
+
+def create_storm_buckets(num_interfaces, context):
+    # Zeroed words are full buckets
+    return context.RawArray(ctypes.c_uint64, num_interfaces * STORM_CLASSES * 2)
+
+def init_resources(table=None, storm=None):
+    global vlan_instance, state_base, port_lag, lag_slots, carrier
+    global storm_enabled, storm_limits, storm_buckets
+    global send_to_link, send_to_link_iov
+    if table is None:
+        # The fast path reads the FDB from shared memory. STP flushes it from
+        # its timer thread, hence the lock.
+        table = create_fdb(FASTPATH, threading.Lock())
     switch_id = sys.argv[1]
-    own_bridge_ID = root_bridge_ID = -1
     num_interfaces = wrapper.init(sys.argv[2:])
+    wrapper.set_zero_copy(ZERO_COPY)
+    if TX_RING:
+        wrapper.init_tx_ring()
+    if RX_RING and not ASYNC:
+        wrapper.init_rx_ring(num_interfaces)
     interfaces = range(0, num_interfaces)
-    interface_state = [True] * num_interfaces
 
-    name = 'configs/switch'+switch_id+'.cfg'
-    
-    f = open(name, 'r')
-    own_bridge_ID = f.readline().strip()
-    own_bridge_ID = int(own_bridge_ID)
-    root_bridge_ID = own_bridge_ID
-    root_path_cost = 0
-
-    for line in f:
-        line = line.strip()
-        # print('line: ', line)
-        vlan.update({line.split()[0]: line.split()[1]})
+    vlan, instances, vlan_instance, groups, storms = read_config(switch_id)
+    state_base = [row * num_interfaces for row in vlan_instance]
+    interface_state = [True] * (len(instances) * num_interfaces)
 
     # print("# Starting switch with id {}".format(switch_id), flush=True)
     # print("[INFO] Switch MAC", ':'.join(f'{b:02x}' for b in get_switch_mac()))
     # print(vlan)
-    
-    return table, vlan, switch_id, own_bridge_ID, root_bridge_ID, root_path_cost, num_interfaces, interfaces, interface_state
+
+    # Everything the forwarding path needs about a port, looked up once
+    ports = tuple(make_port(get_interface_name(i), vlan, get_interface_mac(i)) for i in interfaces)
+
+    port_lag = lag_ports(sys.argv[2:], groups)
+    carrier = [True] * num_interfaces
+    lag_slots = [0] * (num_interfaces * LAG_SLOTS)
+    update_lag_slots(lag_slots, port_lag, carrier)
+    if groups:
+        # Only switches with LAGs pay for choosing a member
+        send_to_link, send_to_link_iov = send_to_lag, send_to_lag_iov
+
+    # Limits of a LAG go to its logical port
+    storm_limits = [0] * (num_interfaces * STORM_CLASSES * 2)
+    for name, storm_class, packets, size in storms:
+        if name in sys.argv[2:]:
+            i = (port_lag[sys.argv[2:].index(name)] * STORM_CLASSES + storm_class) * 2
+            storm_limits[i:i + 2] = packets, size
+    if storm is None:
+        # Only this process takes from them
+        storm = create_storm_buckets(num_interfaces, multiprocessing), None
+    storm_buckets, storm_lock = storm
+    storm_enabled = any(storm_limits)
+    if storm_enabled:
+        wrapper.storm_init(storm_limits, storm_buckets, storm_lock)
+
+    return table, ports, switch_id, instances, num_interfaces, interfaces, interface_state
 
 def inspect(dest_mac, src_mac, ethertype, vlan_id, interface, length):
     # # print the MAC src and MAC dst in human readable format
-    p_dest_mac = ':'.join(f'{b:02x}' for b in dest_mac)
-    p_src_mac = ':'.join(f'{b:02x}' for b in src_mac)
+    p_dest_mac = int_to_mac(dest_mac)
+    p_src_mac = int_to_mac(src_mac)
     print(f'Destination MAC: {p_dest_mac}')
     print(f'Source MAC: {p_src_mac}')
     print(f'EtherType: {ethertype}')
@@ -94,200 +421,438 @@ def translate_trunk(vlan: str) -> int:
         return 0
     return int(vlan)
 
-def trunk_forwarding(dest_mac, vlan_id: int, interface, data, length, table, vlan, interfaces, interface_state):
-    notag_data = data[0:12] + data[16:]
+def make_port(name, vlan, mac):
+    vlan_id = translate_trunk(vlan[name])
+    mode = TRUNK if vlan_id == 0 else ACCESS
+    return Port(name, mode, vlan_id, mac)
+
+def compute_flood_sets(ports, interface_state, vlan_instance):
+    # For every VLAN id: (trunk ports, access ports of the VLAN) in forwarding
+    # state, in the spanning tree instance of the VLAN
+    rows = len(interface_state) // len(ports)
+    trunks = [tuple(i for i, port in enumerate(ports)
+                    if port.mode == TRUNK and interface_state[row * len(ports) + i])
+              for row in range(rows)]
+    flood_sets = [(trunks[row], ()) for row in vlan_instance]
+    for vlan_id in set(port.vlan_id for port in ports if port.mode == ACCESS):
+        base = vlan_instance[vlan_id] * len(ports)
+        access = tuple(i for i, port in enumerate(ports)
+                       if port.vlan_id == vlan_id and interface_state[base + i])
+        flood_sets[vlan_id] = (trunks[vlan_instance[vlan_id]], access)
+    return flood_sets
+
+def update_flood_sets():
+    # Called whenever interface_state or the port table changes
+    global flood_sets, flood_generation
+    flood_generation = state_generation.value
+    flood_sets = compute_flood_sets(ports, interface_state, vlan_instance)
+
+def tag_frame(data, vlan_id):
+    return b''.join((data[0:12], VLAN_TAGS[vlan_id], data[12:]))
+
+def untag_frame(data):
+    return b''.join((data[0:12], data[16:]))
+
+# Both helpers build at most one re-encapsulated copy of a frame, and only once
+# an egress port actually needs it. With SWITCH_TX_IOV=1 no copy is built: the
+# MACs, the tag and the rest of the frame are handed to writev as they are.
+
+def send_tagged(egress, data, vlan_id, length):
+    # Pushes the 802.1Q tag of vlan_id and sends the frame to every port in egress
+    if not egress:
+        return
+    if TX_IOV:
+        header, tag, payload = data[0:12], VLAN_TAGS[vlan_id], data[12:]
+        for i in egress:
+            send_to_link_iov(i, header, tag, payload)
+        return
+    tagged_frame = tag_frame(data, vlan_id)
+    for i in egress:
+        send_to_link(i, tagged_frame, length + 4)
+
+def send_untagged(egress, data, length):
+    # Pops the 802.1Q tag and sends the frame to every port in egress
+    if not egress:
+        return
+    if TX_IOV:
+        header, payload = data[0:12], data[16:]
+        for i in egress:
+            send_to_link_iov(i, header, b'', payload)
+        return
+    notag_data = untag_frame(data)
+    for i in egress:
+        send_to_link(i, notag_data, length - 4)
+
+# trunk_forwarding and access_forwarding only differ in how the frame is
+# tagged on its way out. An FDB entry behind a port that stopped forwarding is
+# as good as unknown, and storm control is checked before a flood copies the
+# frame to every port.
+def trunk_forwarding(dest_mac, vlan_id: int, interface, data, length, table, ports, flood_sets, counters):
     # print('TRUNK Forwarding')
     if is_Unicast(dest_mac):
         # print('Unicast')
-        if dest_mac in table:
-            vlan_path = vlan.get(get_interface_name(table.get(dest_mac)))
-            vlan_path = translate_trunk(vlan_path)
+        dest_port = table.lookup(vlan_id, dest_mac)
+        if dest_port >= 0 and interface_state[state_base[vlan_id] + dest_port]:
+            counters[interface * COUNTERS + UNICAST] += 1
+            vlan_path = ports[dest_port].vlan_id
             # pachetul se duce pe trunk
             if vlan_path == 0:
-                send_to_link(table.get(dest_mac), data, length)
+                send_to_link(dest_port, data, length)
                 # print('sent to trunk next hop')
             else:
-                send_to_link(table.get(dest_mac), notag_data, length - 4)
+                send_untagged((dest_port,), data, length)
                 # print('sent to acces next hop')
-        else:
-            # print('broadcast')
-            for i in interfaces:
-                if i == interface or interface_state[i] == False:
-                    continue
-                vlan_path = vlan.get(get_interface_name(i))
-                vlan_path = translate_trunk(vlan_path)
-                if vlan_path == 0:
-                    send_to_link(i, data, length)
-                    # print('sent to trunk')
-                elif vlan_path == vlan_id:
-                    send_to_link(i, notag_data, length - 4)
-                    # print('sent to acces')
+            return
+        counters[interface * COUNTERS + FLOOD] += 1
+        storm_class = STORM_UNKNOWN
+    elif dest_mac == BROADCAST_MAC:
+        counters[interface * COUNTERS + BROADCAST] += 1
+        storm_class = STORM_BROADCAST
     else:
-        # print('Multicast')
-        for i in interfaces:
-            if i == interface or interface_state[i] == False:
-                continue
-            vlan_path = vlan.get(get_interface_name(i))
-            vlan_path = translate_trunk(vlan_path)
-            if vlan_path == 0:
-                send_to_link(i, data, length)
-                # print('sent to trunk')
-            elif vlan_path == vlan_id:
-                send_to_link(i, notag_data, length - 4)
-                # print('sent to acces')
+        counters[interface * COUNTERS + MULTICAST] += 1
+        storm_class = STORM_MULTICAST
+
+    if storm_enabled and not storm_allow(interface, storm_class, length):
+        counters[interface * COUNTERS + DROP_STORM] += 1
+        return
 
-def access_forwarding(dest_mac, vlan_id: int, interface, data, length, table, vlan, interfaces, interface_state):
+    # print('broadcast / multicast')
+    trunks, access = flood_sets[vlan_id]
+    for i in trunks:
+        if i != interface:
+            send_to_link(i, data, length)
+            # print('sent to trunk')
+    send_untagged(access, data, length)
+
+def access_forwarding(dest_mac, vlan_id: int, interface, data, length, table, ports, flood_sets, counters):
     # print('ACCES Forwarding')
     if is_Unicast(dest_mac):
         # print('Unicast')
-        if dest_mac in table:
-            vlan_path = vlan.get(get_interface_name(table.get(dest_mac)))
-            vlan_path = translate_trunk(vlan_path)
+        dest_port = table.lookup(vlan_id, dest_mac)
+        if dest_port >= 0 and interface_state[state_base[vlan_id] + dest_port]:
+            counters[interface * COUNTERS + UNICAST] += 1
+            vlan_path = ports[dest_port].vlan_id
             # pachetul se duce pe trunk
             if vlan_path == 0:
-                tagged_frame = data[0:12] + create_vlan_tag(vlan_id) + data[12:]
-                send_to_link(table.get(dest_mac), tagged_frame, length + 4)
+                send_tagged((dest_port,), data, vlan_id, length)
                 # print('sent to trunk next hop')
             else:
-                send_to_link(table.get(dest_mac), data, length)
+                send_to_link(dest_port, data, length)
                 # print('sent to acces next hop')
-        else:
-            # print('broadcast')
-            for i in interfaces:
-                if i == interface or interface_state[i] == False:
-                    continue
-                vlan_path = vlan.get(get_interface_name(i))
-                vlan_path = translate_trunk(vlan_path)
-                if vlan_path == 0:
-                    tagged_frame = data[0:12] + create_vlan_tag(vlan_id) + data[12:]
-                    send_to_link(i, tagged_frame, length + 4)
-                    # print('sent to trunk')
-                elif vlan_path == vlan_id:
-                    send_to_link(i, data, length)
-                    # print('sent to acces')
+            return
+        counters[interface * COUNTERS + FLOOD] += 1
+        storm_class = STORM_UNKNOWN
+    elif dest_mac == BROADCAST_MAC:
+        counters[interface * COUNTERS + BROADCAST] += 1
+        storm_class = STORM_BROADCAST
     else:
-        # print('Multicast')
-        for i in interfaces:
-            if i == interface or interface_state[i] == False:
-                continue
-            vlan_path = vlan.get(get_interface_name(i))
-            vlan_path = translate_trunk(vlan_path)
-            if vlan_path == 0:
-                tagged_frame = data[0:12] + create_vlan_tag(vlan_id) + data[12:]
-                send_to_link(i, tagged_frame, length + 4)
-                # print('sent to trunk')
-            elif vlan_path == vlan_id:
-                send_to_link(i, data, length)
-                # print('sent to acces')
+        counters[interface * COUNTERS + MULTICAST] += 1
+        storm_class = STORM_MULTICAST
+
+    if storm_enabled and not storm_allow(interface, storm_class, length):
+        counters[interface * COUNTERS + DROP_STORM] += 1
+        return
+
+    # print('broadcast / multicast')
+    trunks, access = flood_sets[vlan_id]
+    send_tagged(trunks, data, vlan_id, length)
+    for i in access:
+        if i != interface:
+            send_to_link(i, data, length)
+            # print('sent to acces')
 
 def check_for_trunk(vlan_src: int):
     return vlan_src == 0
 
-def main():
-    global root_bridge_ID, root_path_cost, own_bridge_ID
-    global interfaces, interface_state, vlan, table
-    table, vlan, switch_id, own_bridge_ID, root_bridge_ID, root_path_cost, num_interfaces, interfaces, interface_state = init_resources()
-    root_port = None
+def handle_frame(interface, data, length):
+    global interfaces, interface_state, ports, table, flood_sets
+    table.tick()
+    interface = port_lag[interface]
+    mac_cast = data[0:6]
 
-    t = threading.Thread(target=send_bdpu_every_sec)
-    t.start()
+    # print('found mac_cast: ', mac_cast)
+    if mac_cast == BPDU_MAC:
+        # Blocked ports hear BPDUs too, that is how they find out to forward
+        counters[interface * COUNTERS + BPDU] += 1
+        # BPDUs of instances we do not run are ignored
+        stp = stp_by_id.get(bpdu_instance(data, length))
+        if stp is not None:
+            stp.receive(interface, data, length)
+        return
+
+    dest_mac, src_mac, ethertype, vlan_id = parse_ethernet_header(data)
+
+    if vlan_id == -1:
+        vlan_id = ports[interface].vlan_id
+    elif ports[interface].mode == ACCESS and vlan_id != ports[interface].vlan_id:
+        # Tagged for another VLAN than the one of the access port
+        counters[interface * COUNTERS + DROP_VLAN] += 1
+        return
+
+    if interface_state[state_base[vlan_id] + interface] == False:
+        # Ports in learning state learn without forwarding. Only this process
+        # runs STP, the workers and the fast path drop the frames.
+        if stps and stps[vlan_instance[vlan_id]].learning(interface):
+            table.learn(vlan_id, src_mac, interface)
+        counters[interface * COUNTERS + DROP_BLOCKED] += 1
+        return
+
+    # inspect(dest_mac, src_mac, ethertype, vlan_id, interface, length)
+
+    table.learn(vlan_id, src_mac, interface)
+
+    vlan_src = ports[interface].vlan_id
+
+    if check_for_trunk(vlan_src):
+        trunk_forwarding(dest_mac, 
+                         vlan_id, 
+                         interface, 
+                         data, length, 
+                         table, ports, 
+                         flood_sets, counters)
+    else:
+        access_forwarding(dest_mac, 
+                          vlan_id, 
+                          interface, 
+                          data, length, 
+                          table, ports, 
+                          flood_sets, counters)
+
+def start_fastpath():
+    global interface_state, lag_slots, fastpath_started
+    if isinstance(interface_state, list):
+        # The C thread reads the port states straight from this array
+        interface_state = (ctypes.c_bool * len(interface_state))(*interface_state)
+    if isinstance(lag_slots, list):
+        lag_slots = (ctypes.c_int * len(lag_slots))(*lag_slots)
+    # Backends without a fast path refuse, frames then stay on the Python path
+    if wrapper.fastpath_start([port.vlan_id for port in ports], interface_state,
+                              vlan_instance, port_lag, lag_slots,
+                              table.buffer, table.mask + 1) == 0:
+        fastpath_started = True
+
+def receive_loop(handler):
+    if fastpath_started:
+        while True:
+            # Wakes up every second so that the FDB ages without punts
+            frame = fastpath_punt_recv(1000)
+            if frame is None:
+                table.tick()
+                continue
+            handler(*frame)
+            if TX_RING:
+                flush_links()
+
+    # SWITCH_RX_RING=1 reads frames in place from the mmap'd receive rings
+    if RX_RING:
+        while True:
+            # The rings return nothing while BPDUs wait
+            for interface, data, length in recv_control():
+                handler(interface, data, length)
+            for interface, data, length in recv_from_any_link_ring():
+                handler(interface, data, length)
+            if TX_RING:
+                flush_links()
+            release_ring_frames()
+
+    # SWITCH_RX_BATCH=N drains up to N frames per receive call
+    if RX_BATCH > 0:
+        while True:
+            for interface, data, length in recv_from_any_link_batch(RX_BATCH):
+                handler(interface, data, length)
+            if TX_RING:
+                flush_links()
 
     while True:
-        # if own_bridge_ID == root_bridge_ID:
-            # print('I AM ROOOOOT')
         interface, data, length = recv_from_any_link()
-        if interface_state[interface] == False:
-            continue
-        mac_cast = data[0:6]
-
-        #           6 bytes  8 bytes  8 bytes  4 bytes
-        # data = mac_cast + own_bid + root_bid + cost_path
-        # print('found mac_cast: ', mac_cast)
-        if mac_cast == b'\x01\x80\xc2\x00\x00\x00':
-            # print('entered bpdu check')
-            bpdu_src_bid = data[6:14]
-            bpdu_src_bid = int.from_bytes(bpdu_src_bid, byteorder='big')
-            bpdu_root_bid = data[14:22]
-            bpdu_root_bid = int.from_bytes(bpdu_root_bid, byteorder='big')
-            bpdu_cost_path = data[22:26]
-            bpdu_cost_path = int.from_bytes(bpdu_cost_path, byteorder='big')
-
-            we_were_root = False
-            if own_bridge_ID == root_bridge_ID:
-                we_were_root = True
-
-            if bpdu_root_bid < root_bridge_ID:
-                root_bridge_ID = bpdu_root_bid
-                root_path_cost = bpdu_cost_path + 10
-                root_port = interface
-
-                if we_were_root:
-                    for i in interfaces:
-                        if i != root_port and vlan.get(get_interface_name(i)) == 'T':
-                            interface_state[i] = False
-
-                if interface_state[root_port] == False:
-                    interface_state[root_port] = True
-
-                mac_cast = struct.pack('!BBBBBB', 0x01, 0x80, 0xc3, 0x00, 0x00, 0x00)
-                own_bid = struct.pack('!q', own_bridge_ID)
-                root_bid = struct.pack('!q', root_bridge_ID)
-                cost_path = struct.pack('!I', root_path_cost)
-                data = mac_cast + own_bid + root_bid + cost_path
-                for i in interfaces:
-                    if i != root_port and vlan.get(get_interface_name(i)) == 'T':
-                        send_to_link(i, data, len(data))
-                        # print('updated BDPU on interface ', i, ' with data ', data, ' and length ', len(data))
-
-            elif bpdu_root_bid == root_bridge_ID:
-                if interface == root_port and bpdu_cost_path + 10 < root_path_cost:
-                    root_path_cost = bpdu_cost_path + 10
-                
-                elif interface != root_port and bpdu_cost_path > root_path_cost:
-                    interface_state[interface] = True
-
-            elif bpdu_src_bid == own_bridge_ID:
-                interface_state[interface] = False
-            
-            if own_bridge_ID == root_bridge_ID:
-                for i in interfaces:
-                    if i != root_port and vlan.get(get_interface_name(i)) == 'T':
-                        interface_state[i] = True
-            continue
-        
-        dest_mac, src_mac, ethertype, vlan_id = parse_ethernet_header(data)
-
-        if vlan_id == -1:
-            vlan_id = vlan.get(get_interface_name(interface))
-            vlan_id = translate_trunk(vlan_id)
-            
-        # inspect(dest_mac, src_mac, ethertype, vlan_id, interface, length)
-
-        # TODO: Implement forwarding with learning
-        table.update({src_mac: interface})
-
-        vlan_src = vlan.get(get_interface_name(interface))
-        vlan_src = translate_trunk(vlan_src)
-
-        if check_for_trunk(vlan_src):
-            trunk_forwarding(dest_mac, 
-                             vlan_id, 
-                             interface, 
-                             data, length, 
-                             table, vlan, 
-                             interfaces,
-                             interface_state)
-        else:
-            access_forwarding(dest_mac, 
-                              vlan_id, 
-                              interface, 
-                              data, length, 
-                              table, vlan, 
-                              interfaces,
-                              interface_state)
-            
-        # TODO: Implement VLAN support
-        # TODO: Implement STP support
+        handler(interface, data, length)
+        if TX_RING:
+            flush_links()
+
+def on_readable(interface, handler):
+    # At most one batch per wakeup, so a busy port cannot starve the others
+    # or the timers; the loop calls back while frames are left
+    for data, length in recv_from_link(interface, RX_BATCH or 64):
+        handler(interface, data, length)
+    if TX_RING:
+        flush_links()
+
+def on_control(handler):
+    for interface, data, length in recv_control():
+        handler(interface, data, length)
+    if TX_RING:
+        flush_links()
+
+def on_punted(handler):
+    for _ in range(64):
+        frame = fastpath_punt_recv(0)
+        if frame is None:
+            break
+        handler(*frame)
+    if TX_RING:
+        flush_links()
+
+def every(loop, when, period, callback):
+    callback()
+    # Scheduled on absolute times, so the period does not drift under load
+    when += period
+    loop.call_at(when, every, loop, when, period, callback)
+
+async def run_async(handler, hello):
+    loop = asyncio.get_running_loop()
+    if fastpath_started:
+        loop.add_reader(fastpath_punt_fd(), on_punted, handler)
+    else:
+        for interface in interfaces:
+            loop.add_reader(get_interface_fd(interface), on_readable, interface, handler)
+        # Callbacks run in order, so a BPDU waits for one batch per port at most
+        if get_control_fd() >= 0:
+            loop.add_reader(get_control_fd(), on_control, handler)
+
+    # FDB aging runs even when no frame arrives
+    every(loop, loop.time(), 1, table.tick)
+    if hello:
+        every(loop, loop.time(), STP_TICK, tick_stps)
+        links = open_link_events()
+        if links >= 0:
+            loop.add_reader(links, on_link_events, loop)
+        if STATS_FILE:
+            every(loop, loop.time(), 1, export_stats)
+        if STORM_ERR_DISABLE:
+            every(loop, loop.time() + 1, 1, check_storms)
+
+    await loop.create_future()
+
+def handle_worker_frame(interface, data, length):
+    # Port states are changed by the control process
+    if state_generation.value != flood_generation:
+        update_flood_sets()
+    handle_frame(interface, data, length)
+
+def worker_main(process, parent, shared_table, shared_state, shared_lags, shared_storm,
+                fanout_groups, fanout_lock):
+    global interfaces, interface_state, ports, table, lag_slots
+    # Without the control process nobody runs STP: the port states would stay
+    # as they are and a topology change could leave a loop. Die with it.
+    ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    if os.getppid() != parent:
+        os._exit(1)
+    table, ports, switch_id, instances, num_interfaces, interfaces, interface_state = init_resources(shared_table, shared_storm)
+    interface_state = shared_state
+    lag_slots = shared_lags
+    use_stats(process)
+    install_profiler()
+
+    # Workers share every port's traffic by flow hash and never see BPDUs.
+    # One at a time: each starts from the ids the previous one ended up with.
+    with fanout_lock:
+        wrapper.join_fanout(fanout_groups)
+    wrapper.set_bpdu_filter(False)
+    update_flood_sets()
+    if FASTPATH:
+        start_fastpath()
+
+    if ASYNC:
+        asyncio.run(run_async(handle_worker_frame, False))
+    receive_loop(handle_worker_frame)
+
+def start_workers(count):
+    # The FDB and the port states live in shared memory. The calling process
+    # stays the only one running STP; it receives nothing but BPDUs.
+    context = multiprocessing.get_context('fork')
+    num_interfaces = len(sys.argv) - 2
+    _, instances, _, groups, _ = read_config(sys.argv[1])
+    shared_table = create_fdb(True, context.Lock())
+    # Everything blocked until STP in the calling process says otherwise
+    shared_state = context.RawArray(ctypes.c_bool, [False] * (len(instances) * num_interfaces))
+    # LAG members change with the carrier, which only the calling process watches
+    shared_lags = context.RawArray(ctypes.c_int, num_interfaces * LAG_SLOTS)
+    update_lag_slots(shared_lags, lag_ports(sys.argv[2:], groups), [True] * num_interfaces)
+    # Storm buckets are taken atomically by dlink.so, the lock serves the
+    # backends that take them in Python
+    shared_storm = (create_storm_buckets(num_interfaces, context), context.Lock())
+    # Group ids are per network namespace. The first worker looks for free
+    # ones from a random start, the others join the same.
+    fanout_groups = context.RawArray(ctypes.c_int, [random.randrange(0x10000)
+                                                    for _ in range(num_interfaces)])
+    fanout_lock = context.Lock()
+
+    workers = []
+    for worker in range(count):
+        process = context.Process(target=worker_main,
+                                  args=(worker + 1, os.getpid(), shared_table, shared_state,
+                                        shared_lags, shared_storm, fanout_groups, fanout_lock),
+                                  daemon=True)
+        process.start()
+        workers.append(process)
+
+    return workers, shared_table, shared_state, shared_lags, shared_storm
+
+def stop_workers_on_signal(workers):
+    # The main thread may be blocked in dlink.so, where Python does not run
+    # signal handlers (see StageProfiler.install_signals): the signals are
+    # taken by a thread instead. Call before starting any other thread. The
+    # profiler signals (see install_profiler) are blocked in the same call, or
+    # this thread would take them with their default action and kill the switch.
+    signals = {signal.SIGTERM, signal.SIGINT}
+    signal.pthread_sigmask(signal.SIG_BLOCK, signals | {signal.SIGUSR1, signal.SIGUSR2})
+    threading.Thread(target=wait_stop_signal, args=(workers, signals), daemon=True).start()
+
+def wait_stop_signal(workers, signals):
+    signum = signal.sigwait(signals)
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        process.join()
+    os._exit(128 + signum)
+
+def main():
+    global interfaces, interface_state, ports, table, switch_stats, lag_slots
+    global storm_drops, storm_seconds, err_disabled
+    # Process 0 is this one, workers count from 1
+    switch_stats = Stats(len(sys.argv) - 2, WORKERS + 1)
+    shared_table = shared_storm = None
+    if WORKERS > 0:
+        workers, shared_table, shared_state, shared_lags, shared_storm = start_workers(WORKERS)
+        stop_workers_on_signal(workers)
+
+    table, ports, switch_id, instances, num_interfaces, interfaces, interface_state = init_resources(shared_table, shared_storm)
+    use_stats(0)
+    install_profiler()
+    if CONTROL_QUEUE and WORKERS == 0:
+        open_control_sockets()
+    create_stps(instances)
+    storm_drops = [0] * num_interfaces
+    storm_seconds = [0] * num_interfaces
+    err_disabled = [False] * num_interfaces
+
+    # SWITCH_WORKERS=N forwards in N processes, this one only runs STP
+    if WORKERS > 0:
+        interface_state = shared_state
+        lag_slots = shared_lags
+        wrapper.set_bpdu_filter(True)
+    # Trunks discard until STP lets them forward
+    for row in range(len(stps)):
+        apply_port_states(row)
+    if FASTPATH and WORKERS == 0:
+        start_fastpath()
+
+    # SWITCH_ASYNC=1 runs the STP timers in the event loop instead
+    if ASYNC:
+        asyncio.run(run_async(handle_frame, True))
+
+    t = threading.Thread(target=run_stp_timers)
+    t.start()
+    # Backends that cannot tell carrier changes return -1
+    links = open_link_events()
+    if links >= 0:
+        threading.Thread(target=watch_links, args=(links,), daemon=True).start()
+    if STATS_FILE:
+        threading.Thread(target=export_stats_every_sec, daemon=True).start()
+    if STORM_ERR_DISABLE:
+        threading.Thread(target=check_storms_every_sec, daemon=True).start()
+
+    receive_loop(handle_frame)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# Unit tests of the forwarding database, no switch needed.
+#
+#   python3 -m unittest discover tests
+import ctypes
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fdb import FDB, EMPTY, SEQ
+
+def colliding_keys(table, home, count, vlan=1):
+    # Keys of distinct MACs whose home slot is home
+    keys = []
+    mac = 0x020000000000
+    while len(keys) < count:
+        key = (vlan << 48) | mac
+        if table.slot(key) == home:
+            keys.append(key)
+        mac += 1
+    return keys
+
+class FDBTest(unittest.TestCase):
+    def test_learn_and_lookup(self):
+        table = FDB(capacity=16)
+        table.learn(1, 0x020000000001, 3)
+        self.assertEqual(table.lookup(1, 0x020000000001), 3)
+        self.assertEqual(len(table), 1)
+
+    def test_vlans_are_separate(self):
+        table = FDB(capacity=16)
+        table.learn(1, 0x020000000001, 3)
+        self.assertEqual(table.lookup(2, 0x020000000001), -1)
+        table.learn(2, 0x020000000001, 4)
+        self.assertEqual(table.lookup(1, 0x020000000001), 3)
+        self.assertEqual(table.lookup(2, 0x020000000001), 4)
+
+    def test_move(self):
+        table = FDB(capacity=16)
+        table.learn(1, 0x020000000001, 3)
+        table.learn(1, 0x020000000001, 5)
+        self.assertEqual(table.lookup(1, 0x020000000001), 5)
+        self.assertEqual(len(table), 1)
+
+    def test_aging(self):
+        table = FDB(capacity=16, aging_time=10)
+        table.learn(1, 0x020000000001, 3)
+        table.now += 10
+        self.assertEqual(table.lookup(1, 0x020000000001), 3)
+        table.now += 1
+        self.assertEqual(table.lookup(1, 0x020000000001), -1)
+        # Still in a slot until the sweep gets there
+        self.assertEqual(len(table), 1)
+        table.age_out()
+        self.assertEqual(len(table), 0)
+
+    def test_learning_again_refreshes(self):
+        table = FDB(capacity=16, aging_time=10)
+        table.learn(1, 0x020000000001, 3)
+        table.now += 8
+        table.learn(1, 0x020000000001, 3)
+        table.now += 8
+        self.assertEqual(table.lookup(1, 0x020000000001), 3)
+
+    def test_eviction_keeps_capacity(self):
+        table = FDB(capacity=4)
+        for mac in range(1, 5):
+            table.learn(1, mac, mac)
+        table.learn(1, 5, 5)
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table.lookup(1, 5), 5)
+        self.assertEqual(sum(table.lookup(1, mac) != -1 for mac in range(1, 5)), 3)
+
+    def test_eviction_prefers_unreferenced(self):
+        table = FDB(capacity=4)
+        for mac in range(1, 5):
+            table.learn(1, mac, mac)
+        # The first eviction clears every reference bit on its way
+        table.learn(1, 5, 5)
+        survivors = [mac for mac in range(1, 5) if table.lookup(1, mac) != -1]
+        # Learned again a second later, so referenced again
+        table.now += 1
+        for mac in survivors[1:]:
+            table.learn(1, mac, mac)
+        table.learn(1, 5, 5)
+        table.learn(1, 6, 6)
+        self.assertEqual(table.lookup(1, survivors[0]), -1)
+        for mac in survivors[1:] + [5, 6]:
+            self.assertNotEqual(table.lookup(1, mac), -1)
+
+    def check_backward_shift(self, home):
+        table = FDB(capacity=8)
+        first, second, third = colliding_keys(table, home, 3)
+        for port, key in enumerate((first, second, third)):
+            table.learn(key >> 48, key & 0xFFFFFFFFFFFF, port)
+        table.remove_keys([first])
+        mask = table.mask
+        # The others moved back, no hole is left in the probe sequence
+        self.assertEqual(table.keys[home], second)
+        self.assertEqual(table.keys[(home + 1) & mask], third)
+        self.assertEqual(table.keys[(home + 2) & mask], EMPTY)
+        self.assertEqual(table.lookup(1, second & 0xFFFFFFFFFFFF), 1)
+        self.assertEqual(table.lookup(1, third & 0xFFFFFFFFFFFF), 2)
+        self.assertEqual(table.lookup(1, first & 0xFFFFFFFFFFFF), -1)
+        self.assertEqual(len(table), 2)
+
+    def test_backward_shift_delete(self):
+        self.check_backward_shift(3)
+
+    def test_backward_shift_delete_wraps(self):
+        # The run starts in the last slot and goes on at slot 0
+        self.check_backward_shift(FDB(capacity=8).mask)
+
+    def test_backward_shift_keeps_entries_at_home(self):
+        table = FDB(capacity=8)
+        first, second = colliding_keys(table, 2, 2)
+        own = colliding_keys(table, 4, 1)[0]
+        for port, key in enumerate((first, second, own)):
+            table.learn(1, key & 0xFFFFFFFFFFFF, port)
+        table.remove_keys([first])
+        # Slot 4 is its home, it must not move into the hole at 3
+        self.assertEqual(table.keys[4], own)
+        self.assertEqual(table.keys[3], EMPTY)
+        self.assertEqual(table.lookup(1, own & 0xFFFFFFFFFFFF), 2)
+
+    def test_flush_ports(self):
+        table = FDB(capacity=64)
+        for mac in range(1, 21):
+            table.learn(1 + mac % 2, mac, mac % 3)
+        table.flush_ports((1,), vlans={1})
+        for mac in range(1, 21):
+            gone = mac % 3 == 1 and 1 + mac % 2 == 1
+            self.assertEqual(table.lookup(1 + mac % 2, mac), -1 if gone else mac % 3)
+
+    def test_shared_table(self):
+        table = FDB.shared(capacity=16)
+        table.learn(1, 0x020000000001, 3)
+        view = FDB(16, buffer=table.buffer)
+        self.assertEqual(view.lookup(1, 0x020000000001), 3)
+
+    def test_dead_writer_does_not_block_readers(self):
+        table = FDB.shared(capacity=16)
+        table.learn(1, 0x020000000001, 3)
+        # As left by a worker killed inside writing()
+        table.header[SEQ] += 1
+        self.assertEqual(table.lookup(1, 0x020000000001), -1)
+        self.assertEqual(len(table.entries()), 1)
+        # The next writer makes the number even again
+        table.learn(1, 0x020000000002, 4)
+        self.assertEqual(table.header[SEQ] % 2, 0)
+        self.assertEqual(table.lookup(1, 0x020000000001), 3)
+
+    def test_exception_while_writing(self):
+        table = FDB(capacity=16)
+        with self.assertRaises(RuntimeError):
+            with table.writing():
+                raise RuntimeError
+        self.assertEqual(table.header[SEQ] % 2, 0)
+        table.learn(1, 0x020000000001, 3)
+        self.assertEqual(table.lookup(1, 0x020000000001), 3)
+
+    def test_slot_matches_the_fast_path(self):
+        # fdb_find in lib/fastpath.c multiplies in 64 bits, at any table size.
+        # Only the mask matters, a real table of 2^26 slots would take 1 GB.
+        table = FDB(capacity=16)
+        table.mask = (1 << 26) - 1
+        for mac in range(0x020000000000, 0x020000000000 + 1000):
+            key = (1 << 48) | mac
+            product = ctypes.c_uint64(key * 0x9E3779B97F4A7C15).value
+            self.assertEqual(table.slot(key), (product >> 40) & table.mask)
+
+if __name__ == "__main__":
+    unittest.main()
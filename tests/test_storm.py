@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# Unit tests of storm control, no switch needed. The dlink.so ones are
+# skipped until it is built (make).
+#
+#   python3 -m unittest discover tests
+import ctypes
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+from storm import StormControl, SECOND, STORM_CLASSES, STORM_UNKNOWN, STORM_BROADCAST, STORM_MULTICAST
+
+DLINK = os.path.join(HERE, '..', 'dlink.so')
+
+def storm_limits(ports, port, traffic_class, packets, size):
+    limits = [0] * (ports * STORM_CLASSES * 2)
+    i = (port * STORM_CLASSES + traffic_class) * 2
+    limits[i:i + 2] = packets, size
+    return limits
+
+class Clock:
+    def __init__(self):
+        self.now = 1000 * SECOND
+
+    def __call__(self):
+        return self.now
+
+def passed(storm, frames, port=1, traffic_class=STORM_BROADCAST, length=64):
+    return sum(storm.allow(port, traffic_class, length) for _ in range(frames))
+
+class StormControlTest(unittest.TestCase):
+    def storm(self, packets, size, buckets=None):
+        self.clock = Clock()
+        return StormControl(storm_limits(2, 1, STORM_BROADCAST, packets, size), buckets,
+                            clock=self.clock)
+
+    def test_packet_limit(self):
+        # A second of traffic passes at once, nothing more
+        storm = self.storm(100, 0)
+        self.assertEqual(passed(storm, 150), 100)
+        self.assertFalse(storm.allow(1, STORM_BROADCAST, 64))
+
+    def test_byte_limit(self):
+        storm = self.storm(0, 1000)
+        self.assertEqual(passed(storm, 20, length=100), 10)
+        # A frame larger than a second of traffic never passes
+        storm = self.storm(0, 1000)
+        self.assertFalse(storm.allow(1, STORM_BROADCAST, 1001))
+
+    def test_both_limits(self):
+        # A frame over the byte limit costs no packet
+        storm = self.storm(10, 1000)
+        self.assertEqual(passed(storm, 20, length=1500), 0)
+        self.assertEqual(passed(storm, 20, length=50), 10)
+
+    def test_refill(self):
+        storm = self.storm(100, 0)
+        self.assertEqual(passed(storm, 100), 100)
+        self.clock.now += SECOND // 2
+        self.assertEqual(passed(storm, 100), 50)
+        # The bucket holds a second, however long the port stays quiet
+        self.clock.now += 10 * SECOND
+        self.assertEqual(passed(storm, 1000), 100)
+
+    def test_unlimited(self):
+        storm = self.storm(1, 1)
+        for port, traffic_class in ((1, STORM_UNKNOWN), (1, STORM_MULTICAST), (0, STORM_BROADCAST)):
+            self.assertEqual(passed(storm, 100, port, traffic_class), 100)
+
+    def test_shared_buckets(self):
+        # Workers share one limit, however many take from it
+        buckets = [0] * (2 * STORM_CLASSES * 2)
+        first = self.storm(100, 0, buckets)
+        second = StormControl(first.limits, buckets, clock=self.clock)
+        self.assertEqual(passed(first, 60) + passed(second, 60), 100)
+        self.clock.now += SECOND // 10
+        self.assertEqual(passed(second, 60) + passed(first, 60), 10)
+
+    def test_zeroed_bucket_is_full(self):
+        storm = self.storm(100, 0)
+        self.assertEqual(passed(storm, 100), 100)
+        i = (1 * STORM_CLASSES + STORM_BROADCAST) * 2
+        storm.buckets[i] = 0
+        self.assertEqual(passed(storm, 100), 100)
+
+@unittest.skipUnless(os.path.exists(DLINK), 'dlink.so not built')
+class FastPathStormTest(unittest.TestCase):
+    # storm_allow in lib/fastpath.c, on the real clock: a few frames may pass
+    # on top of the limit while the test runs
+
+    def setUp(self):
+        self.lib = ctypes.CDLL(DLINK)
+        self.lib.storm_init.argtypes = (ctypes.POINTER(ctypes.c_uint32),
+                                        ctypes.POINTER(ctypes.c_uint64))
+        self.lib.storm_allow.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_size_t)
+
+    def install(self, packets, size):
+        limits = storm_limits(2, 1, STORM_BROADCAST, packets, size)
+        self.limits = (ctypes.c_uint32 * len(limits))(*limits)
+        self.buckets = (ctypes.c_uint64 * len(limits))()
+        self.lib.storm_init(self.limits, self.buckets)
+
+    def passed(self, frames, length=64):
+        return sum(self.lib.storm_allow(1, STORM_BROADCAST, length) for _ in range(frames))
+
+    def test_packet_limit(self):
+        self.install(1000, 0)
+        self.assertTrue(1000 <= self.passed(2000) < 1100)
+
+    def test_byte_limit(self):
+        self.install(0, 100000)
+        self.assertTrue(100 <= self.passed(200, length=1000) < 110)
+        self.assertEqual(self.lib.storm_allow(0, STORM_BROADCAST, 100000), 1)
+
+    def test_both_limits(self):
+        self.install(1000, 100000)
+        self.assertEqual(self.passed(500, length=200000), 0)
+        self.assertTrue(1000 <= self.passed(2000, length=10) < 1100)
+
+    def test_same_words_as_python(self):
+        # The buckets of dlink.so and of StormControl can be read either way
+        self.install(10, 0)
+        self.assertEqual(self.passed(20), 10)
+        storm = StormControl(list(self.limits), self.buckets)
+        self.assertFalse(storm.allow(1, STORM_BROADCAST, 64))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,317 @@
+#!/usr/bin/python3
+# Regression tests of STP, MST instances, VLANs, LAGs, storm control and the
+# worker processes on whole topologies, run with launcher.py: every switch is a real
+# switch.py over AF_UNIX sockets, no root or Mininet needed. Each test starts
+# its topology and takes a few seconds.
+#
+#   python3 -m unittest discover tests
+#
+# The switches inherit the environment, e.g. to test another receive path:
+#   SWITCH_ASYNC=1 python3 -m unittest tests.test_topology
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+from launcher import Topology, host_mac
+
+# Time for the trees to settle after the switches start
+SETTLE = 3.0
+# Reconvergence after a failure, in seconds. RSTP reacts to a lost carrier
+# at once; the bound leaves room for a loaded machine.
+RECONVERGE = 1.0
+
+class TopologyTest(unittest.TestCase):
+    name = 'default'
+    env = None
+
+    def setUp(self):
+        self.topo = Topology(os.path.join(HERE, '..', 'topologies', self.name + '.topo'), self.env)
+        self.topo.start()
+        self.addCleanup(self.topo.stop)
+        time.sleep(SETTLE)
+
+    def stream(self, src, dst, seconds, action=None, unicast=False, flows=1):
+        """Sends numbered frames from host src to host dst for seconds, right
+        after action. Returns the seconds until dst got the first one (None if
+        it never did), the number sent and how many copies dst got of each.
+
+        Unicast frames carry one of flows source MACs, to spread them over
+        the members of a LAG.
+        """
+        dst_mac = host_mac(int(dst[2:])) if unicast else b'\xff' * 6
+        base = host_mac(int(src[2:]))
+        if action:
+            action()
+        start = time.monotonic()
+        first = None
+        copies = {}
+        sent = 0
+        while time.monotonic() - start < seconds:
+            sent += 1
+            src_mac = base[:4] + bytes([(base[4] + sent % flows) & 0xff]) + base[5:]
+            try:
+                self.topo.send(src, dst_mac + src_mac + b'\x08\x00' + sent.to_bytes(4, 'big') + bytes(42))
+            except BlockingIOError:
+                pass
+            for frame in self.topo.receive(dst, 0.002):
+                if frame[6:10] != base[:4] or frame[11] != base[5]:
+                    continue
+                seq = int.from_bytes(frame[14:18], 'big')
+                copies[seq] = copies.get(seq, 0) + 1
+                if first is None:
+                    first = time.monotonic() - start
+        return first, sent, copies
+
+    def assertDelivered(self, first, sent, copies, within=RECONVERGE, ratio=0.5):
+        self.assertIsNotNone(first, 'nothing got through')
+        self.assertLess(first, within)
+        # Each frame at most once: a loop or two forwarding paths would copy it
+        self.assertEqual(max(copies.values()), 1)
+        # Only the frames sent before the tree converged again may be lost
+        self.assertGreater(len(copies), sent * ratio)
+
+    def learn(self, *hosts):
+        # Lets the switches learn the hosts, so unicast frames are not flooded
+        for host in hosts:
+            self.topo.send(host, b'\xff' * 6 + host_mac(int(host[2:])) + b'\x08\x00' + bytes(46))
+        time.sleep(0.2)
+        self.topo.drain(0.1)
+
+class TriangleTest(TopologyTest):
+    # switch1 is the root, switch2 blocks rr-0-2 (see configs/switch*.cfg)
+
+    def test_steady(self):
+        self.assertDelivered(*self.stream('h-0', 'h-5', 1.0))
+
+    def test_link_cut(self):
+        # h-0 reaches h-5 through the root; rr-0-2 has to take over
+        self.assertDelivered(*self.stream('h-0', 'h-5', 1.0))
+        self.assertDelivered(*self.stream('h-0', 'h-5', 1.5,
+                                          lambda: self.topo.cut('switch0', 'rr-0-1')))
+        self.assertDelivered(*self.stream('h-0', 'h-5', 1.0), within=0.1)
+
+    def test_root_dies(self):
+        self.assertDelivered(*self.stream('h-0', 'h-5', 1.0))
+        self.assertDelivered(*self.stream('h-0', 'h-5', 1.5,
+                                          lambda: self.topo.kill('switch1')))
+
+    def test_blocked_link_cut(self):
+        # Losing the blocked link changes nothing for the traffic
+        self.assertDelivered(*self.stream('h-0', 'h-5', 1.0,
+                                          lambda: self.topo.cut('switch2', 'rr-0-2')),
+                             within=0.1)
+
+class VlanTest(TopologyTest):
+    # VLAN 1: h-0, h-2, h-3, h-5; VLAN 2: h-1, h-4
+
+    def broadcast_from(self, host):
+        self.topo.drain(0.05)
+        self.topo.send(host, b'\xff' * 6 + host_mac(int(host[2:])) + b'\x08\x00' + bytes(46))
+        got = {}
+        for name, frames in self.topo.drain(0.3).items():
+            mine = [f for f in frames if f[6:12] == host_mac(int(host[2:]))]
+            if mine:
+                got[name] = mine
+        return got
+
+    def test_isolation_across_trunks(self):
+        for host, members in (('h-0', {'h-2', 'h-3', 'h-5'}), ('h-1', {'h-4'}),
+                              ('h-4', {'h-1'}), ('h-5', {'h-0', 'h-2', 'h-3'})):
+            got = self.broadcast_from(host)
+            self.assertEqual(set(got), members, host)
+            for frames in got.values():
+                self.assertEqual(len(frames), 1)
+                # Access ports get the frame without its tag
+                self.assertEqual(frames[0][12:14], b'\x08\x00')
+
+    def test_unicast_stays_in_vlan(self):
+        self.learn('h-1', 'h-4')
+        # h-0 (VLAN 1) sends to the MAC of h-4 (VLAN 2): h-4 never sees it
+        first, _, _ = self.stream('h-0', 'h-4', 0.5, unicast=True)
+        self.assertIsNone(first)
+        self.assertDelivered(*self.stream('h-1', 'h-4', 0.5, unicast=True))
+
+class LagTest(TopologyTest):
+    # switch0 and switch1 are joined by rr-0-1 and rr-0-1b (configs/lag-example)
+    name = 'lag'
+
+    def test_member_fails(self):
+        self.learn('h-0', 'h-2')
+        self.assertDelivered(*self.stream('h-0', 'h-2', 1.0, unicast=True, flows=8))
+        # The other member takes every flow at once, the tree does not change
+        self.assertDelivered(*self.stream('h-0', 'h-2', 1.0, unicast=True, flows=8,
+                                          action=lambda: self.topo.cut('switch0', 'rr-0-1')),
+                             within=0.1, ratio=0.9)
+        # Without any member, traffic goes around through switch2
+        self.assertDelivered(*self.stream('h-0', 'h-2', 1.5, unicast=True, flows=8,
+                                          action=lambda: self.topo.cut('switch0', 'rr-0-1b')))
+
+    def test_broadcast_crosses_once(self):
+        self.assertDelivered(*self.stream('h-0', 'h-3', 1.0, flows=8))
+
+class StatsTest(TopologyTest):
+    # The switches rewrite their stats files every second
+
+    def setUp(self):
+        stats = tempfile.TemporaryDirectory()
+        self.addCleanup(stats.cleanup)
+        self.stats = os.path.join(stats.name, 'switch{id}.json')
+        self.env = dict(self.env or {}, SWITCH_STATS_FILE=self.stats)
+        super().setUp()
+
+    def port_stats(self, switch):
+        with open(self.stats.replace('{id}', switch)) as f:
+            return json.load(f)['ports']
+
+class MstTest(StatsTest):
+    # Instance 0 (VLAN 1) is rooted at switch1 and blocks rr-0-2 on switch2,
+    # instance 1 (VLAN 2) is rooted at switch2 and blocks rr-0-1 on switch1
+    # (configs/mst-example)
+    name = 'mst'
+
+    def blocked(self):
+        # Frames dropped by the blocked port of each instance so far
+        return {port: self.port_stats(switch)[port]['drop_blocked']
+                for switch, port in (('1', 'rr-0-1'), ('2', 'rr-0-2'))}
+
+    def test_instances_block_different_ports(self):
+        for src, dst, blocked, open_port in (('h-0', 'h-5', 'rr-0-2', 'rr-0-1'),
+                                             ('h-1', 'h-4', 'rr-0-1', 'rr-0-2')):
+            before = self.blocked()
+            self.assertDelivered(*self.stream(src, dst, 0.5))
+            # The stats files are rewritten every second
+            time.sleep(1.5)
+            after = self.blocked()
+            self.assertGreater(after[blocked], before[blocked], src)
+            self.assertEqual(after[open_port], before[open_port], src)
+
+    def test_link_cut_per_instance(self):
+        # VLAN 2 goes straight from switch0 to switch2, cutting rr-0-1 only
+        # changes the tree of VLAN 1
+        self.learn('h-0', 'h-2', 'h-1', 'h-4')
+        cut = lambda: self.topo.cut('switch0', 'rr-0-1')
+        self.assertDelivered(*self.stream('h-1', 'h-4', 1.0, cut, unicast=True),
+                             within=0.1, ratio=0.9)
+        self.assertDelivered(*self.stream('h-0', 'h-2', 1.5, unicast=True))
+
+    def test_vlan_isolation(self):
+        self.assertDelivered(*self.stream('h-1', 'h-4', 0.5))
+        first, _, _ = self.stream('h-1', 'h-5', 0.5)
+        self.assertIsNone(first)
+
+class StormTest(StatsTest):
+    # switch0 lets h-0 (r-0) and the LAG to switch1 flood 100 broadcasts per
+    # second and err-disables them after 2 seconds over (configs/storm-example)
+    name = 'storm'
+    env = {'SWITCH_STORM_ERR_DISABLE': '2'}
+
+    def flood(self, host, seconds):
+        frame = b'\xff' * 6 + host_mac(int(host[2:])) + b'\x08\x00' + bytes(46)
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            try:
+                self.topo.send(host, frame)
+            except BlockingIOError:
+                time.sleep(0.001)
+
+    def wait_state(self, ports, state, timeout=3.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            states = {port: self.port_stats('0')[port]['state'] for port in ports}
+            if set(states.values()) == {state} or time.monotonic() > deadline:
+                break
+            time.sleep(0.2)
+        self.assertEqual(set(states.values()), {state}, states)
+
+    def bounce(self, port):
+        self.topo.cut('switch0', port)
+        time.sleep(0.2)
+        self.topo.plug('switch0', port)
+
+    def test_port_err_disabled(self):
+        self.learn('h-3')
+        self.flood('h-0', 3.5)
+        self.wait_state(['r-0'], 'err-disabled')
+        self.assertGreater(self.port_stats('0')['r-0']['drop_storm'], 0)
+        # Out of the tree, nothing gets through any more. The hosts still
+        # have the flood queued up.
+        self.topo.drain(0.5)
+        first, _, _ = self.stream('h-0', 'h-3', 0.5, unicast=True)
+        self.assertIsNone(first)
+        self.wait_state(['r-0'], 'err-disabled', 0)
+
+        self.bounce('r-0')
+        self.wait_state(['r-0'], 'up')
+        self.assertDelivered(*self.stream('h-0', 'h-3', 1.0, unicast=True))
+
+    def test_lag_err_disabled(self):
+        # h-2 floods switch0 through the LAG, its root port. The LAG comes
+        # back when any member does, and carries the traffic again.
+        lag = ['rr-0-1', 'rr-0-1b']
+        self.flood('h-2', 3.5)
+        self.wait_state(lag, 'err-disabled')
+        self.bounce('rr-0-1b')
+        self.wait_state(lag, 'up')
+
+        self.learn('h-0', 'h-2')
+        time.sleep(1.5)
+        before = sum(self.port_stats('0')[port]['tx_frames'] for port in lag)
+        first, sent, copies = self.stream('h-0', 'h-2', 1.0, unicast=True, flows=8)
+        self.assertDelivered(first, sent, copies)
+        time.sleep(1.5)
+        after = sum(self.port_stats('0')[port]['tx_frames'] for port in lag)
+        self.assertGreater(after - before, len(copies) * 0.9)
+
+def running(pid):
+    # Killed processes nobody reaped yet stay as zombies
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] not in 'ZX'
+    except FileNotFoundError:
+        return False
+
+class WorkersTest(TopologyTest):
+    env = {'SWITCH_WORKERS': '2'}
+
+    def workers(self, switch):
+        pid = self.topo.processes[switch].pid
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+
+    def test_profiler_signals(self):
+        # SIGUSR1 starts the profiler, SIGUSR2 prints its report
+        switch = self.topo.processes['switch0']
+        workers = self.workers('switch0')
+        self.assertEqual(len(workers), 2)
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            switch.send_signal(signum)
+            time.sleep(0.3)
+            self.assertIsNone(switch.poll())
+        self.assertEqual(self.workers('switch0'), workers)
+        self.assertTrue(all(running(pid) for pid in workers))
+        self.assertDelivered(*self.stream('h-0', 'h-5', 1.0))
+
+    def check_workers_stop(self, signum):
+        switch = self.topo.processes['switch0']
+        workers = self.workers('switch0')
+        switch.send_signal(signum)
+        switch.wait(timeout=2)
+        deadline = time.monotonic() + 2
+        while any(running(pid) for pid in workers) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(any(running(pid) for pid in workers))
+
+    def test_workers_stop_with_sigterm(self):
+        self.check_workers_stop(signal.SIGTERM)
+
+    def test_workers_die_with_the_switch(self):
+        self.check_workers_stop(signal.SIGKILL)
+
+if __name__ == "__main__":
+    unittest.main()
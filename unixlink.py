@@ -0,0 +1,273 @@
+# Link layer over AF_UNIX seqpacket sockets, with the same functions as
+# wrapper.py. Every port is one end of a socketpair created by launcher.py,
+# so switches and hosts run in one box without root or real interfaces.
+# A port whose other end is closed or shut down has lost its carrier; it gets
+# it back when the launcher plugs a new socket in its place.
+#
+# Selected with SWITCH_BACKEND=unixlink. The ports come from the environment:
+#   SWITCH_LINK_FDS      name=fd,... the inherited socket of every port
+#   SWITCH_LINK_NODE     name of this node, makes the port MACs unique
+#   SWITCH_LINK_CONTROL  socket the launcher sends new cables on, if any
+# The receive and transmit rings, the C fast path and the worker fanout are
+# dlink.so features: the calls are accepted and the switch runs without them.
+import hashlib
+import os
+import select
+import socket
+
+from stats import COUNTERS, RX_FRAMES, RX_BYTES, TX_FRAMES, TX_BYTES
+from storm import StormControl
+
+MAX_PACKET_LEN = 1600
+MAX_BATCH_FRAMES = 64
+
+PACKET_HOST = 0
+PACKET_FANOUT_HASH = 0
+
+sockets = []
+names = []
+node = ''
+poller = select.poll()
+fd_port = {}
+# Ports found readable by poll and not served yet, served round-robin
+ready = []
+port_stats = None
+# Carrier losses not reported yet, and the pipe that wakes up their reader
+link_events = []
+dead_ports = set()
+events_pipe = None
+# New cables come from the launcher as a port name and a socket, taken by the
+# reader of the link events. wake_pipe gets the forwarding thread out of poll
+# to see them.
+control = None
+events_poll = None
+wake_pipe = os.pipe()
+# Storm control in Python, buckets updated under a lock instead of atomically
+storm_control = None
+
+def link_fds():
+    fds = {}
+    for item in os.environ.get('SWITCH_LINK_FDS', '').split(','):
+        if item:
+            name, fd = item.split('=')
+            fds[name] = int(fd)
+    return fds
+
+def init(argv_p):
+    global node, control
+    print("Initializing the switch")
+    fds = link_fds()
+    node = os.environ.get('SWITCH_LINK_NODE', str(os.getpid()))
+    for name in argv_p:
+        sock = socket.socket(fileno=fds[name])
+        sock.setblocking(False)
+        fd_port[sock.fileno()] = len(sockets)
+        sockets.append(sock)
+        names.append(name)
+        poller.register(sock.fileno(), select.POLLIN)
+        print("Setting up interface:", name)
+    if 'SWITCH_LINK_CONTROL' in os.environ:
+        control = socket.socket(fileno=int(os.environ['SWITCH_LINK_CONTROL']))
+        control.setblocking(False)
+    os.set_blocking(wake_pipe[0], False)
+    poller.register(wake_pipe[0], select.POLLIN)
+    return len(sockets)
+
+def set_zero_copy(enabled):
+    pass
+
+def set_port_stats(block):
+    global port_stats
+    port_stats = block
+
+def count(interface, frames, length, direction):
+    if port_stats is not None:
+        base = interface * COUNTERS
+        if direction == 'rx':
+            port_stats[base + RX_FRAMES] += frames
+            port_stats[base + RX_BYTES] += length
+        else:
+            port_stats[base + TX_FRAMES] += frames
+            port_stats[base + TX_BYTES] += length
+
+def set_bpdu_filter(bpdus_only):
+    pass
+
+def open_control_sockets():
+    pass
+
+def recv_control(max_frames=MAX_BATCH_FRAMES):
+    return []
+
+def get_control_fd():
+    return -1
+
+def join_fanout(groups, mode=PACKET_FANOUT_HASH):
+    pass
+
+def init_rx_ring(num_interfaces, *args):
+    pass
+
+def init_tx_ring(*args):
+    pass
+
+def fastpath_start(vlans, states, instances, lags, lag_slots, fdb_buffer, fdb_size):
+    return -1
+
+def storm_init(limits, buckets, lock=None):
+    global storm_control
+    storm_control = StormControl(limits, buckets, lock)
+
+def storm_allow(port, traffic_class, length):
+    return storm_control.allow(port, traffic_class, length)
+
+def fastpath_punt_recv(timeout_ms=-1):
+    return None
+
+def fastpath_punt_fd():
+    return -1
+
+def next_ready_port():
+    while not ready:
+        for fd, event in sorted(poller.poll()):
+            if fd == wake_pipe[0]:
+                os.read(wake_pipe[0], 4096)
+            elif event & (select.POLLHUP | select.POLLERR):
+                link_down(fd_port[fd])
+            else:
+                ready.append(fd_port[fd])
+    return ready.pop(0)
+
+def link_down(interface):
+    # Like an unplugged cable: the socket cannot be reconnected, see plug_links
+    if interface in dead_ports:
+        return
+    dead_ports.add(interface)
+    poller.unregister(sockets[interface].fileno())
+    if interface in ready:
+        ready.remove(interface)
+    link_events.append((interface, False))
+    if events_pipe is not None:
+        os.write(events_pipe[1], b'\0')
+
+def plug_links():
+    # Like a new cable in the port: the new socket takes the fd of the old
+    # one, so whoever polls the port goes on with the same fd
+    global control
+    while True:
+        try:
+            name, fds, _, _ = socket.recv_fds(control, 64, 1)
+        except BlockingIOError:
+            return
+        if not name:
+            # The launcher is gone, no more cables
+            events_poll.unregister(control.fileno())
+            control = None
+            return
+        interface = names.index(name.decode())
+        os.set_blocking(fds[0], False)
+        os.dup2(fds[0], sockets[interface].fileno())
+        os.close(fds[0])
+        dead_ports.discard(interface)
+        poller.register(sockets[interface].fileno(), select.POLLIN)
+        os.write(wake_pipe[1], b'\0')
+        link_events.append((interface, True))
+
+def open_link_events():
+    # Readable on carrier losses and on new cables
+    global events_pipe, events_poll
+    events_pipe = os.pipe()
+    os.set_blocking(events_pipe[0], False)
+    events_poll = select.epoll()
+    events_poll.register(events_pipe[0], select.EPOLLIN)
+    if control is not None:
+        events_poll.register(control.fileno(), select.EPOLLIN)
+    return events_poll.fileno()
+
+def recv_link_events():
+    try:
+        os.read(events_pipe[0], 4096)
+    except BlockingIOError:
+        pass
+    if control is not None:
+        plug_links()
+    events = []
+    while link_events:
+        events.append(link_events.pop(0))
+    return events
+
+def recv_from_link(interface, max_frames=MAX_BATCH_FRAMES):
+    frames = []
+    sock = sockets[interface]
+    while len(frames) < max_frames:
+        try:
+            data = sock.recv(MAX_PACKET_LEN)
+        except BlockingIOError:
+            break
+        except OSError:
+            data = b''
+        if not data:
+            # End of file: the other end is gone
+            link_down(interface)
+            break
+        frames.append((data, len(data)))
+        count(interface, 1, len(data), 'rx')
+    return frames
+
+def recv_from_any_link():
+    while True:
+        interface = next_ready_port()
+        frames = recv_from_link(interface, 1)
+        if frames:
+            data, length = frames[0]
+            return interface, data, length
+
+def recv_from_any_link_batch(max_frames=MAX_BATCH_FRAMES):
+    frames = []
+    # Block for the first frame only, then drain the ports that are already ready
+    while not frames or (ready and len(frames) < max_frames):
+        interface = next_ready_port()
+        for data, length in recv_from_link(interface, max_frames - len(frames)):
+            frames.append((interface, data, length))
+    return frames
+
+recv_from_any_link_ring = recv_from_any_link_batch
+
+def release_ring_frames():
+    pass
+
+def flush_links():
+    pass
+
+def packet_type(index=None):
+    return PACKET_HOST
+
+def get_interface_fd(interface):
+    return sockets[interface].fileno()
+
+def send_to_link(interface, buffer, length):
+    assert(length < 1600)
+    try:
+        sockets[interface].send(buffer[:length], socket.MSG_DONTWAIT)
+    except OSError:
+        # A full, closed or gone peer, like a congested or unplugged cable
+        return
+    count(interface, 1, length, 'tx')
+
+def send_to_link_iov(interface, header, tag, payload):
+    try:
+        sockets[interface].sendmsg([header, tag, payload], [], socket.MSG_DONTWAIT)
+    except OSError:
+        return
+    count(interface, 1, len(header) + len(tag) + len(payload), 'tx')
+
+def get_interface_mac(interface):
+    # Locally administered and stable for a node and port name
+    digest = hashlib.sha1(f'{node}/{names[interface]}'.encode()).digest()
+    return bytes([0x02]) + digest[:5]
+
+def get_switch_mac():
+    return get_interface_mac(1)
+
+def get_interface_name(interface):
+    return names[interface]
@@ -1,6 +1,7 @@
 import ctypes
 import sys
 from ctypes import create_string_buffer
+from netlink import LinkMonitor
 
 # Load the shared library with the data link functions
 lib = ctypes.CDLL('./dlink.so')
@@ -12,6 +13,11 @@ lib.recv_from_any_link.restype = ctypes.c_int
 lib.send_to_link.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t)
 lib.send_to_link.restype = ctypes.c_int
 
+lib.send_to_link_iov.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_void_p, ctypes.c_size_t)
+lib.send_to_link_iov.restype = ctypes.c_int
+
 lib.init.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_char_p))
 lib.init.restype = ctypes.c_int
 
@@ -21,7 +27,124 @@ lib.get_interface_mac.restype = None
 lib.get_interface_name.argtypes = [ctypes.c_int]
 lib.get_interface_name.restype = ctypes.c_char_p
 
+lib.recv_from_any_link_batch.argtypes = (ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int,
+                                         ctypes.POINTER(ctypes.c_int),
+                                         ctypes.POINTER(ctypes.c_size_t),
+                                         ctypes.POINTER(ctypes.c_size_t),
+                                         ctypes.POINTER(ctypes.c_int))
+lib.recv_from_any_link_batch.restype = ctypes.c_int
+
+lib.recv_from_link_batch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_size_t),
+                                     ctypes.POINTER(ctypes.c_size_t),
+                                     ctypes.POINTER(ctypes.c_int))
+lib.recv_from_link_batch.restype = ctypes.c_int
+
+lib.get_interface_fd.argtypes = [ctypes.c_int]
+lib.get_interface_fd.restype = ctypes.c_int
+
+lib.get_last_packet_type.argtypes = ()
+lib.get_last_packet_type.restype = ctypes.c_int
+
+lib.init_rx_ring.argtypes = (ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint)
+lib.init_rx_ring.restype = ctypes.c_int
+
+lib.get_rx_ring.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_size_t))
+lib.get_rx_ring.restype = ctypes.c_void_p
+
+lib.rx_ring_recv.argtypes = (ctypes.POINTER(ctypes.c_int),
+                             ctypes.POINTER(ctypes.c_size_t),
+                             ctypes.POINTER(ctypes.c_size_t),
+                             ctypes.POINTER(ctypes.c_int), ctypes.c_int)
+lib.rx_ring_recv.restype = ctypes.c_int
+
+lib.rx_ring_release.argtypes = [ctypes.c_int]
+lib.rx_ring_release.restype = None
+
+lib.init_tx_ring.argtypes = (ctypes.c_uint, ctypes.c_uint, ctypes.c_uint)
+lib.init_tx_ring.restype = ctypes.c_int
+
+lib.tx_ring_flush.argtypes = ()
+lib.tx_ring_flush.restype = ctypes.c_int
+
+lib.open_control_sockets.argtypes = ()
+lib.open_control_sockets.restype = ctypes.c_int
+
+lib.recv_control.argtypes = (ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t))
+lib.recv_control.restype = ctypes.c_int
+
+lib.get_control_fd.argtypes = ()
+lib.get_control_fd.restype = ctypes.c_int
+
+lib.set_bpdu_filter.argtypes = [ctypes.c_int]
+lib.set_bpdu_filter.restype = ctypes.c_int
+
+lib.join_fanout.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.c_int)
+lib.join_fanout.restype = ctypes.c_int
+
+lib.fastpath_set_ports.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_uint8),
+                                   ctypes.POINTER(ctypes.c_uint8))
+lib.fastpath_set_ports.restype = None
+
+lib.fastpath_set_lags.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int))
+lib.fastpath_set_lags.restype = None
+
+lib.storm_init.argtypes = (ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_uint64))
+lib.storm_init.restype = None
+
+lib.storm_allow.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_size_t)
+lib.storm_allow.restype = ctypes.c_int
+
+lib.fastpath_set_fdb.argtypes = (ctypes.c_void_p, ctypes.c_uint64)
+lib.fastpath_set_fdb.restype = None
+
+lib.fastpath_start.argtypes = ()
+lib.fastpath_start.restype = ctypes.c_int
+
+lib.fastpath_punt_recv.argtypes = (ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t), ctypes.c_int)
+lib.fastpath_punt_recv.restype = ctypes.c_int
+
+lib.fastpath_punt_fd.argtypes = ()
+lib.fastpath_punt_fd.restype = ctypes.c_int
+
+lib.set_port_stats.argtypes = [ctypes.c_void_p]
+lib.set_port_stats.restype = None
+
+PACKET_FANOUT_HASH = 0
+
+MAX_PACKET_LEN = 1600
+MAX_BATCH_FRAMES = 64
+
+# Buffers for the batched receive path, allocated once and reused
+batch_frames = ctypes.create_string_buffer(MAX_PACKET_LEN * MAX_BATCH_FRAMES)
+batch_view = memoryview(batch_frames).cast('B')
+batch_ifaces = (ctypes.c_int * MAX_BATCH_FRAMES)()
+batch_offsets = (ctypes.c_size_t * MAX_BATCH_FRAMES)()
+batch_lengths = (ctypes.c_size_t * MAX_BATCH_FRAMES)()
+# Packet type of each frame of the last batch, see packet_type()
+batch_pkttypes = (ctypes.c_int * MAX_BATCH_FRAMES)()
+
+# Packet types reported by the kernel (linux/if_packet.h). The switch's own
+# transmissions (PACKET_OUTGOING) are dropped by the kernel.
+PACKET_HOST = 0
+PACKET_BROADCAST = 1
+PACKET_MULTICAST = 2
+PACKET_OTHERHOST = 3
+
+# Zero-copy mode: frames are handed out as memoryviews into buffers that are
+# allocated once, and sent buffers are passed to C without copying them.
+zero_copy = False
+rx_buffer = ctypes.create_string_buffer(MAX_PACKET_LEN)
+rx_view = memoryview(rx_buffer).cast('B')
+rx_length = ctypes.c_size_t()
+rx_length_ref = ctypes.byref(rx_length)
+
+def set_zero_copy(enabled):
+    global zero_copy
+    zero_copy = enabled
+
 def init(argv_p):
+    global num_interfaces
     # Get the command-line arguments using sys.argv
     print("Initializing the switch")
     argv = [arg.encode('utf-8') for arg in argv_p]  # Convert each argument to bytes
@@ -31,9 +154,16 @@ def init(argv_p):
     argv_array = (ctypes.c_char_p * argc)(*argv)
     # Call the hub init function
     num_int = lib.init(argc, argv_array)
+    num_interfaces = num_int
     return num_int
 
 def recv_from_any_link():
+    if zero_copy:
+        # The frame is only valid until the next receive call
+        result = lib.recv_from_any_link(rx_buffer, rx_length_ref)
+        length = rx_length.value
+        return result, rx_view[:length], length
+
     # Create a buffer for the data to be written into
     buffer_size = 1600 # MAX_PACKET_LEN
 
@@ -46,28 +176,257 @@ def recv_from_any_link():
 
     return result, bytes(buffer.raw[:length.value]), length.value
 
+# Receives up to max_frames frames from all the ready interfaces in one call.
+# Returns a list of (interface, data, length) tuples.
+def recv_from_any_link_batch(max_frames=MAX_BATCH_FRAMES):
+    count = lib.recv_from_any_link_batch(batch_frames, MAX_PACKET_LEN,
+                                         min(max_frames, MAX_BATCH_FRAMES),
+                                         batch_ifaces, batch_offsets, batch_lengths,
+                                         batch_pkttypes)
+    frames = []
+    for i in range(count):
+        offset = batch_offsets[i]
+        length = batch_lengths[i]
+        if zero_copy:
+            frames.append((batch_ifaces[i], batch_view[offset:offset + length], length))
+        else:
+            frames.append((batch_ifaces[i], bytes(batch_view[offset:offset + length]), length))
+
+    return frames
+
+# Receives the frames queued on one interface without blocking, for use from
+# an event loop (see get_interface_fd). Returns a list of (data, length).
+def recv_from_link(interface, max_frames=MAX_BATCH_FRAMES):
+    count = lib.recv_from_link_batch(interface, batch_frames, MAX_PACKET_LEN,
+                                     min(max_frames, MAX_BATCH_FRAMES),
+                                     batch_offsets, batch_lengths, batch_pkttypes)
+    frames = []
+    for i in range(count):
+        offset = batch_offsets[i]
+        length = batch_lengths[i]
+        if zero_copy:
+            frames.append((batch_view[offset:offset + length], length))
+        else:
+            frames.append((bytes(batch_view[offset:offset + length]), length))
+
+    return frames
+
+# Returns the socket of an interface, e.g. for loop.add_reader
+def get_interface_fd(interface):
+    return lib.get_interface_fd(interface)
+
+# One memoryview over the receive ring of each interface, see init_rx_ring
+ring_views = []
+ring_iface = ctypes.c_int()
+
+# Switches every interface to a memory mapped TPACKET_V3 receive ring.
+# Frames must then be received with recv_from_any_link_ring.
+def init_rx_ring(num_interfaces, block_size=1 << 16, block_nr=64, frame_size=2048, block_timeout=1):
+    lib.init_rx_ring(block_size, block_nr, frame_size, block_timeout)
+    for i in range(num_interfaces):
+        size = ctypes.c_size_t()
+        addr = lib.get_rx_ring(i, ctypes.byref(size))
+        ring = (ctypes.c_ubyte * size.value).from_address(addr)
+        ring_views.append(memoryview(ring).cast('B'))
+
+# Returns a list of (interface, data, length) tuples where data is a memoryview
+# into the receive ring. The frames stay valid until release_ring_frames().
+def recv_from_any_link_ring(max_frames=MAX_BATCH_FRAMES):
+    count = lib.rx_ring_recv(ctypes.byref(ring_iface), batch_offsets, batch_lengths,
+                             batch_pkttypes, min(max_frames, MAX_BATCH_FRAMES))
+    interface = ring_iface.value
+    view = ring_views[interface]
+    frames = []
+    for i in range(count):
+        offset = batch_offsets[i]
+        length = batch_lengths[i]
+        frames.append((interface, view[offset:offset + length], length))
+
+    return frames
+
+# Gives the ring block of the last received frames back to the kernel
+def release_ring_frames():
+    lib.rx_ring_release(ring_iface.value)
+
+# Adds a memory mapped transmit ring to every interface. send_to_link then only
+# queues the frame, flush_links() puts all the queued frames on the wire.
+# Must be called before init_rx_ring, which maps the rings of the socket.
+def init_tx_ring(block_size=1 << 16, block_nr=8, frame_size=2048):
+    lib.init_tx_ring(block_size, block_nr, frame_size)
+
+# Transmits the frames queued by send_to_link in the transmit rings
+def flush_links():
+    lib.tx_ring_flush()
+
+# Returns the packet type of the frame last returned by recv_from_any_link, or,
+# with index, of frame index of the last batch or ring receive.
+def packet_type(index=None):
+    if index is None:
+        return lib.get_last_packet_type()
+    return batch_pkttypes[index]
+
 # Receives an interface, a byte array and a length.
 def send_to_link(interface, buffer, length):
     # Create a buffer for the data to be written into
     buffer_size = length
     # Make sure buffer is smaller than MAX_PACKET_LEN
     assert(buffer_size < 1600)
-    
-    c_buf = create_string_buffer(buffer)
+
+    if zero_copy:
+        # bytes go through c_char_p as a pointer to their own storage
+        if isinstance(buffer, memoryview) and not buffer.readonly:
+            buffer = (ctypes.c_char * buffer_size).from_buffer(buffer)
+        elif not isinstance(buffer, bytes):
+            buffer = bytes(buffer)
+        lib.send_to_link(interface, buffer, buffer_size)
+        return
+
+    if isinstance(buffer, memoryview):
+        # Frames from the receive ring are passed to C without copying them
+        c_buf = (ctypes.c_char * buffer_size).from_buffer(buffer)
+    else:
+        c_buf = create_string_buffer(buffer)
     c_len = ctypes.c_size_t(buffer_size)
 
     # Call the C function
     result = lib.send_to_link(interface, c_buf, c_len)
 
+# Returns an object ctypes passes to C as a pointer to the bytes of buf.
+# bytes and writable buffers are not copied, read-only views are.
+def buffer_pointer(buf):
+    if isinstance(buf, bytes):
+        return buf
+    if isinstance(buf, memoryview) and buf.readonly:
+        return bytes(buf)
+    return (ctypes.c_char * len(buf)).from_buffer(buf)
+
+# Sends header + tag + payload as one frame without joining them in Python.
+# Used to push or pop a VLAN tag: the payload is usually a memoryview of the
+# received frame.
+def send_to_link_iov(interface, header, tag, payload):
+    lib.send_to_link_iov(interface,
+                         buffer_pointer(header), len(header),
+                         tag, len(tag),
+                         buffer_pointer(payload), len(payload))
+
+# Keeps only BPDUs (bpdus_only=True) or everything but BPDUs on all interfaces
+def set_bpdu_filter(bpdus_only):
+    lib.set_bpdu_filter(1 if bpdus_only else 0)
+
+# Gives BPDUs sockets of their own that every receive function serves before
+# the data frames. With SWITCH_RX_RING, recv_control must be drained before
+# each recv_from_any_link_ring, which returns nothing while BPDUs wait.
+def open_control_sockets():
+    lib.open_control_sockets()
+
+# Returns the BPDUs waiting on the control sockets, as (interface, data, length)
+def recv_control(max_frames=MAX_BATCH_FRAMES):
+    frames = []
+    while len(frames) < max_frames:
+        interface = lib.recv_control(rx_buffer, rx_length_ref)
+        if interface < 0:
+            break
+        length = rx_length.value
+        frames.append((interface, rx_buffer.raw[:length], length))
+    return frames
+
+# Readable while BPDUs wait on the control sockets, -1 if they are not open
+def get_control_fd():
+    return lib.get_control_fd()
+
+# Spreads the frames of every interface across the processes in its group.
+# groups is a ctypes int array, one first id to try per interface; the ids
+# joined are written back.
+def join_fanout(groups, mode=PACKET_FANOUT_HASH):
+    lib.join_fanout(groups, mode)
+
+# Tables read by the C forwarding thread, kept alive as long as it runs
+fastpath_tables = []
+
+# Starts forwarding in a C thread of dlink.so. vlans is the access VLAN of
+# every port (0 for trunks), states a ctypes bool array of the port states,
+# one row of ports per spanning tree instance, instances the row of each
+# VLAN id, lags the logical port of each interface, lag_slots a ctypes int
+# array with the member of every hash slot (see fastpath.h) and fdb_buffer
+# the shared memory of an FDB with fdb_size slots. states, lag_slots and the
+# FDB are read in place, later changes take effect immediately.
+def fastpath_start(vlans, states, instances, lags, lag_slots, fdb_buffer, fdb_size):
+    port_vlans = (ctypes.c_int * len(vlans))(*vlans)
+    vlan_instances = (ctypes.c_uint8 * len(instances))(*instances)
+    port_lags = (ctypes.c_int * len(lags))(*lags)
+    fdb = ctypes.c_char.from_buffer(fdb_buffer)
+    fastpath_tables[:] = [port_vlans, states, vlan_instances, port_lags, lag_slots, fdb]
+    lib.fastpath_set_ports(port_vlans, ctypes.cast(states, ctypes.POINTER(ctypes.c_uint8)),
+                           vlan_instances)
+    lib.fastpath_set_lags(port_lags, ctypes.cast(lag_slots, ctypes.POINTER(ctypes.c_int)))
+    lib.fastpath_set_fdb(ctypes.addressof(fdb), fdb_size)
+    return lib.fastpath_start()
+
+# Storm control tables, kept alive as long as storm_allow may run
+storm_tables = []
+
+# Installs the storm control rates of every port and class (see storm.py).
+# buckets is a ctypes uint64 array as long as limits, shared by the processes
+# that share the limits; dlink.so updates it atomically, no lock needed.
+def storm_init(limits, buckets, lock=None):
+    storm_limits = (ctypes.c_uint32 * len(limits))(*limits)
+    storm_tables[:] = [storm_limits, buckets]
+    lib.storm_init(storm_limits, ctypes.cast(buckets, ctypes.POINTER(ctypes.c_uint64)))
+
+# False if the port already flooded its limit of the traffic class
+def storm_allow(port, traffic_class, length):
+    return lib.storm_allow(port, traffic_class, length) != 0
+
+# Returns the next (interface, data, length) the C thread could not forward
+# itself, or None after timeout_ms (-1 waits forever)
+def fastpath_punt_recv(timeout_ms=-1):
+    result = lib.fastpath_punt_recv(rx_buffer, rx_length_ref, timeout_ms)
+    if result < 0:
+        return None
+    length = rx_length.value
+    if zero_copy:
+        return result, rx_view[:length], length
+    return result, bytes(rx_view[:length]), length
+
+# Readable while punted frames are waiting, e.g. for loop.add_reader
+def fastpath_punt_fd():
+    return lib.fastpath_punt_fd()
+
+# Carrier of the interfaces, watched through rtnetlink once asked for
+link_monitor = None
+
+# Returns a file descriptor that is readable while recv_link_events() has news
+def open_link_events():
+    global link_monitor
+    link_monitor = LinkMonitor([get_interface_name(i) for i in range(num_interfaces)])
+    return link_monitor.fileno()
+
+# Returns (interface, up) for every carrier change since the last call
+def recv_link_events():
+    return link_monitor.events()
+
+# Counter block updated by dlink.so, see stats.py; kept alive while in use
+port_stats = None
+
+# Makes dlink.so count rx/tx frames and bytes (and the fast path decisions)
+# into block, a writable buffer of STATS_COUNTERS words per interface
+def set_port_stats(block):
+    global port_stats
+    port_stats = (ctypes.c_uint64 * len(block)).from_buffer(block)
+    lib.set_port_stats(ctypes.addressof(port_stats))
+
 def get_switch_mac():
+    # Our switch should have only 1 MAC and such
+    # we return the MAC from interface 1
+    return get_interface_mac(1)
+
+def get_interface_mac(interface):
     # Create a buffer for the MAC address
     mac_buffer = (ctypes.c_uint8 * 6)()
-    
+
     # Call the get_inferface mac function.
-    # Our switch should have only 1 MAC and such
-    # we return the MAC from interface 0
-    lib.get_interface_mac(1, mac_buffer)
-    
+    lib.get_interface_mac(interface, mac_buffer)
+
     return bytes(mac_buffer)
 
 # Returns the name of an interface, used for the VLAN subtask